@@ -0,0 +1,153 @@
+'''
+asyncio access to PostgreSQL for the queries on the request path. Queries are still built with
+the peewee models, only the round trip goes through a bounded asyncpg pool, so a handler awaits
+the database instead of blocking every other session of the worker:
+    rows = await adb.fetch(UserHistory.select().where(...))
+fetch() hands the rows to the query's own peewee result wrapper, so they come back as model
+instances, dicts or tuples exactly like iterating the query would. Model.save() overrides do
+not run in create().
+The pool belongs to the event loop that first used it and is recreated for a new loop.
+'''
+import asyncio
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import List
+
+import asyncpg
+import dotenv
+import orjson
+from psycopg2.extras import Json
+
+from db import db
+from metrics import metrics
+
+dotenv.load_dotenv()
+
+DB_ASYNC_POOL_MIN = int(os.getenv('DB_ASYNC_POOL_MIN', 2))
+DB_ASYNC_POOL_MAX = int(os.getenv('DB_ASYNC_POOL_MAX', 10))
+
+_pool_task = None
+_pool_loop = None
+
+
+def _json_encode(value) -> str:
+    return value if isinstance(value, str) else orjson.dumps(value).decode()
+
+
+async def _init_connection(connection) -> None:
+    # peewee's field conversions expect what psycopg2 returns: decoded JSON, and the text form of
+    # types asyncpg has no codec for (pgvector's vector, halfvec) or a different one (bit)
+    for name in ('json', 'jsonb'):
+        await connection.set_type_codec(name, encoder=_json_encode, decoder=orjson.loads, schema='pg_catalog')
+    await connection.set_type_codec('bit', encoder=str, decoder=str, schema='pg_catalog', format='text')
+
+
+async def get_pool() -> asyncpg.Pool:
+    global _pool_task, _pool_loop
+    loop = asyncio.get_running_loop()
+    if _pool_task is None or _pool_loop is not loop:
+        params = db.connect_params
+        _pool_loop = loop
+        # a task, so concurrent first callers share one pool
+        _pool_task = asyncio.ensure_future(asyncpg.create_pool(
+            database=db.database, user=params.get('user'), password=params.get('password'),
+            host=params.get('host'), port=int(params.get('port') or 5432),
+            min_size=DB_ASYNC_POOL_MIN, max_size=DB_ASYNC_POOL_MAX,
+            init=_init_connection))
+    return await _pool_task
+
+
+async def close() -> None:
+    global _pool_task, _pool_loop
+    if _pool_task is not None and _pool_loop is asyncio.get_running_loop():
+        await (await _pool_task).close()
+    _pool_task = _pool_loop = None
+
+
+@asynccontextmanager
+async def connection():
+    '''A pooled connection. Waits while all DB_ASYNC_POOL_MAX connections are in use.'''
+    pool = await get_pool()
+    start = time.perf_counter()
+    async with pool.acquire() as conn:
+        metrics.observe('adb.acquire.seconds', time.perf_counter() - start)
+        yield conn
+
+
+@asynccontextmanager
+async def transaction():
+    async with connection() as conn:
+        async with conn.transaction():
+            yield conn
+
+
+def _sql(query):
+    '''The query's SQL in asyncpg's $n placeholder style and its parameters.'''
+    sql, params = query.sql()
+    count = 0
+
+    def placeholder(match):
+        nonlocal count
+        if match.group() == '%%':
+            return '%'
+        count += 1
+        return f'${count}'
+
+    sql = re.sub(r'%[s%]', placeholder, sql)
+    # a literal %s spliced into raw SQL would shift every later parameter, bind values instead
+    if count != len(params):
+        raise ValueError(f'Query has {count} placeholders for {len(params)} parameters: {sql}')
+    return sql, [param.adapted if isinstance(param, Json) else param for param in params]
+
+
+class _Cursor:
+    '''The part of a DB-API cursor peewee's result wrappers read fetched rows through.'''
+    def __init__(self, columns: List[str], records) -> None:
+        self.description = [(name,) for name in columns]
+        self.records = iter(records)
+
+    def fetchone(self):
+        return next(self.records, None)
+
+    def close(self) -> None:
+        pass
+
+
+async def fetch(query, conn=None) -> list:
+    '''Rows of a select (or raw) query, converted the way iterating the query would.'''
+    if conn is None:
+        async with connection() as conn:
+            return await fetch(query, conn)
+    sql, params = _sql(query)
+    start = time.perf_counter()
+    # fetch() goes through the connection's prepared statement cache, prepare() would not
+    records = await conn.fetch(sql, *params)
+    metrics.observe('adb.query.seconds', time.perf_counter() - start)
+    # peewee only reads the column names once there is a row
+    columns = list(records[0].keys()) if records else []
+    return list(query._get_cursor_wrapper(_Cursor(columns, records)))
+
+
+async def execute(query, conn=None) -> int:
+    '''Run an insert, update or delete. Returns the number of rows affected.'''
+    if conn is None:
+        async with connection() as conn:
+            return await execute(query, conn)
+    sql, params = _sql(query)
+    start = time.perf_counter()
+    status = await conn.execute(sql, *params)
+    metrics.observe('adb.query.seconds', time.perf_counter() - start)
+    count = status.rsplit(' ', 1)[-1]
+    return int(count) if count.isdigit() else 0
+
+
+async def create(model, conn=None, **values):
+    '''Model.create(): insert one row with the model's defaults and return the instance.'''
+    instance = model(**values)
+    primary_key = model._meta.primary_key
+    rows = await fetch(model.insert(instance.__data__).returning(primary_key).tuples(), conn)
+    setattr(instance, primary_key.name, rows[0][0])
+    instance._dirty.clear()
+    return instance
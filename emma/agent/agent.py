@@ -7,8 +7,9 @@ import time
 from pydantic import BaseModel, Field
 from uuid import UUID
 from typing import Optional
+import adb
 from db import UserHistory
-from history import get_history
+from history import aget_history
 from logger import logger
 
 load_dotenv()
@@ -63,6 +64,15 @@ class Agent:
         except Exception as e:
             logger.error(f"Failed to store history: {e}")
             raise
+
+    async def _astore_history(self, role: str, message: str, state: int = 0) -> None:
+        """_store_history() for async handlers, on the asyncpg pool"""
+        try:
+            await adb.create(UserHistory, user_id=self.config.user_id, session_id=self.config.session_id,
+                             role=role, message=message, state=state)
+        except Exception as e:
+            logger.error(f"Failed to store history: {e}")
+            raise
         
     async def _user_llm(self, query: str, sys_msg: str, history: list, temperature: float = 0.85, stream: bool = False):
         """User LLM. Final return to user
@@ -80,19 +90,19 @@ class Agent:
             agent_resp = llm_resp.choices[0].message.content
             yield llm_resp
         # save to history
-        self._store_history('assistant', agent_resp)
+        await self._astore_history('assistant', agent_resp)
 
 
 class ChatAgent(Agent):
     async def act(self, query: str, state: int, agent_type: str = 'default', template=None, context: dict = None, temperature=0.85, stream=False) -> AsyncGenerator[Dict[str, Any], None]:
         # get UserHistory
-        history = get_history(self.config.user_id, self.config.session_id)
+        history = await aget_history(self.config.user_id, self.config.session_id)
         if history:
             history = history['history']
         else:
             history =[]
         # store user query in UserHistory
-        self._store_history('user', query, state)
+        await self._astore_history('user', query, state)
         # create query
         if agent_type == 'default':
             if context:
@@ -108,8 +118,8 @@ class MemoryAgent(Agent):
         super().__init__(config)
         self.organization = config['organization']
         
-    def memory(self, query):
-        return Memory.think_about(self.organization, query)
+    async def memory(self, query):
+        return await Memory.athink_about(self.organization, query)
     
 
 class NullAgent(Agent):
@@ -124,8 +134,8 @@ class NullAgent(Agent):
                  'system_fingerprint': 'fp_990915emma',
                  'choices': [{'index': 0, 'delta': d[0], 'logprobs': None, 'finish_reason': d[1]}]} for d in zip(content, finish_reason)]
         # save to history
-        self._store_history('user', query)
-        self._store_history('assistant', message)
+        await self._astore_history('user', query)
+        await self._astore_history('assistant', message)
         for chunk in resp:
             yield chunk
     
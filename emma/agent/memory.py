@@ -5,25 +5,37 @@ import os
 sys.path.append(os.path.abspath('..'))
 
 from peewee import *
-from openai import OpenAI
+import asyncio
 import dotenv
 import os
-from embedding import LocalEmbedding
+import re
+from embedding_registry import get_backend
+from embedding_cache import CachedEmbedding
+from embedding_client import EMBEDDING_STREAM_BATCH
 from prompt import memory_prompt
-from db import MemoryModel
+from db import db, release_connection, MemoryModel
+import adb
+from memory_index import MEMORY_INDEX, memory_index
+from vector_index import asearch_settings, search_settings
 from tool.load_file import LoadWordDoc
 import time
 from uuid import UUID, uuid4
 from pydantic import BaseModel, Field
 from llm import llm
+from logger import logger
+from metrics import metrics
 
 dotenv.load_dotenv()
 
+# think_about answers without the LLM when the best FAQ match is at least this similar to the
+# query, and gives up without it below the floor; both depend on the embedding model
+MEMORY_ACCEPT_SIMILARITY = float(os.getenv('MEMORY_ACCEPT_SIMILARITY', 0.95))
+MEMORY_REJECT_SIMILARITY = float(os.getenv('MEMORY_REJECT_SIMILARITY', 0.5))
+
       
 class Memory:
     model = 'qwen2-72b-instruct'
-    client = OpenAI(api_key=os.getenv("DASHSCOPE_KEY"), base_url="https://dashscope.aliyuncs.com/compatible-mode/v1")
-    embedding_engine = LocalEmbedding
+    embedding_engine = CachedEmbedding(get_backend())
 
     @classmethod
     def load_memory(cls, filepath, organization, meta=None, file_type="docx", monitor=None):
@@ -31,19 +43,32 @@ class Memory:
             pairs = LoadWordDoc().load(filepath).split_content()
         text_list = [pair['query'] for pair in pairs]
         start_time = time.time()
-        embeddings = LocalEmbedding.embeddings(inputs=text_list)
+        batches = (text_list[i:i + EMBEDDING_STREAM_BATCH] for i in range(0, len(text_list), EMBEDDING_STREAM_BATCH))
+        done = 0
+        own_connection = db.is_closed()
+        # insert every batch as soon as its vectors arrive, each in its own short transaction so
+        # no transaction stays open while the next batch is being embedded
+        try:
+            for embeddings in cls.embedding_engine.stream_embeddings(batches):
+                db_data = [{'text': p['query'],
+                            'ans': p['ans'],
+                            'embedding': e,
+                            'organization': organization,
+                            'meta': meta} for (p, e) in zip(pairs[done:done + len(embeddings)], embeddings)]
+                with db.atomic():
+                    MemoryModel.insert_many(db_data).execute()
+                done += len(embeddings)
+                logger.info(f'{done}/{len(text_list)} memories stored for {organization}')
+            memory_index.refresh(organization)
+        finally:
+            if own_connection:
+                release_connection()
         if monitor:
             end_time = time.time()
             monitor.insert_execution_stat({'name': 'embedding',
                                            'size': len(text_list),
                                            'meta': {'embedding': 'local', 'model': 'xiaobu-embedding-v2'},
                                            'duration': end_time - start_time})
-        db_data = [{'text': p['query'],
-                    'ans': p['ans'],
-                    'embedding': e,
-                    'organization': organization,
-                    'meta': meta} for (p, e) in zip(pairs, embeddings)]
-        MemoryModel.insert_many(db_data).execute()
         return 1
 
     @classmethod
@@ -57,37 +82,81 @@ class Memory:
         except MemoryModel.DoesNotExist:
             return None
 
+    @classmethod
+    def _memory_select(cls, organization, query_embedding, topk=10):
+        return MemoryModel.select(MemoryModel.id, MemoryModel.text, MemoryModel.ans, (1 - MemoryModel.embedding.cosine_distance(query_embedding)).alias('similarity')).where(MemoryModel.organization == organization).order_by(MemoryModel.embedding.cosine_distance(query_embedding)).limit(topk)
+
+    @classmethod
+    def _memory_query(cls, organization, query_embedding, topk=10):
+        # small FAQ tables are searched in memory, see memory_index.py
+        index = memory_index.get(organization) if MEMORY_INDEX else None
+        if index is not None:
+            return index.search(query_embedding, topk)
+        with search_settings(limit=topk):
+            return list(cls._memory_select(organization, query_embedding, topk))
+
+    @classmethod
+    async def _amemory_query(cls, organization, query_embedding, topk=10):
+        index = await memory_index.aget(organization) if MEMORY_INDEX else None
+        if index is not None:
+            return index.search(query_embedding, topk)
+        async with asearch_settings(limit=topk) as conn:
+            return await adb.fetch(cls._memory_select(organization, query_embedding, topk), conn)
+
     @classmethod
     def search_memory(cls, organization, query, topk=10):
         # achieve topk by using vector similarity
         query_embedding = cls.embedding_engine.embeddings(inputs=query)[0]
-        mem_query = MemoryModel.select(MemoryModel.id, MemoryModel.text, MemoryModel.ans).where(MemoryModel.organization == organization).order_by(MemoryModel.embedding.cosine_distance(query_embedding)).limit(topk)
-        return mem_query
+        return cls._memory_query(organization, query_embedding, topk)
+
+    @classmethod
+    async def asearch_memory(cls, organization, query, topk=10):
+        query_embedding = (await cls.embedding_engine.aembeddings(inputs=query))[0]
+        return await cls._amemory_query(organization, query_embedding, topk)
     
     @classmethod
-    def think_about(cls, organization, query):
-        mem_query = cls.search_memory(organization, query)
-        llm_query_examples = [q.text for q in mem_query]
-        llm_query_ans = [q.ans for q in mem_query]
-        llm_query = memory_prompt().render(query=query, memory=llm_query_examples)
-        if not llm_query:
+    def _short_circuit(cls, memories):
+        '''(decided, answer) from the similarity of the best match alone, so the LLM is not asked.'''
+        if not memories:
+            metrics.incr('memory.think.llm_avoided.empty')
+            return True, None
+        if memories[0].similarity >= MEMORY_ACCEPT_SIMILARITY:
+            metrics.incr('memory.think.llm_avoided.accept')
+            return True, memories[0].ans
+        if memories[0].similarity < MEMORY_REJECT_SIMILARITY:
+            metrics.incr('memory.think.llm_avoided.reject')
+            return True, None
+        return False, None
+
+    @classmethod
+    async def athink_about(cls, organization, query):
+        '''The stored answer of the FAQ entry that answers the query, or None if there is none.'''
+        memories = await cls.asearch_memory(organization, query)
+        decided, ans = cls._short_circuit(memories)
+        if decided:
+            metrics.incr('memory.think.llm_avoided')
+            return ans
+        llm_query = memory_prompt().render(query=query, memory=[m.text for m in memories])
+        # the LLM picks the number of the matching entry
+        metrics.incr('memory.think.llm_calls')
+        llm_ans = await llm(llm_query, model=cls.model, sys_msg="You are a helpful assistant.", temperature=0.1, is_text=True)
+        if not llm_ans or 'Fuiyo' in llm_ans:
             return None
-        # connect to llm model and wait for response
-        response = cls.client.chat.completions.create(
-            model=cls.model,
-            messages=[{"role": "system", "content": "You are a helpful assistant."},
-                      {"role": "user", "content": llm_query}],
-            stream=False,
-            temperature=0.1
-        )
-        llm_ans = response.choices[0].message.content
-        if 'Fuiyo' in llm_ans:
-            print(llm_query)
-            print(llm_ans)
+        picked = re.search(r'\d+', llm_ans)
+        if not picked or not 1 <= int(picked.group()) <= len(memories):
+            logger.error(f'Memory answer is not an entry number: {llm_ans}')
             return None
-        # ans = MemoryModel.select(MemoryModel.ans).where(MemoryModel.id == mem_query[0].id).get().ans
-        ans = llm_query_ans[int(llm_ans)-1]
-        return ans
+        return memories[int(picked.group()) - 1].ans
+
+    @classmethod
+    def think_about(cls, organization, query):
+        # for scripts, async code awaits athink_about
+        async def run():
+            try:
+                return await cls.athink_about(organization, query)
+            finally:
+                await adb.close()
+        return asyncio.run(run())
 
 
 class LocalMemoryModel(BaseModel):
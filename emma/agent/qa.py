@@ -12,10 +12,15 @@ class QAAgent(RagAgent):
         vectors, context = self.vector_retrieval.vector_retrieval(query=query, topk=5, raw=True)
         self.context = context
         return vectors, context
+
+    async def arag(self, query):
+        vectors, context = await self.vector_retrieval.avector_retrieval(query=query, topk=5, raw=True)
+        self.context = context
+        return vectors, context
     
     async def act(self, query):
         if not self.context:
-            _, self.context = self.rag(query)
+            _, self.context = await self.arag(query)
         # mem_ans = self.memory(query)
         # (queries, ans) = Memory.get_memory(self.organization, limit=15)
         # examples = list(zip(queries, ans))
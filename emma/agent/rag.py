@@ -1,6 +1,8 @@
+import asyncio
 from prompt import basic_rag_prompt, rag_with_examplar_prompt, rag_with_memory_prompt, rag_with_memory_prompt_cn
 from agent.agent import Agent, MemoryAgent
 from agent.memory import Memory
+from db import in_worker_thread
 from vectorization import VectorRetrival
 from redis import Redis
 
@@ -19,9 +21,14 @@ class RagAgent(MemoryAgent):
         self.context, self.context_meta = self.vector_retrieval.rerank(query)
         return self.context, self.context_meta
 
+    async def arag(self, query):
+        await self.vector_retrieval.avector_retrieval(query=query)
+        self.context, self.context_meta = await self.vector_retrieval.arerank(query)
+        return self.context, self.context_meta
+
     async def act(self, query):
-        mem_ans = self.memory(query)
-        (queries, ans) = Memory.get_memory(self.organization, limit=15)
+        mem_ans = await self.memory(query)
+        (queries, ans) = await asyncio.to_thread(in_worker_thread, Memory.get_memory, self.organization, limit=15)
         examples = list(zip(queries, ans))
         if mem_ans:
             query = rag_with_memory_prompt().render(retrieved_chunk=self.context, question=query, memory=mem_ans, examples=examples)
@@ -0,0 +1,157 @@
+'''
+Event-loop lag of concurrent chat sessions while they run the database round trips of a chat
+turn (history read, user message insert, product list, vector search, answer insert), with
+synchronous peewee on the event loop versus the asyncpg pool of adb.py.
+Needs a local PostgreSQL with pgvector, configured through the usual DB_* variables:
+    python bench/bench_async_db.py --sessions 50 --turns 10
+The LLM call of every turn is an asyncio.sleep of --llm-ms. Tables live in a scratch schema
+that is dropped afterwards.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import asyncio
+import time
+import uuid
+
+import numpy as np
+
+import adb
+from db import db, UserHistory, Vector1792
+from history import _history_query, _to_history
+from ingest import copy_rows
+from serve.db import Product
+from vector_index import VectorIndex, asearch_settings, cosine_distance, create_index, search_settings
+
+SCHEMA = 'bench_async_db'
+
+
+def setup(sessions, history, rows, rng):
+    db.execute_sql(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    db.execute_sql(f'CREATE SCHEMA {SCHEMA}')
+    db.execute_sql(f'SET search_path TO {SCHEMA}, public')
+    db.create_tables([UserHistory, Vector1792])
+    Product.create_table()
+    Product.insert_many([{'name': f'product {i}', 'pid': i, 'price': 9.9, 'brief': '低 GI 代餐', 'description': ''}
+                         for i in range(30)]).execute()
+    session_ids = [uuid.uuid4() for _ in range(sessions)]
+    UserHistory.insert_many([{'user_id': f'u{s}', 'session_id': session_id, 'role': 'user', 'message': '孕期饮食' * 20}
+                             for s, session_id in enumerate(session_ids) for _ in range(history)]).execute()
+    vectors = rng.standard_normal((rows, 1792)).astype(np.float32)
+    copy_rows(Vector1792, [Vector1792.doc_id, Vector1792.text, Vector1792.embedding, Vector1792.organization, Vector1792.meta],
+              [('d', f'chunk {i}', vector, 'bench', {}) for i, vector in enumerate(vectors)])
+    create_index(VectorIndex(Vector1792))
+    db.execute_sql('ANALYZE')
+    return session_ids, vectors
+
+
+def vector_query(embedding):
+    return (Vector1792.select(Vector1792.id, Vector1792.text)
+            .where(Vector1792.organization == 'bench')
+            .order_by(cosine_distance(Vector1792.embedding, embedding)).limit(5))
+
+
+def sync_turn(user_id, session_id, embedding):
+    with db.atomic():
+        db.execute_sql(f'SET LOCAL search_path TO {SCHEMA}, public')
+        _to_history(list(_history_query(user_id, session_id, 40)))
+        UserHistory.create(user_id=user_id, session_id=session_id, role='user', message='今天吃什么')
+        list(Product.select())
+    with search_settings(limit=5):
+        db.execute_sql(f'SET LOCAL search_path TO {SCHEMA}, public')
+        list(vector_query(embedding))
+
+
+async def async_turn(user_id, session_id, embedding):
+    async with adb.transaction() as conn:
+        await conn.execute(f'SET LOCAL search_path TO {SCHEMA}, public')
+        _to_history(await adb.fetch(_history_query(user_id, session_id, 40), conn))
+        await adb.create(UserHistory, conn, user_id=user_id, session_id=session_id, role='user', message='今天吃什么')
+        await adb.fetch(Product.select(), conn)
+    async with asearch_settings(limit=5) as conn:
+        await conn.execute(f'SET LOCAL search_path TO {SCHEMA}, public')
+        await adb.fetch(vector_query(embedding), conn)
+
+
+def sync_answer(user_id, session_id):
+    with db.atomic():
+        db.execute_sql(f'SET LOCAL search_path TO {SCHEMA}, public')
+        UserHistory.create(user_id=user_id, session_id=session_id, role='assistant', message='建议' * 50)
+
+
+async def async_answer(user_id, session_id):
+    async with adb.transaction() as conn:
+        await conn.execute(f'SET LOCAL search_path TO {SCHEMA}, public')
+        await adb.create(UserHistory, conn, user_id=user_id, session_id=session_id, role='assistant', message='建议' * 50)
+
+
+async def session(index, session_id, embeddings, is_async, turns, tick, llm, lags, turn_times):
+    async def stream():
+        # stands in for the websocket writer: wakes up every tick and records how late it was
+        while not done.is_set():
+            expected = time.perf_counter() + tick
+            await asyncio.sleep(tick)
+            lags.append(time.perf_counter() - expected)
+
+    done = asyncio.Event()
+    streamer = asyncio.create_task(stream())
+    user_id = f'u{index}'
+    for turn in range(turns):
+        start = time.perf_counter()
+        embedding = embeddings[(index * turns + turn) % len(embeddings)]
+        if is_async:
+            await async_turn(user_id, session_id, embedding)
+        else:
+            sync_turn(user_id, session_id, embedding)
+        await asyncio.sleep(llm)
+        if is_async:
+            await async_answer(user_id, session_id)
+        else:
+            sync_answer(user_id, session_id)
+        turn_times.append(time.perf_counter() - start - llm)
+    done.set()
+    await streamer
+
+
+async def run(session_ids, embeddings, is_async, turns, tick, llm):
+    lags, turn_times = [], []
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[session(i, session_id, embeddings, is_async, turns, tick, llm, lags, turn_times)
+                               for i, session_id in enumerate(session_ids)])
+    finally:
+        if is_async:
+            await adb.close()
+    elapsed = time.perf_counter() - start
+    lags, turn_times = np.array(lags) * 1000, np.array(turn_times) * 1000
+    return elapsed, np.percentile(lags, 50), np.percentile(lags, 99), lags.max(), np.percentile(turn_times, 50)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--history', type=int, default=40, help='stored messages per session')
+    parser.add_argument('--rows', type=int, default=2000, help='vector rows searched')
+    parser.add_argument('--llm-ms', type=float, default=200)
+    parser.add_argument('--tick-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    db.connect()
+    try:
+        session_ids, vectors = setup(args.sessions, args.history, args.rows, np.random.default_rng(0))
+        print(f"{args.sessions} sessions x {args.turns} turns, pool of {adb.DB_ASYNC_POOL_MAX} connections")
+        print(f"{'db':>6} {'total s':>8} {'lag p50 ms':>11} {'lag p99 ms':>11} {'lag max ms':>11} {'db/turn p50 ms':>15}")
+        for is_async in (False, True):
+            elapsed, p50, p99, worst, turn = asyncio.run(run(session_ids, vectors, is_async, args.turns,
+                                                             args.tick_ms / 1000, args.llm_ms / 1000))
+            print(f"{'async' if is_async else 'sync':>6} {elapsed:>8.2f} {p50:>11.1f} {p99:>11.1f} {worst:>11.1f} {turn:>15.1f}")
+    finally:
+        db.execute_sql(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
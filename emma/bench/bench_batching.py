@@ -0,0 +1,92 @@
+'''
+Throughput and latency of the embedding server with and without micro-batching.
+Run from emma/: python bench/bench_batching.py [--model /path/to/model]
+Without --model a simulated encoder is used whose cost is a fixed per-call overhead
+plus a per-input cost, which is the shape of SentenceTransformer.encode on CPU.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+import numpy as np
+
+import proto.embedding_query_pb2 as embedding_query_pb2
+import proto.embedding_query_pb2_grpc as embedding_query_pb2_grpc
+from embedding import LocalEmbedding, GRPC_STATIC_TOKEN
+from embedding_client import SERVER_OPTIONS, CHANNEL_OPTIONS
+from metrics import metrics
+
+
+class SimulatedModel:
+    def __init__(self, dim=1792, call_overhead=0.02, per_input=0.002):
+        self.dim = dim
+        self.call_overhead = call_overhead
+        self.per_input = per_input
+
+    def encode(self, inputs, normalize_embeddings=True):
+        time.sleep(self.call_overhead + self.per_input * len(inputs))
+        vectors = np.random.rand(len(inputs), self.dim).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def start_server(model, batching):
+    server = grpc.server(ThreadPoolExecutor(max_workers=128), options=SERVER_OPTIONS)
+    embedding_query_pb2_grpc.add_EmbeddingServiceServicer_to_server(LocalEmbedding(model=model, batching=batching), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    return server, port
+
+
+def run_clients(port, clients, requests_per_client):
+    metadata = [('authorization', GRPC_STATIC_TOKEN or '')]
+    latencies = []
+
+    def client(i):
+        with grpc.insecure_channel(f'127.0.0.1:{port}', options=CHANNEL_OPTIONS) as channel:
+            stub = embedding_query_pb2_grpc.EmbeddingServiceStub(channel)
+            result = []
+            for j in range(requests_per_client):
+                query = embedding_query_pb2.EmbeddingQuery(queries=[f'client {i} query {j}'])
+                start = time.perf_counter()
+                stub.GetEmbeddings(query, metadata=metadata)
+                result.append(time.perf_counter() - start)
+            return result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for result in pool.map(client, range(clients)):
+            latencies.extend(result)
+    elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=None, help='SentenceTransformer path, simulated model if omitted')
+    parser.add_argument('--requests', type=int, default=50, help='requests per client')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 64])
+    args = parser.parse_args()
+    if args.model:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(args.model, local_files_only=True)
+    else:
+        model = SimulatedModel()
+
+    print(f"{'batching':>8} {'clients':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'mean batch':>10}")
+    for batching in (False, True):
+        server, port = start_server(model, batching)
+        for clients in args.clients:
+            metrics.reset()
+            throughput, p50, p99 = run_clients(port, clients, args.requests)
+            batch = metrics.summary('embedding.server.batch_size').get('mean', 1.0)
+            print(f'{str(batching):>8} {clients:>7} {throughput:>9.1f} {p50:>9.1f} {p99:>9.1f} {batch:>10.1f}')
+        server.stop(None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+'''
+Event-loop lag of concurrent chat sessions while they fetch query embeddings,
+using the blocking EmbeddingClient versus the grpc.aio AsyncEmbeddingClient.
+Run from emma/: python bench/bench_event_loop_lag.py
+The server is an in-process stub whose encode cost is --server-ms per call.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+import numpy as np
+
+import proto.embedding_query_pb2 as embedding_query_pb2
+import proto.embedding_query_pb2_grpc as embedding_query_pb2_grpc
+from embedding_client import EmbeddingClient, AsyncEmbeddingClient, encode_embeddings, SERVER_OPTIONS
+
+
+class StubServicer(embedding_query_pb2_grpc.EmbeddingServiceServicer):
+    def __init__(self, delay, dim=1792):
+        self.delay = delay
+        self.dim = dim
+
+    def GetEmbeddings(self, request, context):
+        time.sleep(self.delay)
+        vectors = np.random.rand(len(request.queries), self.dim).astype(np.float32)
+        return embedding_query_pb2.EmbeddingResponse(serialized_embeddings=encode_embeddings(vectors))
+
+
+async def session(client, is_async, turns, tick, lags):
+    async def stream():
+        # stands in for the websocket writer: wakes up every tick and records how late it was
+        while not done.is_set():
+            expected = time.perf_counter() + tick
+            await asyncio.sleep(tick)
+            lags.append(time.perf_counter() - expected)
+
+    done = asyncio.Event()
+    streamer = asyncio.create_task(stream())
+    for turn in range(turns):
+        if is_async:
+            await client.embeddings([f'query {turn}'])
+        else:
+            client.embeddings([f'query {turn}'])
+        await asyncio.sleep(0)
+    done.set()
+    await streamer
+
+
+async def run(target, is_async, sessions, turns, tick):
+    client_cls = AsyncEmbeddingClient if is_async else EmbeddingClient
+    client = client_cls(target=target, insecure=True)
+    lags = []
+    start = time.perf_counter()
+    await asyncio.gather(*[session(client, is_async, turns, tick, lags) for _ in range(sessions)])
+    elapsed = time.perf_counter() - start
+    if is_async:
+        await client.close()
+    else:
+        client.close()
+    lags = np.array(lags) * 1000
+    return elapsed, np.percentile(lags, 50), np.percentile(lags, 99), lags.max()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--server-ms', type=float, default=30)
+    parser.add_argument('--tick-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    server = grpc.server(ThreadPoolExecutor(max_workers=64), options=SERVER_OPTIONS)
+    embedding_query_pb2_grpc.add_EmbeddingServiceServicer_to_server(StubServicer(args.server_ms / 1000), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    target = f'127.0.0.1:{port}'
+
+    print(f"{'client':>6} {'total s':>8} {'lag p50 ms':>11} {'lag p99 ms':>11} {'lag max ms':>11}")
+    for is_async in (False, True):
+        elapsed, p50, p99, worst = asyncio.run(run(target, is_async, args.sessions, args.turns, args.tick_ms / 1000))
+        print(f"{'async' if is_async else 'sync':>6} {elapsed:>8.2f} {p50:>11.1f} {p99:>11.1f} {worst:>11.1f}")
+    server.stop(None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+'''
+Latency of hybrid retrieval against its two legs run one after the other.
+Run from emma/ against a database with the pg_search index on the vector table:
+    python bench/bench_hybrid.py --organization dehan0001
+Each query is embedded once before timing, so all variants hit the embedding cache and
+the numbers compare the database work and how it overlaps.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+
+import numpy as np
+
+from vectorization import VectorRetrival
+
+QUERIES = ['孕期每天需要补充多少叶酸', '妊娠糖尿病饮食', '产后抑郁早期表现', '孕晚期下肢水肿',
+           '哺乳期可以喝咖啡吗', '胎动减少怎么办', '孕早期出血', '缺铁性贫血补铁']
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--organization', required=True)
+    parser.add_argument('--topk', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    retrieval = VectorRetrival(organization=args.organization)
+    retrieval.embedding_model.embeddings(inputs=QUERIES)
+    results = {'vector': [], 'keyword': [], 'vector + keyword': [], 'hybrid': []}
+    for _ in range(args.rounds):
+        for query in QUERIES:
+            vector = timed(retrieval.vector_retrieval, query, topk=2 * args.topk)
+            keyword = timed(retrieval.keyword_retrieval, query, topk=2 * args.topk)
+            results['vector'].append(vector)
+            results['keyword'].append(keyword)
+            results['vector + keyword'].append(vector + keyword)
+            results['hybrid'].append(timed(retrieval.hybrid_retrieval, query, topk=args.topk))
+            retrieval.reset()
+    for name, values in results.items():
+        print(f'{name:18s} p50 {np.percentile(values, 50):7.1f} ms  p95 {np.percentile(values, 95):7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+'''
+Startup cost of importing a module, measured with `python -X importtime` in a fresh interpreter.
+Reports the total, the slowest top-level packages and which embedding providers got imported.
+
+    python bench/bench_importtime.py --module server
+'''
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+EMMA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROVIDERS = ('torch', 'sentence_transformers', 'transformers', 'dashscope', 'volcengine', 'ollama', 'fastapi')
+
+
+def importtime(module: str):
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=EMMA_DIR, capture_output=True, text=True)
+    packages = defaultdict(int)
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        top = name.strip().split('.')[0]
+        imported.add(top)
+        # self times of every submodule add up to the package's own cost
+        packages[top] += int(self_us.strip())
+    if proc.returncode != 0:
+        print(proc.stderr.strip().splitlines()[-1])
+    return packages, imported
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='server')
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    packages, imported = importtime(args.module)
+    total = sum(packages.values())
+    print(f'import {args.module}: {total / 1000:.0f} ms across {len(packages)} top-level packages')
+    for name, us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'  {name:30s} {us / 1000:8.1f} ms')
+    print('providers imported:', ', '.join(p for p in PROVIDERS if p in imported) or 'none')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+'''
+Ingestion throughput of the COPY pipeline against the previous insert_many loop.
+Needs a local PostgreSQL with pgvector, configured through the usual DB_* variables:
+    python bench/bench_ingest.py --chunks 10000 --documents 10
+Chunks are pre-split synthetic text and embeddings are random unit vectors unless
+--embedding local is given, so by default the numbers isolate the write path.
+The last run re-ingests every document after editing --edit of its chunks, which only
+embeds the changed chunks.
+Rows are written to the configured table and deleted again afterwards.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+import db as models
+from db import db, Document, MATRYOSHKA_DIM
+from embedding_client import EMBEDDING_STREAM_BATCH
+from ingest import IngestionPipeline
+from metrics import metrics
+from utils import sliced_norm_l2_batch
+
+
+class RandomEmbedding:
+    def __init__(self, dim):
+        self.dim = dim
+        self.rng = np.random.default_rng(0)
+
+    def embeddings(self, inputs):
+        return sliced_norm_l2_batch(self.rng.standard_normal((len(inputs), self.dim), dtype=np.float32), self.dim)
+
+    def stream_embeddings(self, batches):
+        for batch in batches:
+            yield self.embeddings(batch)
+
+
+class PreSplit:
+    '''Stands in for Vectorization: documents carry their chunks already.'''
+    def __init__(self, embedding_model):
+        self.embedding_model = embedding_model
+
+    def split_document(self, document):
+        return document.chunks, {'embedding_model': 'bench', 'sentence_splitter': 'bench'}
+
+
+def make_documents(chunks, documents, rng):
+    words = ['孕期', '叶酸', '产检', '胎动', '哺乳', 'iron', 'glucose', 'trimester', '水肿', '睡眠']
+    per_doc = chunks // documents
+    return [SimpleNamespace(doc_id=f'bench-{d}', text='',
+                            metadata={'organization': 'bench', 'filename': f'bench-{d}.md'},
+                            chunks=[' '.join(rng.choice(words, size=80)) for _ in range(per_doc)])
+            for d in range(documents)]
+
+
+def insert_many(pipeline, document):
+    # the previous create_doc_vectors write path: one parameterised INSERT per batch
+    inputs, meta = pipeline.vectorization.split_document(document)
+    batches = (inputs[i:i + pipeline.batch_size] for i in range(0, len(inputs), pipeline.batch_size))
+    done = 0
+    with db.atomic():
+        for embeddings in pipeline.vectorization.embedding_model.stream_embeddings(batches):
+            rows = [{'doc_id': document.doc_id, 'text': text, 'embedding': embedding,
+                     'organization': 'bench', 'meta': meta}
+                    for text, embedding in zip(inputs[done:done + len(embeddings)], embeddings)]
+            if pipeline.with_short:
+                for row, short in zip(rows, sliced_norm_l2_batch(embeddings, MATRYOSHKA_DIM)):
+                    row['embedding_short'] = short
+            pipeline.table.insert_many(rows).execute()
+            done += len(embeddings)
+    return done
+
+
+def cleanup(table):
+    table.delete().where(table.organization == 'bench').execute()
+    Document.delete().where(Document.organization == 'bench').execute()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=10000)
+    parser.add_argument('--documents', type=int, default=10)
+    parser.add_argument('--table', default='Vector1792')
+    parser.add_argument('--batch-size', type=int, default=EMBEDDING_STREAM_BATCH)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--embedding', choices=['random', 'local'], default='random')
+    parser.add_argument('--edit', type=float, default=0.1, help='share of chunks changed before re-ingesting')
+    args = parser.parse_args()
+
+    table = getattr(models, args.table)
+    if args.embedding == 'local':
+        from embedding_cache import CachedEmbedding
+        from embedding_registry import get_backend
+        embedding_model = CachedEmbedding(get_backend('local'))
+    else:
+        embedding_model = RandomEmbedding(table.embedding.dimensions)
+    pipeline = IngestionPipeline(PreSplit(embedding_model), table, batch_size=args.batch_size, workers=args.workers)
+    documents = make_documents(args.chunks, args.documents, np.random.default_rng(0))
+    total = sum(len(document.chunks) for document in documents)
+    cleanup(table)
+    try:
+        start = time.perf_counter()
+        for document in documents:
+            insert_many(pipeline, document)
+        elapsed = time.perf_counter() - start
+        print(f'insert_many, sequential  {total / elapsed:8.0f} chunks/s  ({elapsed:.2f}s)')
+        cleanup(table)
+
+        start = time.perf_counter()
+        for document in documents:
+            pipeline.ingest(document)
+        elapsed = time.perf_counter() - start
+        print(f'COPY pipeline, 1 worker  {total / elapsed:8.0f} chunks/s  ({elapsed:.2f}s)')
+        cleanup(table)
+
+        metrics.reset()
+        start = time.perf_counter()
+        pipeline.ingest_many(documents)
+        elapsed = time.perf_counter() - start
+        print(f'COPY pipeline, {args.workers} workers {total / elapsed:8.0f} chunks/s  ({elapsed:.2f}s)')
+        for stage in ('split', 'embed', 'write', 'publish'):
+            seconds = metrics.summary(f'ingest.{stage}.seconds')
+            busy = seconds.get('mean', 0) * seconds.get('count', 0)
+            items = metrics.counter(f'ingest.{stage}.items')
+            print(f'  {stage:6s} {items / busy if busy else 0:10.0f} chunks per busy second')
+
+        rng = np.random.default_rng(1)
+        original = [list(document.chunks) for document in documents]
+        edited = []
+        for chunks in original:
+            chunks = list(chunks)
+            for i in rng.choice(len(chunks), size=int(len(chunks) * args.edit), replace=False):
+                chunks[i] += ' 更新'
+            edited.append(chunks)
+        for incremental in (False, True):
+            for document, chunks in zip(documents, original):
+                document.chunks = chunks
+            pipeline.ingest_many(documents, incremental=False)
+            for document, chunks in zip(documents, edited):
+                document.chunks = chunks
+            start = time.perf_counter()
+            reports = pipeline.ingest_many(documents, incremental=incremental)
+            elapsed = time.perf_counter() - start
+            embedded = sum(report.embedded for report in reports.values())
+            deleted = sum(report.deleted for report in reports.values())
+            print(f're-ingest, {args.edit:.0%} edited, {"incremental" if incremental else "full"}: '
+                  f'{elapsed:.2f}s, {embedded} embedded, {deleted} deleted')
+    finally:
+        cleanup(table)
+
+
+if __name__ == '__main__':
+    main()
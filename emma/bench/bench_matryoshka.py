@@ -0,0 +1,99 @@
+'''
+Recall@k and latency of two-stage Matryoshka retrieval against the single-stage query.
+Run from emma/ against a migrated database (python infra/vector_migrate.py matryoshka):
+    python bench/bench_matryoshka.py --organization dehan0001
+Queries are stored chunk embeddings with a little noise; the exact top-k over the
+organization's rows (computed in numpy) is the ground truth. --offline skips SQL and
+measures only what truncating to the prefix costs in recall.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+
+import numpy as np
+
+from db import db, Vector1792, MATRYOSHKA_DIM, SEARCH_PATH
+from utils import sliced_norm_l2_batch
+from vector_index import identity_filter
+
+
+def load_vectors(organization, metadata):
+    db.execute_sql(f'SET search_path TO {SEARCH_PATH}')
+    rows = (Vector1792.select(Vector1792.id, Vector1792.embedding)
+            .where(identity_filter(Vector1792, organization, metadata['embedding_model'], metadata['sentence_splitter']))
+            .tuples())
+    ids, vectors = zip(*rows)
+    return np.array(ids), np.array(vectors, dtype=np.float32)
+
+
+def make_queries(vectors, n, noise, rng):
+    picked = vectors[rng.choice(len(vectors), size=min(n, len(vectors)), replace=False)]
+    queries = picked + rng.normal(scale=noise, size=picked.shape).astype(np.float32)
+    return sliced_norm_l2_batch(queries, queries.shape[1])
+
+
+def exact_topk(vectors, query, k):
+    return np.argsort(-(vectors @ query))[:k]
+
+
+def offline(vectors, queries, k, candidates):
+    short = sliced_norm_l2_batch(vectors, MATRYOSHKA_DIM)
+    recalls = []
+    for query in queries:
+        truth = set(exact_topk(vectors, query, k))
+        first = np.argsort(-(short @ sliced_norm_l2_batch([query], MATRYOSHKA_DIM)[0]))[:candidates]
+        rescored = first[np.argsort(-(vectors[first] @ query))][:k]
+        recalls.append(len(truth & set(rescored)) / k)
+    return float(np.mean(recalls))
+
+
+def online(retrieval, ids, vectors, queries, k, first_pass):
+    retrieval.first_pass = first_pass
+    recalls, latencies = [], []
+    for query in queries:
+        truth = set(ids[exact_topk(vectors, query, k)])
+        start = time.perf_counter()
+        rows = list(retrieval._vector_query(query, topk=k).select(Vector1792.id).tuples())
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(truth & {row[0] for row in rows}) / k)
+    latencies = np.array(latencies) * 1000
+    return float(np.mean(recalls)), np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--organization', required=True)
+    parser.add_argument('--splitter', default='RawMarkdownSplitter')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--topk', type=int, default=20)
+    parser.add_argument('--candidates', type=int, nargs='+', default=[50, 100, 200, 400])
+    parser.add_argument('--noise', type=float, default=0.02)
+    parser.add_argument('--offline', action='store_true')
+    args = parser.parse_args()
+
+    metadata = {'embedding_model': 'LocalEmbedding', 'sentence_splitter': args.splitter}
+    rng = np.random.default_rng(0)
+    ids, vectors = load_vectors(args.organization, metadata)
+    queries = make_queries(vectors, args.queries, args.noise, rng)
+    print(f'{len(vectors)} rows, {len(queries)} queries, top{args.topk}, prefix {MATRYOSHKA_DIM}')
+
+    if args.offline:
+        for candidates in args.candidates:
+            print(f'candidates={candidates:>4} recall@{args.topk}={offline(vectors, queries, args.topk, candidates):.3f}')
+        return
+
+    from vectorization import VectorRetrival
+    retrieval = VectorRetrival(args.organization, metadata=metadata)
+    recall, p50, p99 = online(retrieval, ids, vectors, queries, args.topk, first_pass=None)
+    print(f"{'single-stage':>22} recall@{args.topk}={recall:.3f} p50={p50:.1f}ms p99={p99:.1f}ms")
+    for candidates in args.candidates:
+        retrieval.candidates = candidates
+        recall, p50, p99 = online(retrieval, ids, vectors, queries, args.topk, first_pass='short')
+        print(f"{f'two-stage c={candidates}':>22} recall@{args.topk}={recall:.3f} p50={p50:.1f}ms p99={p99:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
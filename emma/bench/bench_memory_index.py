@@ -0,0 +1,104 @@
+'''
+FAQ memory search latency and recall: the SQL path of Memory._memory_query (cosine order over the
+organization's MemoryModel rows under search_settings, with the table's ANN index) against the
+in-process memory_index.py matrix-vector product, for organizations of several sizes.
+Needs a local PostgreSQL with pgvector, configured through the usual DB_* variables:
+    python bench/bench_memory_index.py --sizes 500 2000 5000 --others 5
+The query embedding is given, the remote embedding call both paths share is not measured.
+Tables live in a scratch schema that is dropped afterwards.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+
+import numpy as np
+
+from bench_matryoshka import exact_topk, make_queries
+from bench_quantization import synthetic_vectors
+from db import db, MemoryModel
+from memory_index import MemoryIndex
+from vector_index import VectorIndex, create_index, cosine_distance, search_settings
+
+SCHEMA = 'bench_memory_index'
+
+
+def sql_search(organization, query, k):
+    # what Memory._memory_query runs when the index is off
+    with search_settings(limit=k):
+        return [row.id for row in MemoryModel.select(MemoryModel.id, MemoryModel.text, MemoryModel.ans)
+                .where(MemoryModel.organization == organization)
+                .order_by(cosine_distance(MemoryModel.embedding, query)).limit(k)]
+
+
+def measure(search, organization, ids, vectors, queries, k):
+    recalls, latencies = [], []
+    for query in queries:
+        truth = set(ids[exact_topk(vectors, query, k)])
+        start = time.perf_counter()
+        found = search(organization, query, k)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(truth & set(found)) / k)
+    latencies = np.array(latencies) * 1000
+    return float(np.mean(recalls)), np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 2000, 5000], help='memories per measured organization')
+    parser.add_argument('--others', type=int, default=5, help='further organizations of 2000 memories each')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--noise', type=float, default=0.02)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    sizes = {**{f'faq{size}': size for size in args.sizes}, **{f'other{i}': 2000 for i in range(args.others)}}
+    ids, vectors = synthetic_vectors(sum(sizes.values()), MemoryModel.embedding.dimensions, rng)
+    db.connect()
+    try:
+        db.execute_sql(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        db.execute_sql(f'CREATE SCHEMA {SCHEMA}')
+        db.execute_sql(f'SET search_path TO {SCHEMA}, public')
+        db.create_tables([MemoryModel])
+        organizations, start = {}, 0
+        for organization, size in sizes.items():
+            rows = [{'text': f'q{i}', 'ans': f'a{i}', 'embedding': vector, 'organization': organization, 'meta': {}}
+                    for i, vector in enumerate(vectors[start:start + size])]
+            with db.atomic():
+                for batch in range(0, size, 500):
+                    MemoryModel.insert_many(rows[batch:batch + 500]).execute()
+            organizations[organization] = (vectors[start:start + size], start)
+            start += size
+        create_index(VectorIndex(MemoryModel))
+        db.execute_sql('ANALYZE')
+        # ids are assigned in insertion order
+        first_id = db.execute_sql('SELECT min(id) FROM emma_memory').fetchone()[0]
+
+        index = MemoryIndex()
+        print(f'{len(vectors)} memories in {len(sizes)} organizations, top-{args.topk}, {args.queries} queries')
+        print(f"{'organization':>12} {'path':>6} {'recall':>7} {'p50 ms':>8} {'p99 ms':>8}")
+        for size in args.sizes:
+            organization = f'faq{size}'
+            org_vectors, offset = organizations[organization]
+            org_ids = np.arange(len(org_vectors)) + offset + first_id
+            queries = make_queries(org_vectors, args.queries, args.noise, rng)
+            started = time.perf_counter()
+            index.get(organization)
+            loaded = (time.perf_counter() - started) * 1000
+            paths = {'sql': sql_search,
+                     'index': lambda o, q, k: [row.id for row in index.get(o).search(q, k)]}
+            for name, search in paths.items():
+                recall, p50, p99 = measure(search, organization, org_ids, org_vectors, queries, args.topk)
+                print(f'{organization:>12} {name:>6} {recall:>7.3f} {p50:>8.2f} {p99:>8.2f}')
+            matrix = index.get(organization).matrix
+            print(f'{"":>12} index load {loaded:.0f}ms, {matrix.nbytes / 2 ** 20:.1f} MB')
+    finally:
+        db.execute_sql(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Throughput of the Ollama backend against a local stub server:
+sequential per-prompt calls (the old list comprehension), the batch /api/embed path,
+and the concurrent /api/embeddings fallback.
+Run from emma/: python bench/bench_ollama.py [--host http://localhost:11434 --model mxbai-embed-large]
+Without --host a stub is started whose cost per request is --overhead-ms + --per-input-ms * inputs.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ollama
+
+from embedding_ollama import OllamaEmbedding
+
+
+def stub_server(overhead, per_input, dim=1024):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            texts = body['input'] if self.path == '/api/embed' else [body['prompt']]
+            time.sleep(overhead + per_input * len(texts))
+            vectors = [[0.1] * dim for _ in texts]
+            result = {'embeddings': vectors} if self.path == '/api/embed' else {'embedding': vectors[0]}
+            payload = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    class Server(ThreadingHTTPServer):
+        # the default backlog of 5 drops connections under concurrent clients
+        request_queue_size = 128
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--model', default='mxbai-embed-large')
+    parser.add_argument('--chunks', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--overhead-ms', type=float, default=5)
+    parser.add_argument('--per-input-ms', type=float, default=1)
+    args = parser.parse_args()
+
+    host = args.host
+    if host is None:
+        _, host = stub_server(args.overhead_ms / 1000, args.per_input_ms / 1000)
+    texts = [f'chunk {i} of a long manual' for i in range(args.chunks)]
+
+    client = ollama.Client(host=host)
+    start = time.perf_counter()
+    [client.embeddings(model=args.model, prompt=prompt)['embedding'] for prompt in texts]
+    sequential = time.perf_counter() - start
+
+    backend = OllamaEmbedding(args.model, host=host, batch_size=args.batch_size, concurrency=args.concurrency)
+    start = time.perf_counter()
+    backend.embedding(texts)
+    batched = time.perf_counter() - start
+
+    backend.batch_supported = False
+    start = time.perf_counter()
+    backend.embedding(texts)
+    concurrent = time.perf_counter() - start
+
+    for name, elapsed in (('sequential', sequential), ('batch /api/embed', batched), ('concurrent fallback', concurrent)):
+        print(f'{name:>20}: {elapsed:6.2f}s {args.chunks / elapsed:8.1f} chunks/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+Sentences/sec and cosine agreement of the ONNX engines against the PyTorch SentenceTransformer.
+Any small model works on a laptop CPU, e.g.
+    python bench/bench_onnx.py --model sentence-transformers/all-MiniLM-L6-v2
+The ONNX graphs are exported to --onnx-dir (default <model>/onnx) when missing.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+
+import numpy as np
+
+from embedding_onnx import CONFIG_FILE, OnnxEncoder, SAMPLE_SENTENCES, cosine_agreement, export_onnx
+
+
+def make_corpus(n, rng):
+    words = ' '.join(SAMPLE_SENTENCES).split()
+    chars = ''.join(s for s in SAMPLE_SENTENCES if not s.isascii())
+    corpus = []
+    for i in range(n):
+        if i % 2:
+            corpus.append(' '.join(rng.choice(words, size=rng.integers(5, 60))))
+        else:
+            corpus.append(''.join(rng.choice(list(chars), size=rng.integers(8, 120))))
+    return corpus
+
+
+def throughput(encode, corpus, batch_size, repeat):
+    encode(corpus[:batch_size])
+    start = time.perf_counter()
+    for _ in range(repeat):
+        embeddings = encode(corpus)
+    return repeat * len(corpus) / (time.perf_counter() - start), embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--onnx-dir')
+    parser.add_argument('--sentences', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    onnx_dir = args.onnx_dir or os.path.join(args.model, 'onnx')
+    if not os.path.exists(os.path.join(onnx_dir, CONFIG_FILE)):
+        export_onnx(args.model, onnx_dir)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    corpus = make_corpus(args.sentences, np.random.default_rng(0))
+
+    model = SentenceTransformer(args.model, device='cpu')
+    rate, reference = throughput(lambda texts: model.encode(texts, batch_size=args.batch_size, normalize_embeddings=True),
+                                 corpus, args.batch_size, args.repeat)
+    print(f'{"torch fp32":12s} {rate:8.1f} sentences/s')
+    for name, quantized in (('onnx fp32', False), ('onnx int8', True)):
+        encoder = OnnxEncoder(onnx_dir, quantized=quantized, threads=args.threads, batch_size=args.batch_size)
+        rate, embeddings = throughput(lambda texts: encoder.encode(texts, normalize_embeddings=True),
+                                      corpus, args.batch_size, args.repeat)
+        cosine = cosine_agreement(reference, embeddings)
+        print(f'{name:12s} {rate:8.1f} sentences/s  cosine vs torch min {cosine.min():.5f} mean {cosine.mean():.5f}')
+
+
+if __name__ == '__main__':
+    main()
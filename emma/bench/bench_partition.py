@@ -0,0 +1,151 @@
+'''
+Retrieval latency and recall of a small organization next to a large one, with every
+organization in one flat table against the partitioned layout where the large organization
+was split into its own partition (partitioning.split_organization).
+Needs a local PostgreSQL with pgvector, configured through the usual DB_* variables:
+    python bench/bench_partition.py --large 20000 --small 200
+Both layouts are built from the same generated vectors in scratch schemas, which are dropped
+afterwards unless --keep is given. The query is the single-stage retrieval query: identity
+filter, cosine order, top-k, under search_settings.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+
+import numpy as np
+
+from bench_matryoshka import exact_topk, make_queries
+from bench_quantization import synthetic_vectors
+from db import db, Vector1792, MATRYOSHKA_DIM
+from ingest import copy_rows
+from partitioning import split_organization
+from utils import sliced_norm_l2_batch
+from vector_index import INDEXES, create_index, cosine_distance, identity_filter, search_settings
+
+FLAT = 'bench_flat'
+PARTITIONED = 'bench_partitioned'
+MODEL, SPLITTER = 'bench', 'bench'
+
+
+def use(schema):
+    db.execute_sql(f'SET search_path TO {schema}, public')
+
+
+def build_indexes():
+    for index in INDEXES:
+        if index.table is Vector1792:
+            create_index(index)
+
+
+def load(organizations):
+    names = ['doc_id', 'text', 'embedding', 'organization', 'meta', 'embedding_short', 'embedding_model', 'sentence_splitter']
+    fields = [Vector1792._meta.fields[name] for name in names]
+    meta = {'embedding_model': MODEL, 'sentence_splitter': SPLITTER}
+    for organization, (ids, vectors) in organizations.items():
+        shorts = sliced_norm_l2_batch(vectors, MATRYOSHKA_DIM)
+        with db.atomic():
+            copy_rows(Vector1792, fields, ((f'{organization}-{i}', 'bench', vector, organization, meta, short, MODEL, SPLITTER)
+                                           for i, vector, short in zip(ids, vectors, shorts)))
+
+
+def build_partitioned(organizations, large):
+    use(PARTITIONED)
+    Vector1792.create_table()
+    load(organizations)
+    build_indexes()
+    split_organization(Vector1792, large)
+    # the shared partition still carries the dead rows of the organization that moved out
+    db.execute_sql('VACUUM ANALYZE emma_vector1792_default')
+    db.execute_sql('ANALYZE emma_vector1792')
+
+
+def build_flat():
+    use(FLAT)
+    table = Vector1792._meta.table_name
+    db.execute_sql(f'CREATE TABLE {table} (LIKE {PARTITIONED}.{table} INCLUDING DEFAULTS)')
+    db.execute_sql(f'ALTER TABLE {table} ADD PRIMARY KEY (id)')
+    for index in Vector1792._meta.fields_to_index():
+        db.execute_sql(*Vector1792._schema._create_index(index, safe=True).query())
+    db.execute_sql(f'INSERT INTO {table} SELECT * FROM {PARTITIONED}.{table}')
+    build_indexes()
+    db.execute_sql(f'VACUUM ANALYZE {table}')
+
+
+def measure(schema, organization, ids, vectors, queries, k):
+    use(schema)
+    recalls, returned, latencies = [], [], []
+    for query in queries:
+        truth = {f'{organization}-{i}' for i in ids[exact_topk(vectors, query, k)]}
+        start = time.perf_counter()
+        with search_settings(limit=k):
+            rows = list(Vector1792.select(Vector1792.doc_id)
+                        .where(identity_filter(Vector1792, organization, MODEL, SPLITTER))
+                        .order_by(cosine_distance(Vector1792.embedding, query)).limit(k).tuples())
+        latencies.append(time.perf_counter() - start)
+        returned.append(len(rows))
+        recalls.append(len(truth & {row[0] for row in rows}) / k)
+    latencies = np.array(latencies) * 1000
+    return float(np.mean(recalls)), float(np.mean(returned)), np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def plan(schema, organization, query, k):
+    use(schema)
+    sql, params = (Vector1792.select(Vector1792.doc_id)
+                   .where(identity_filter(Vector1792, organization, MODEL, SPLITTER))
+                   .order_by(cosine_distance(Vector1792.embedding, query)).limit(k).sql())
+    with search_settings(limit=k):
+        lines = [row[0] for row in db.execute_sql('EXPLAIN ' + sql, params).fetchall()]
+    return ' / '.join(line.strip() for line in lines if 'Scan' in line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--large', type=int, default=20000, help='rows of the large organization')
+    parser.add_argument('--small', type=int, default=200, help='rows of the small organization')
+    parser.add_argument('--others', type=int, default=10, help='further organizations of --small rows each')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--topk', type=int, default=20)
+    parser.add_argument('--noise', type=float, default=0.02)
+    parser.add_argument('--maintenance-work-mem', default='1GB')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch schemas')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    sizes = {'bench_large': args.large, 'bench_small': args.small,
+             **{f'bench_other{i}': args.small for i in range(args.others)}}
+    ids, vectors = synthetic_vectors(sum(sizes.values()), 1792, rng)
+    organizations, start = {}, 0
+    for organization, size in sizes.items():
+        organizations[organization] = (ids[start:start + size] - start, vectors[start:start + size])
+        start += size
+
+    db.connect()
+    db.execute_sql(f"SET maintenance_work_mem = '{args.maintenance_work_mem}'")
+    try:
+        for schema in (FLAT, PARTITIONED):
+            db.execute_sql(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+            db.execute_sql(f'CREATE SCHEMA {schema}')
+        started = time.perf_counter()
+        build_partitioned(organizations, 'bench_large')
+        build_flat()
+        print(f'{len(vectors)} rows in {len(sizes)} organizations, layouts built in {time.perf_counter() - started:.1f}s')
+        for organization in ('bench_small', 'bench_large'):
+            org_ids, org_vectors = organizations[organization]
+            queries = make_queries(org_vectors, args.queries, args.noise, rng)
+            for schema in (FLAT, PARTITIONED):
+                recall, returned, p50, p99 = measure(schema, organization, org_ids, org_vectors, queries, args.topk)
+                print(f'{organization:12s} {schema:18s} recall@{args.topk}={recall:.3f} rows={returned:5.1f} '
+                      f'p50={p50:6.1f}ms p99={p99:6.1f}ms')
+                print(f'{"":31s} {plan(schema, organization, queries[0], args.topk)}')
+    finally:
+        if not args.keep:
+            for schema in (FLAT, PARTITIONED):
+                db.execute_sql(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
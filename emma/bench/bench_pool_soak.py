@@ -0,0 +1,117 @@
+'''
+Soak test of the shared peewee connection pool: request-like work from more threads than the
+pool has connections, every request returning its connection with release_connection() the way
+serve/lifecycle.py does. Once a second it prints the server-side connection count of the pool
+(pg_stat_activity) next to the pool's own in use / idle / waiting / created numbers; the count
+should level off at DB_MAX_CONNECTIONS or below and stay there.
+Needs a local PostgreSQL, configured through the usual DB_* variables:
+    python bench/bench_pool_soak.py --workers 40 --seconds 60 --kill-every 10
+--kill-every terminates one idle backend of the pool every few seconds. With DB_POOL_PING_AFTER=0
+the health check replaces it if it was waiting in the pool; one that was checked out between two
+statements fails its request.
+The table lives in a scratch schema that is dropped afterwards.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import random
+import threading
+import time
+import uuid
+
+import psycopg2
+
+from db import db, release_connection, UserHistory, DB_MAX_CONNECTIONS
+from metrics import metrics
+
+SCHEMA = 'bench_pool_soak'
+
+
+def request(rng):
+    user_id = f'u{rng.randrange(100)}'
+    with db.atomic():
+        db.execute_sql(f'SET LOCAL search_path TO {SCHEMA}, public')
+        UserHistory.create(user_id=user_id, session_id=uuid.uuid4(), role='user', message='今天吃什么')
+        list(UserHistory.select().where(UserHistory.user_id == user_id).order_by(UserHistory.id.desc()).limit(20))
+    db.execute_sql('SELECT pg_sleep(%s)', (rng.random() * 0.01,))
+
+
+def worker(index, stop, done, errors):
+    rng = random.Random(index)
+    while not stop.is_set():
+        try:
+            request(rng)
+            done.append(1)
+        except Exception as e:
+            errors.append(repr(e))
+        finally:
+            release_connection()
+        # think time between two requests of this worker
+        time.sleep(rng.random() * 0.02)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=40, help='concurrent request threads')
+    parser.add_argument('--seconds', type=int, default=60)
+    parser.add_argument('--kill-every', type=float, default=0, help='terminate an idle pooled backend every N seconds')
+    args = parser.parse_args()
+
+    params = db.connect_params
+    # the monitor has its own connection outside the pool, so it is not counted
+    monitor = psycopg2.connect(dbname=db.database, **dict(params, application_name='bench_pool_monitor'))
+    monitor.autocommit = True
+    application = params.get('application_name')
+
+    def backends():
+        with monitor.cursor() as cursor:
+            cursor.execute('SELECT pid, state FROM pg_stat_activity WHERE application_name = %s', (application,))
+            return cursor.fetchall()
+
+    with db.connection_context():
+        db.execute_sql(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        db.execute_sql(f'CREATE SCHEMA {SCHEMA}')
+        db.execute_sql(f'SET search_path TO {SCHEMA}, public')
+        db.create_tables([UserHistory])
+        db.execute_sql('RESET search_path')
+
+    stop, done, errors = threading.Event(), [], []
+    threads = [threading.Thread(target=worker, args=(i, stop, done, errors), daemon=True) for i in range(args.workers)]
+    print(f'{args.workers} workers, pool of {DB_MAX_CONNECTIONS}')
+    print(f"{'s':>4} {'backends':>9} {'in use':>7} {'idle':>5} {'waiting':>8} {'created':>8} {'req/s':>7} {'errors':>7}")
+    try:
+        for thread in threads:
+            thread.start()
+        last_kill = time.monotonic()
+        for second in range(1, args.seconds + 1):
+            before = len(done)
+            time.sleep(1)
+            pids = backends()
+            idle = [pid for pid, state in pids if state == 'idle']
+            if args.kill_every and time.monotonic() - last_kill >= args.kill_every and idle:
+                with monitor.cursor() as cursor:
+                    cursor.execute('SELECT pg_terminate_backend(%s)', (random.choice(idle),))
+                last_kill = time.monotonic()
+            stats = db.stats()
+            print(f"{second:>4} {len(pids):>9} {stats['in_use']:>7} {stats['idle']:>5} {stats['waiting']:>8} "
+                  f"{stats['created']:>8} {len(done) - before:>7} {len(errors):>7}")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        with db.connection_context():
+            db.execute_sql(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        db.close_all()
+        monitor.close()
+    wait = metrics.summary('db.pool.wait.seconds')
+    print(f"{len(done)} requests, {len(errors)} errors, health check replaced "
+          f"{metrics.counter('db.pool.health_check_failed')} connections, {metrics.counter('db.pool.waits')} waits "
+          f"for a connection" + (f" (p99 of the last {wait['count']}: {wait['p99'] * 1000:.1f}ms)" if wait['count'] else ''))
+    for error in sorted(set(errors))[:5]:
+        print(error)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''
+Recall@k, latency and storage of the quantized first passes (half, binary, the Matryoshka
+prefix) with exact rescoring, against single-stage exact search.
+Run from emma/ against a database with the quantized indexes of the organization
+(python infra/ann_index.py create --table Vector1792 --quantization binary --organization dehan0001):
+    python bench/bench_quantization.py --organization dehan0001
+--offline replays the first passes in numpy over the organization's vectors, --synthetic N
+does the same over N generated vectors and needs no database at all.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+
+import numpy as np
+
+from bench_matryoshka import exact_topk, load_vectors, make_queries, online
+from db import MATRYOSHKA_DIM
+from utils import sliced_norm_l2_batch
+from vector_index import vector_bytes
+
+FIRST_PASSES = ['short', 'half', 'binary']
+
+
+def synthetic_vectors(n, dim, rng, rank=64):
+    # embeddings live near a low-dimensional subspace, unlike isotropic noise
+    basis = rng.standard_normal((rank, dim)).astype(np.float32)
+    vectors = rng.standard_normal((n, rank)).astype(np.float32) @ basis + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return np.arange(n), sliced_norm_l2_batch(vectors, dim)
+
+
+def first_pass_scores(vectors, first_pass):
+    '''Similarity of every vector to a query under the first pass, higher is closer.'''
+    if first_pass == 'short':
+        short = sliced_norm_l2_batch(vectors, MATRYOSHKA_DIM)
+        return lambda query: short @ sliced_norm_l2_batch([query], MATRYOSHKA_DIM)[0]
+    if first_pass == 'half':
+        half = vectors.astype(np.float16)
+        return lambda query: half.astype(np.float32) @ query.astype(np.float16).astype(np.float32)
+    bits = np.packbits(vectors > 0, axis=1)
+    popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+    return lambda query: -popcount[bits ^ np.packbits(query > 0)].sum(axis=1)
+
+
+def offline(vectors, queries, k, first_pass, candidates):
+    scores = first_pass_scores(vectors, first_pass)
+    recalls, first_only = [], []
+    for query in queries:
+        truth = set(exact_topk(vectors, query, k))
+        first = np.argsort(-scores(query), kind='stable')[:candidates]
+        rescored = first[np.argsort(-(vectors[first] @ query))][:k]
+        recalls.append(len(truth & set(rescored)) / k)
+        first_only.append(len(truth & set(first[:k])) / k)
+    return float(np.mean(recalls)), float(np.mean(first_only))
+
+
+def print_storage(dim, rows):
+    for name, size in vector_bytes(dim).items():
+        print(f'{name:6s} {size:6d} bytes/vector {size * rows / 2 ** 20:9.1f} MB for {rows} rows')
+    print(f"short  {vector_bytes(MATRYOSHKA_DIM)['full']:6d} bytes/vector (embedding_short column)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--organization')
+    parser.add_argument('--splitter', default='RawMarkdownSplitter')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--topk', type=int, default=20)
+    parser.add_argument('--candidates', type=int, nargs='+', default=[50, 100, 200, 400])
+    parser.add_argument('--noise', type=float, default=0.02)
+    parser.add_argument('--offline', action='store_true')
+    parser.add_argument('--synthetic', type=int, help='number of generated 1792-d vectors')
+    args = parser.parse_args()
+    if not args.synthetic and not args.organization:
+        parser.error('--organization or --synthetic is required')
+
+    rng = np.random.default_rng(0)
+    metadata = {'embedding_model': 'LocalEmbedding', 'sentence_splitter': args.splitter}
+    ids, vectors = synthetic_vectors(args.synthetic, 1792, rng) if args.synthetic else load_vectors(args.organization, metadata)
+    queries = make_queries(vectors, args.queries, args.noise, rng)
+    print(f'{len(vectors)} rows, {len(queries)} queries, top{args.topk}')
+    print_storage(vectors.shape[1], len(vectors))
+
+    if args.synthetic or args.offline:
+        for first_pass in FIRST_PASSES:
+            for candidates in args.candidates:
+                recall, first_only = offline(vectors, queries, args.topk, first_pass, candidates)
+                print(f'{first_pass:6s} c={candidates:>4} recall@{args.topk}={recall:.3f} (first pass alone {first_only:.3f})')
+        return
+
+    from vector_index import storage_report
+    from vectorization import VectorRetrival
+    from db import Vector1792
+    for index in storage_report(Vector1792, args.organization)['indexes']:
+        print(f"{index['index']:50s} {index['size_bytes'] / 2 ** 20:9.1f} MB {index['predicate'] or ''}")
+    retrieval = VectorRetrival(args.organization, metadata=metadata, cache=False)
+    recall, p50, p99 = online(retrieval, ids, vectors, queries, args.topk, first_pass=None)
+    print(f"{'exact':>14} recall@{args.topk}={recall:.3f} p50={p50:.1f}ms p99={p99:.1f}ms")
+    for first_pass in FIRST_PASSES:
+        for candidates in args.candidates:
+            retrieval.candidates = candidates
+            recall, p50, p99 = online(retrieval, ids, vectors, queries, args.topk, first_pass=first_pass)
+            print(f"{f'{first_pass} c={candidates}':>14} recall@{args.topk}={recall:.3f} p50={p50:.1f}ms p99={p99:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+Bytes on the wire and client decode time of the embedding response formats.
+legacy: list<float> column built from a list of row arrays, decoded with to_pylist()
+float32: fixed_size_list<float32> column, decoded as a numpy view (embedding_client)
+Run from emma/: python bench/bench_wire_format.py
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+
+import numpy as np
+import pyarrow as pa
+
+from embedding_client import encode_embeddings, decode_embeddings
+
+
+def encode_legacy(matrix):
+    buffer = pa.BufferOutputStream()
+    batch = pa.RecordBatch.from_arrays([pa.array(list(matrix))], ['embeddings'])
+    with pa.ipc.new_stream(buffer, batch.schema) as writer:
+        writer.write_batch(batch)
+    return buffer.getvalue().to_pybytes()
+
+
+def decode_legacy(serialized):
+    with pa.ipc.open_stream(pa.BufferReader(serialized)) as reader:
+        return reader.read_next_batch().column(0).to_pylist()
+
+
+def timeit(fn, arg, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dim', type=int, default=1792)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 16, 256, 1024, 4096])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'vectors':>7} {'legacy bytes':>13} {'f32 bytes':>11} {'legacy enc ms':>14} {'f32 enc ms':>11} {'legacy dec ms':>14} {'f32 dec ms':>11}")
+    for n in args.sizes:
+        matrix = np.random.rand(n, args.dim).astype(np.float32)
+        legacy, compact = encode_legacy(matrix), encode_embeddings(matrix)
+        assert np.allclose(np.asarray(decode_legacy(legacy), dtype=np.float32), decode_embeddings(compact))
+        print(f'{n:>7} {len(legacy):>13} {len(compact):>11} '
+              f'{timeit(encode_legacy, matrix, args.repeat):>14.3f} {timeit(encode_embeddings, matrix, args.repeat):>11.3f} '
+              f'{timeit(decode_legacy, legacy, args.repeat):>14.3f} {timeit(decode_embeddings, compact, args.repeat):>11.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,204 @@
 import datetime
+import threading
+import time
+import weakref
 from peewee import *
-from playhouse.postgres_ext import PostgresqlExtDatabase, BinaryJSONField
+from playhouse.pool import MaxConnectionsExceeded
+from playhouse.postgres_ext import BinaryJSONField
 from pgvector.peewee import VectorField
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
 import dotenv
 import os
+from metrics import metrics
 from utils import make_table_name
+try:
+    from playhouse.postgres_ext import PooledPostgresqlExtDatabase
+except ImportError:
+    # peewee before 3.18 keeps it in playhouse.pool
+    from playhouse.pool import PooledPostgresqlExtDatabase
 
 dotenv.load_dotenv()
 
+# width of the normalised Matryoshka prefix stored next to the full vector
+MATRYOSHKA_DIM = 256
+# schemas the vector tables are looked up in
+SEARCH_PATH = os.getenv('DB_SEARCH_PATH', 'valacy,public')
 
-db = PostgresqlExtDatabase(
+
+# The pool is shared by every model module (db.py, nutrition/db.py, serve/db.py) of a process.
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', 20))
+# connections older than this (seconds) are closed instead of being handed out again
+DB_STALE_TIMEOUT = int(os.getenv('DB_STALE_TIMEOUT', 300))
+# how long a thread waits for a free connection before MaxConnectionsExceeded
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 10))
+# connections idle for longer than this are pinged before reuse, 0 pings on every checkout
+DB_POOL_PING_AFTER = float(os.getenv('DB_POOL_PING_AFTER', 30))
+
+
+class HealthCheckedPool(PooledPostgresqlExtDatabase):
+    '''
+    Connection pool that pings connections which sat idle before handing them out again, so a
+    connection the server or a proxy dropped is replaced instead of failing the next query.
+    Every thread checks out its own connection on first use and returns it with close();
+    serve/lifecycle.py does that after each request. The size of the pool is published as the
+    db.pool.* metrics.
+    '''
+    def __init__(self, database, ping_after: float = DB_POOL_PING_AFTER, **kwargs):
+        self.ping_after = ping_after
+        self.created = 0
+        self._waiting = 0
+        self._waiter = threading.local()
+        # connections handed out so far, and when the idle ones were returned to the pool
+        self._known = weakref.WeakSet()
+        self._idle_since = weakref.WeakKeyDictionary()
+        super().__init__(database, **kwargs)
+
+    def connect(self, reuse_if_open=False):
+        start = time.perf_counter()
+        try:
+            return super().connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            metrics.incr('db.pool.timeouts')
+            raise
+        finally:
+            if getattr(self._waiter, 'waiting', False):
+                with self._pool_lock:
+                    self._waiter.waiting = False
+                    self._waiting -= 1
+                    self._publish()
+                metrics.observe('db.pool.wait.seconds', time.perf_counter() - start)
+
+    def _connect(self):
+        with self._pool_lock:
+            try:
+                conn = super()._connect()
+            except MaxConnectionsExceeded:
+                # the base class retries until its timeout, count the thread once
+                if not getattr(self._waiter, 'waiting', False):
+                    self._waiter.waiting = True
+                    self._waiting += 1
+                    metrics.incr('db.pool.waits')
+                    self._publish()
+                raise
+            if conn not in self._known:
+                self._known.add(conn)
+                self.created += 1
+                metrics.incr('db.pool.created')
+            self._publish()
+            return conn
+
+    def _is_closed(self, conn):
+        # replaces the base check, which depending on the peewee version never or always pings
+        idle_since = self._idle_since.pop(conn, None)
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_UNKNOWN:
+            if idle_since is None or time.time() - idle_since < self.ping_after or self._ping(conn):
+                return False
+        metrics.incr('db.pool.health_check_failed')
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return True
+
+    def _ping(self, conn) -> bool:
+        try:
+            if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn, close_conn=False):
+        with self._pool_lock:
+            checked_in = not close_conn and self.conn_key(conn) in self._in_use
+            super()._close(conn, close_conn)
+            if checked_in and any(entry[-1] is conn for entry in self._connections):
+                self._idle_since[conn] = time.time()
+            self._publish()
+
+    def _publish(self) -> None:
+        metrics.gauge('db.pool.in_use', len(self._in_use))
+        metrics.gauge('db.pool.idle', len(self._connections))
+        metrics.gauge('db.pool.waiting', self._waiting)
+
+    def stats(self) -> dict:
+        with self._pool_lock:
+            return {'in_use': len(self._in_use), 'idle': len(self._connections), 'waiting': self._waiting,
+                    'created': self.created, 'max_connections': self._max_connections}
+
+
+db = HealthCheckedPool(
     os.getenv("DB_NAME"),
+    max_connections=DB_MAX_CONNECTIONS,
+    stale_timeout=DB_STALE_TIMEOUT,
+    timeout=DB_POOL_TIMEOUT,
     user=os.getenv("DB_USER"),
     password=os.getenv("DB_PASSWORD"),
     host=os.getenv("DB_HOST", "localhost"),
-    port=os.getenv("DB_PORT", 19032)
+    port=os.getenv("DB_PORT", 19032),
+    application_name=os.getenv("DB_APPLICATION_NAME", "emma")
 )
 
 
+def release_connection() -> None:
+    '''Return this thread's connection to the pool, unless a transaction is still open on it.'''
+    if not db.is_closed() and not db.in_transaction():
+        db.close()
+
+
+def in_worker_thread(fn, *args, **kwargs):
+    '''
+    Call fn in a thread pool or asyncio.to_thread worker. peewee keeps a connection per thread and
+    the worker outlives the call, so whatever connection fn opened goes back to the pool afterwards.
+    '''
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        release_connection()
+
+
 class BaseModel(Model):
     class Meta:
         database = db
         table_function = make_table_name
 
 
+# Organizations split out with infra/vector_partition.py get a LIST partition of their own,
+# all others share the DEFAULT partition, which is hash-partitioned VECTOR_HASH_PARTITIONS ways.
+VECTOR_HASH_PARTITIONS = int(os.getenv('VECTOR_HASH_PARTITIONS', 8))
+
+
+class PartitionedModel(BaseModel):
+    '''
+    A table declaratively partitioned by organization. Queries and writes use the parent table
+    and PostgreSQL routes and prunes partitions, so the model is used like any other. The key
+    has to include the partition column; ids still come from the table's own sequence.
+    '''
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        super().create_table(safe, **options)
+        table = cls._meta.table_name
+        partitioned = cls._meta.database.execute_sql(
+            "SELECT 1 FROM pg_class WHERE oid = to_regclass(%s) AND relkind = 'p'", (table,)).fetchone()
+        # a table created before partitioning is left alone, infra/vector_partition.py convert migrates it
+        if partitioned:
+            cls.create_default_partitions(table)
+
+    @classmethod
+    def create_default_partitions(cls, table: str) -> None:
+        cls._meta.database.execute_sql(f'CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} '
+                                       f'DEFAULT PARTITION BY HASH (organization)')
+        for i in range(VECTOR_HASH_PARTITIONS):
+            cls._meta.database.execute_sql(f'CREATE TABLE IF NOT EXISTS {table}_h{i} PARTITION OF {table}_default '
+                                           f'FOR VALUES WITH (MODULUS {VECTOR_HASH_PARTITIONS}, REMAINDER {i})')
+
+    class Meta:
+        primary_key = CompositeKey('id', 'organization')
+        table_settings = ['PARTITION BY LIST (organization)']
+
+
 class Document(Model):
     id = AutoField(primary_key=True)
     doc_id = CharField(max_length=255, unique=True)
@@ -48,8 +223,8 @@ class Document(Model):
         )
 
 
-class Vector1536(BaseModel):
-    id = AutoField(primary_key=True)
+class Vector1536(PartitionedModel):
+    id = IntegerField(sequence='emma_vector1536_id_seq')
     doc_id = CharField(max_length=255, index=True)
     text = TextField()
     embedding = VectorField(dimensions=1536)
@@ -57,8 +232,8 @@ class Vector1536(BaseModel):
     meta = BinaryJSONField()
         
         
-class Vector512(BaseModel):
-    id = AutoField(primary_key=True)
+class Vector512(PartitionedModel):
+    id = IntegerField(sequence='emma_vector512_id_seq')
     doc_id = CharField(max_length=255, index=True)
     text = TextField()
     embedding = VectorField(dimensions=512)
@@ -66,8 +241,8 @@ class Vector512(BaseModel):
     meta = BinaryJSONField()
         
         
-class Vector1024(BaseModel):
-    id = AutoField(primary_key=True)
+class Vector1024(PartitionedModel):
+    id = IntegerField(sequence='emma_vector1024_id_seq')
     doc_id = CharField(max_length=255, index=True)
     text = TextField()
     embedding = VectorField(dimensions=1024)
@@ -75,8 +250,8 @@ class Vector1024(BaseModel):
     meta = BinaryJSONField()
         
 
-class Vector2048(BaseModel):
-    id = AutoField(primary_key=True)
+class Vector2048(PartitionedModel):
+    id = IntegerField(sequence='emma_vector2048_id_seq')
     doc_id = CharField(max_length=255, index=True)
     text = TextField()
     embedding = VectorField(dimensions=2048)
@@ -84,8 +259,8 @@ class Vector2048(BaseModel):
     meta = BinaryJSONField()
         
         
-class Vector768(BaseModel):
-    id = AutoField(primary_key=True)
+class Vector768(PartitionedModel):
+    id = IntegerField(sequence='emma_vector768_id_seq')
     doc_id = CharField(max_length=255, index=True)
     text = TextField()
     embedding = VectorField(dimensions=768)
@@ -93,13 +268,24 @@ class Vector768(BaseModel):
     meta = BinaryJSONField()
         
 
-class Vector1792(BaseModel):
-    id = AutoField(primary_key=True)
+class Vector1792(PartitionedModel):
+    id = IntegerField(sequence='emma_vector1792_id_seq')
     doc_id = CharField(max_length=255, index=True)
     text = TextField()
     embedding = VectorField(dimensions=1792)
+    embedding_short = VectorField(dimensions=MATRYOSHKA_DIM, null=True)
+    # sha256 of text, lets re-ingestion keep unchanged chunks
+    content_hash = CharField(max_length=64, null=True)
     organization = CharField(max_length=255, index=True)
+    # copies of meta['embedding_model'] / meta['sentence_splitter'] that retrieval filters on
+    embedding_model = CharField(max_length=255, null=True)
+    sentence_splitter = CharField(max_length=255, null=True)
     meta = BinaryJSONField()
+
+    class Meta:
+        indexes = (
+            (('organization', 'embedding_model', 'sentence_splitter'), False),
+        )
         
         
 class MemoryModel(Model):
@@ -1,110 +1,95 @@
-from typing import List
-import dashscope
+from typing import List, Iterator
 import httpx
 import dotenv
 import os
-import tempfile
-import orjson
 import numpy as np
-from tool.storage import S3Storage
-from volcengine.maas import MaasException, ChatRole
-from volcengine.maas.v2 import MaasService
-import ollama
-from sentence_transformers import SentenceTransformer
 import proto.embedding_query_pb2 as embedding_query_pb2
 import proto.embedding_query_pb2_grpc as embedding_query_pb2_grpc
 import grpc
-import pyarrow as pa
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Dict
 # import ray
 # from ray import serve
-from fastapi import FastAPI
-from grpc import metadata_call_credentials, composite_channel_credentials, ssl_channel_credentials
+from embedding_ali_batch import AliBatchPipeline
+from embedding_client import get_embedding_client, get_async_embedding_client, encode_embeddings, SERVER_OPTIONS
+from embedding_batch import BatchScheduler
+from embedding_onnx import load_encoder
+from utils import sliced_norm_l2_batch
+from metrics import metrics
+from logger import logger
+import asyncio
+import threading
+import time
 
 dotenv.load_dotenv()
 
-dashscope.api_key = os.getenv('DASHSCOPE_KEY')
 # Define a static token
 GRPC_STATIC_TOKEN = os.getenv('GRPC_STATIC_TOKEN')
+# server side micro-batching
+EMBEDDING_BATCHING = os.getenv('EMBEDDING_BATCHING', '1') == '1'
+EMBEDDING_MAX_BATCH = int(os.getenv('EMBEDDING_MAX_BATCH', 64))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', 5))
+EMBEDDING_SERVER_WORKERS = int(os.getenv('EMBEDDING_SERVER_WORKERS', 64))
+# torch, onnx or onnx-int8, see embedding_onnx.py for exporting the ONNX graphs
+EMBEDDING_ENGINE = os.getenv('EMBEDDING_ENGINE', 'torch')
+EMBEDDING_ONNX_DIR = os.getenv('EMBEDDING_ONNX_DIR')
+EMBEDDING_MODEL_PATH = os.getenv('EMBEDDING_MODEL_PATH', '/home/chenxueliang/embedding/xiaobu-embedding-v2')
+# bump when the embedding server's weights change under the same path
+EMBEDDING_MODEL_VERSION = os.getenv('EMBEDDING_MODEL_VERSION', '1')
 
 
 def sliced_norm_l2(vec: List[float], dim=2048) -> List[float] : 
     # dim to 512,1024,2048
-    norm = float(np.linalg.norm(vec[:dim]))
-    return [v / norm for v in vec[:dim]]
+    return sliced_norm_l2_batch([vec], dim)[0].tolist()
 
 
 class AliEmbedding:
-    def __init__(self, bucket_name=None) -> None:
+    def __init__(self, bucket_name=None, pipeline: AliBatchPipeline = None) -> None:
         self.bucket_name = bucket_name or 'embedding'
-    
-    def call(self, url: str):
-        print(url)
-        result = dashscope.BatchTextEmbedding.call(dashscope.BatchTextEmbedding.Models.text_embedding_async_v2,
-                                                   url=url,
-                                                   text_type="document")
-        return result
-    
-    def minio_tmp_storage(self, inputs: List) -> str:
-        # create tmp file and store inputs
-        with tempfile.NamedTemporaryFile(delete=False, mode='w', suffix='.txt') as tmp:
-            tmp.write('\n'.join(inputs))
-            tmp_name = tmp.name  # Store the temp file name to use after closing
-        minio = S3Storage(bucket_name=self.bucket_name)
-        object_name = os.path.basename(tmp_name)
-        url = minio.upload_and_sign(tmp_name, object_name)
-        # delete tmp file
-        os.unlink(tmp_name)
-        return url
-    
-    def handle_ali_result(self, result):
-        if result.status_code == httpx.codes.OK:
-            if result['output']['task_status'] == 'SUCCEEDED':
-                url = result['output']['url']
-                # httpx download and save file from url to /tmp
-                with httpx.get(url) as response:
-                    response.raise_for_status()
-                    filename = os.path.basename(url)
-                    # Create the full path for the file to be saved in /tmp
-                    filepath = os.path.join('/tmp', filename)
-                    # Open the file in binary write mode and save the content
-                    with open(filepath, 'wb') as file:
-                        file.write(response.content)
-                print(filepath)
-            else:
-                print(result)
-        else:
-            print(result)
-            return []
+        self._pipeline = pipeline
+        # provider SDKs are imported when a backend is created, not when this module is
+        import dashscope
+        dashscope.api_key = os.getenv('DASHSCOPE_KEY')
+        self.dashscope = dashscope
+
+    # single texts never need the batch jobs or their S3 input store, build them on the first batch
+    @property
+    def pipeline(self) -> AliBatchPipeline:
+        if self._pipeline is None:
+            self._pipeline = AliBatchPipeline(bucket_name=self.bucket_name)
+        return self._pipeline
     
     def embedding(self, inputs: List):
         if len(inputs) == 0:
             return []
         if len(inputs) == 1:
-            resp = dashscope.TextEmbedding.call(
-                model=dashscope.TextEmbedding.Models.text_embedding_v2,
+            resp = self.dashscope.TextEmbedding.call(
+                model=self.dashscope.TextEmbedding.Models.text_embedding_v2,
                 input=inputs[0])
             if resp.status_code == httpx.codes.OK:
-                return resp['output']['embeddings'][0]['embedding']
+                # one vector per input, like the batch path
+                return [resp['output']['embeddings'][0]['embedding']]
             else:
                 print(resp)
                 return []
-        result = None  # merge the results.
-        # batch 
-        url = self.minio_tmp_storage(inputs)
-        result = self.call(url)
-        self.handle_ali_result(result)
+        # batch: submit BatchTextEmbedding jobs and wait for the result matrix
+        return self.pipeline.embedding(inputs)
+
+    async def aembeddings(self, model=None, inputs: List = None) -> np.ndarray:
+        if len(inputs) == 1:
+            return np.asarray(await asyncio.to_thread(self.embedding, inputs), dtype=np.float32)
+        return await self.pipeline.aembedding(inputs)
 
 
 class DoubaoEmbedding:
     def __init__(self) -> None:
+        from volcengine.maas.v2 import MaasService
         self.maas = MaasService('maas-api.ml-platform-cn-beijing.volces.com', 'cn-beijing')
         # set ak&sk
         self.maas.set_ak(os.getenv("VOLC_ACCESSKEY"))
         self.maas.set_sk(os.getenv("VOLC_SECRETKEY"))
     
     def req_embeddings(self, maas, endpoint_id, req):
+        from volcengine.maas import MaasException
         try:
             resp = maas.embeddings(endpoint_id, req)
             return resp
@@ -122,21 +107,43 @@ class DoubaoEmbedding:
         return embeddings
     
     
-class OllamaEmbedding:
-    def __init__(self, model: str = 'mxbai-embed-large') -> None:
-        self.model = model
-    
-    def embedding(self, inputs: List) -> List:
-        return [ollama.embeddings(model=self.model, prompt=prompt)['embedding'] for prompt in inputs]
-    
-
 class LocalEmbedding(embedding_query_pb2_grpc.EmbeddingServiceServicer):
-    def __init__(self, model_path: str = None) -> None:
-        self.model_path = model_path or '/home/chenxueliang/embedding/xiaobu-embedding-v2'
-        self.model = SentenceTransformer(self.model_path, local_files_only=True)
+    # the model the embedding server runs, API workers read the same settings; part of the
+    # embedding cache keys so vectors of a previous model or engine are not served
+    cache_version = f"{os.path.basename(EMBEDDING_MODEL_PATH.rstrip('/'))}-{EMBEDDING_ENGINE}-v{EMBEDDING_MODEL_VERSION}"
+
+    def __init__(self, model_path: str = None, model=None, batching: bool = None, engine: str = None) -> None:
+        self.model_path = model_path or EMBEDDING_MODEL_PATH
+        self.engine = engine or EMBEDDING_ENGINE
+        # only the embedding server loads a model, API workers use the gRPC classmethods
+        self.model = model or load_encoder(self.model_path, self.engine, EMBEDDING_ONNX_DIR)
+        self.batching = EMBEDDING_BATCHING if batching is None else batching
+        self._scheduler = None
+        self._scheduler_lock = threading.Lock()
+    
+    @property
+    def scheduler(self) -> BatchScheduler:
+        # only the serving process needs the batcher thread
+        if self._scheduler is None:
+            with self._scheduler_lock:
+                if self._scheduler is None:
+                    self._scheduler = BatchScheduler(self._encode, max_batch_size=EMBEDDING_MAX_BATCH, max_wait_ms=EMBEDDING_BATCH_WINDOW_MS)
+        return self._scheduler
+    
+    def _encode(self, inputs: List) -> np.ndarray:
+        return self.model.encode(inputs, normalize_embeddings=True)
+    
+    def _embedding_matrix(self, inputs: List, dimensions: int = 0) -> np.ndarray:
+        if self.batching:
+            embeddings = self.scheduler.encode(inputs)
+        else:
+            embeddings = self._encode(inputs)
+        if dimensions and len(embeddings):
+            embeddings = sliced_norm_l2_batch(embeddings, dimensions)
+        return embeddings
     
     def _embedding(self, inputs: List) -> List:
-        return list(self.model.encode(inputs, normalize_embeddings=True))
+        return list(self._embedding_matrix(inputs))
     
     def GetEmbeddings(self, request, context):
         # Token check
@@ -145,43 +152,32 @@ class LocalEmbedding(embedding_query_pb2_grpc.EmbeddingServiceServicer):
             context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Invalid token')
         
         inputs = request.queries
-        embeddings = self._embedding(inputs)
-        buffer = pa.BufferOutputStream()
-        pa_array = pa.array(embeddings)
-        batch = pa.RecordBatch.from_arrays([pa_array], ['embeddings'])
-        with pa.ipc.new_stream(buffer, batch.schema) as writer:
-            writer.write_batch(batch)
-        return embedding_query_pb2.EmbeddingResponse(serialized_embeddings=buffer.getvalue().to_pybytes())
+        embeddings = self._embedding_matrix(inputs, request.dimensions)
+        return embedding_query_pb2.EmbeddingResponse(serialized_embeddings=encode_embeddings(embeddings))
     
-    @classmethod
-    def embeddings(cls, model='xiaobu-embedding-v2', inputs: List = None) -> np.array:
-        ssl_dir = os.getenv('SSL_DIR')
-        channel_options = [('grpc.ssl_target_name_override', '115.223.19.227')]
-        if isinstance(inputs, str):
-            inputs = [inputs]
-        
-        def metadata_callback(context, callback):
-            callback([('authorization', GRPC_STATIC_TOKEN)], None)
-        
-        auth_credentials = metadata_call_credentials(metadata_callback)
-        ssl_credentials = ssl_channel_credentials(
-            root_certificates=open(f'{ ssl_dir }/ca/ca.crt', 'rb').read(),
-            private_key=open(f'{ ssl_dir }/client/client.key', 'rb').read(),
-            certificate_chain=open(f'{ ssl_dir }/client/client.crt', 'rb').read()
-        )
-        channel_credentials = composite_channel_credentials(ssl_credentials, auth_credentials)
+    def StreamEmbeddings(self, request_iterator, context):
+        token = dict(context.invocation_metadata()).get('authorization')
+        if token != GRPC_STATIC_TOKEN:
+            context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Invalid token')
         
-        with grpc.secure_channel(os.getenv('EMBEDDING_SERVER'), channel_credentials, options=channel_options) as channel:
-            stub = embedding_query_pb2_grpc.EmbeddingServiceStub(channel)
-            response = stub.GetEmbeddings(embedding_query_pb2.EmbeddingQuery(queries=inputs))
-            buffer = pa.BufferReader(response.serialized_embeddings)
-            with pa.ipc.open_stream(buffer) as reader:
-                batch = reader.read_next_batch()
-                embeddings = batch.column(0).to_pylist()
-            return embeddings
+        for request in request_iterator:
+            embeddings = self._embedding_matrix(request.queries, request.dimensions)
+            yield embedding_query_pb2.EmbeddingResponse(serialized_embeddings=encode_embeddings(embeddings))
+    
+    @classmethod
+    def embeddings(cls, model='xiaobu-embedding-v2', inputs: List = None, dimensions: int = None) -> np.array:
+        return get_embedding_client().embeddings(inputs, dimensions=dimensions)
+
+    @classmethod
+    def stream_embeddings(cls, batches) -> Iterator[np.ndarray]:
+        return get_embedding_client().stream_embeddings(batches)
+
+    @classmethod
+    async def aembeddings(cls, model='xiaobu-embedding-v2', inputs: List = None, dimensions: int = None) -> np.array:
+        return await get_async_embedding_client().embeddings(inputs, dimensions=dimensions)
 
     def __str__(self) -> str:
-        return f"Running {self.model_path}...."
+        return f"Running {self.model_path} ({self.engine})...."
     
     
 # @serve.deployment(num_replicas=4, ray_actor_options={"num_cpus": 1, "num_gpus": 0})
@@ -215,11 +211,19 @@ class LocalEmbedding(embedding_query_pb2_grpc.EmbeddingServiceServicer):
 #         return f"Running {self.model_path}...."
 
 
+def log_metrics(interval: int = 60):
+    while True:
+        time.sleep(interval)
+        logger.info(f'Embedding server metrics: {metrics.snapshot()}')
+
+
 if __name__ == '__main__':
-    server = grpc.server(ThreadPoolExecutor(max_workers=10))
+    # RPC threads wait on the batcher, so the pool must be larger than the expected concurrency
+    server = grpc.server(ThreadPoolExecutor(max_workers=EMBEDDING_SERVER_WORKERS), options=SERVER_OPTIONS)
     embedding_query_pb2_grpc.add_EmbeddingServiceServicer_to_server(LocalEmbedding(), server)
     server.add_insecure_port('0.0.0.0:50051')
     server.start()
+    threading.Thread(target=log_metrics, daemon=True).start()
     print("Embedding server running on 0.0.0.0:50051")
     server.wait_for_termination()
     
@@ -0,0 +1,246 @@
+'''
+Asynchronous batch embedding through DashScope BatchTextEmbedding.
+Inputs are split into jobs, each job is uploaded to object storage, submitted, polled with
+backoff and its result file is stream-downloaded and parsed into a matrix aligned with the
+inputs. Job state lives in small JSON files so a restarted process resumes polling instead
+of submitting the same texts again.
+'''
+import asyncio
+import gzip
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from urllib.parse import urlparse
+
+import dotenv
+import httpx
+import numpy as np
+import orjson
+
+from logger import logger
+from metrics import metrics
+
+dotenv.load_dotenv()
+
+ALI_BATCH_JOB_SIZE = int(os.getenv('ALI_BATCH_JOB_SIZE', 10000))
+ALI_BATCH_MAX_JOBS = int(os.getenv('ALI_BATCH_MAX_JOBS', 4))
+ALI_BATCH_STATE_DIR = os.getenv('ALI_BATCH_STATE_DIR', os.path.expanduser('~/.cache/emma/ali_batch'))
+ALI_BATCH_TIMEOUT = float(os.getenv('ALI_BATCH_TIMEOUT', 3600))
+
+SUCCEEDED = 'SUCCEEDED'
+FAILED_STATUS = ('FAILED', 'CANCELED', 'UNKNOWN')
+
+
+class DashscopeBatchService:
+    '''Submits and polls BatchTextEmbedding tasks. Any object with submit/fetch can replace it.'''
+    def __init__(self, model: str = None, text_type: str = 'document') -> None:
+        import dashscope
+        dashscope.api_key = os.getenv('DASHSCOPE_KEY')
+        self.dashscope = dashscope
+        self.model = model or dashscope.BatchTextEmbedding.Models.text_embedding_async_v2
+        self.text_type = text_type
+
+    def submit(self, url: str) -> str:
+        resp = self.dashscope.BatchTextEmbedding.async_call(model=self.model, url=url, text_type=self.text_type)
+        if resp.status_code != httpx.codes.OK:
+            raise RuntimeError(f'BatchTextEmbedding submit failed: {resp.code} {resp.message}')
+        return resp.output['task_id']
+
+    def fetch(self, task_id: str) -> Tuple[str, Optional[str]]:
+        resp = self.dashscope.BatchTextEmbedding.fetch(task_id)
+        if resp.status_code != httpx.codes.OK:
+            # treat as still running, the next poll retries
+            logger.error(f'BatchTextEmbedding fetch {task_id} failed: {resp.code} {resp.message}')
+            return 'RUNNING', None
+        return resp.output['task_status'], resp.output.get('url')
+
+
+class S3InputStore:
+    '''Uploads the job input file to MinIO/S3 and returns a presigned url.'''
+    def __init__(self, bucket_name: str = 'embedding') -> None:
+        from tool.storage import S3Storage
+        self.storage = S3Storage(bucket_name=bucket_name)
+
+    def upload(self, file_path: str, object_name: str) -> str:
+        url = self.storage.upload_and_sign(file_path, object_name)
+        if not url:
+            raise RuntimeError(f'Failed to upload {object_name}')
+        return url
+
+
+def job_id(model: str, texts: List[str]) -> str:
+    digest = hashlib.sha256(model.encode('utf-8'))
+    for text in texts:
+        digest.update(b'\x00')
+        digest.update(text.encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+
+def parse_result(path: str, count: int) -> np.ndarray:
+    '''
+    Parse a BatchTextEmbedding result file (JSON lines, optionally gzipped) into a
+    (count, dim) float32 matrix ordered by text_index.
+    '''
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    matrix = None
+    seen = np.zeros(count, dtype=bool)
+    with (gzip.open(path, 'rb') if gzipped else open(path, 'rb')) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            output = orjson.loads(line).get('output', {})
+            items = output['embeddings'] if 'embeddings' in output else [output]
+            for item in items:
+                if 'embedding' not in item:
+                    raise RuntimeError(f'Embedding failed for text {item.get("text_index")}: {item.get("message")}')
+                if matrix is None:
+                    matrix = np.empty((count, len(item['embedding'])), dtype=np.float32)
+                index = int(item['text_index'])
+                matrix[index] = item['embedding']
+                seen[index] = True
+    if matrix is None or not seen.all():
+        raise RuntimeError(f'Result {path} has {int(seen.sum())} of {count} embeddings')
+    return matrix
+
+
+class AliBatchPipeline:
+    def __init__(self, service=None, store=None, model: str = 'text-embedding-async-v2',
+                 state_dir: str = ALI_BATCH_STATE_DIR, job_size: int = None, max_jobs: int = None,
+                 poll_interval: float = 2, max_poll_interval: float = 60, timeout: float = ALI_BATCH_TIMEOUT,
+                 bucket_name: str = 'embedding') -> None:
+        self._service = service
+        self._store = store
+        self.bucket_name = bucket_name
+        self.model = model
+        self.state_dir = state_dir
+        self.job_size = job_size or ALI_BATCH_JOB_SIZE
+        self.max_jobs = max_jobs or ALI_BATCH_MAX_JOBS
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        os.makedirs(state_dir, exist_ok=True)
+
+    # the defaults need dashscope and boto3, only build them when a job is really submitted
+    @property
+    def service(self):
+        if self._service is None:
+            self._service = DashscopeBatchService()
+        return self._service
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = S3InputStore(self.bucket_name)
+        return self._store
+
+    def _path(self, job: str, suffix: str) -> str:
+        return os.path.join(self.state_dir, f'{job}.{suffix}')
+
+    def load_state(self, job: str) -> dict:
+        try:
+            with open(self._path(job, 'json'), 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def save_state(self, job: str, state: dict) -> None:
+        # write then rename so a crash never leaves a truncated state file
+        tmp = self._path(job, 'json.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(orjson.dumps(state))
+        os.replace(tmp, self._path(job, 'json'))
+
+    def submit(self, job: str, texts: List[str]) -> dict:
+        with tempfile.NamedTemporaryFile(delete=False, mode='w', suffix='.txt', encoding='utf-8') as tmp:
+            # one text per line, so embedded newlines would shift every following index
+            tmp.write('\n'.join(text.replace('\r', ' ').replace('\n', ' ') for text in texts))
+            tmp_name = tmp.name
+        try:
+            url = self.store.upload(tmp_name, f'{job}.txt')
+        finally:
+            os.unlink(tmp_name)
+        state = {'job': job, 'count': len(texts), 'task_id': self.service.submit(url),
+                 'status': 'PENDING', 'submitted_at': time.time()}
+        self.save_state(job, state)
+        metrics.incr('embedding.ali_batch.submitted')
+        logger.info(f'Ali batch job {job}: submitted {len(texts)} texts as task {state["task_id"]}')
+        return state
+
+    def download(self, url: str, path: str) -> None:
+        tmp = f'{path}.part'
+        parsed = urlparse(url)
+        if parsed.scheme == 'file':
+            with open(parsed.path, 'rb') as src, open(tmp, 'wb') as dst:
+                while chunk := src.read(1 << 20):
+                    dst.write(chunk)
+        else:
+            with httpx.stream('GET', url, timeout=120, follow_redirects=True) as response:
+                response.raise_for_status()
+                with open(tmp, 'wb') as dst:
+                    for chunk in response.iter_bytes(1 << 20):
+                        dst.write(chunk)
+        os.replace(tmp, path)
+
+    async def run_job(self, texts: List[str]) -> np.ndarray:
+        job = job_id(self.model, texts)
+        matrix_path = self._path(job, 'npy')
+        if os.path.exists(matrix_path):
+            return np.load(matrix_path)
+        state = self.load_state(job)
+        if state.get('task_id'):
+            logger.info(f'Ali batch job {job}: resuming task {state["task_id"]}')
+        else:
+            state = await asyncio.to_thread(self.submit, job, texts)
+        start = time.perf_counter()
+        delay = self.poll_interval
+        while True:
+            status, url = await asyncio.to_thread(self.service.fetch, state['task_id'])
+            if status != state['status']:
+                state['status'] = status
+                self.save_state(job, state)
+            if status == SUCCEEDED:
+                break
+            if status in FAILED_STATUS:
+                # forget the task so the next run submits the job again
+                state.pop('task_id')
+                self.save_state(job, state)
+                metrics.incr('embedding.ali_batch.failed')
+                raise RuntimeError(f'Ali batch job {job} ended with {status}')
+            if time.perf_counter() - start > self.timeout:
+                raise TimeoutError(f'Ali batch job {job} still {status} after {self.timeout}s')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+        result_path = self._path(job, 'result')
+        await asyncio.to_thread(self.download, url, result_path)
+        matrix = await asyncio.to_thread(parse_result, result_path, state['count'])
+        np.save(matrix_path, matrix)
+        os.unlink(result_path)
+        state['status'] = 'DONE'
+        self.save_state(job, state)
+        metrics.observe('embedding.ali_batch.job_latency', time.time() - state['submitted_at'])
+        return matrix
+
+    async def aembedding(self, inputs: List[str]) -> np.ndarray:
+        if not inputs:
+            return np.empty((0, 0), dtype=np.float32)
+        semaphore = asyncio.Semaphore(self.max_jobs)
+
+        async def bounded(chunk):
+            async with semaphore:
+                return await self.run_job(chunk)
+
+        chunks = [inputs[i:i + self.job_size] for i in range(0, len(inputs), self.job_size)]
+        return np.concatenate(await asyncio.gather(*[bounded(chunk) for chunk in chunks]))
+
+    def embedding(self, inputs: List[str]) -> np.ndarray:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.aembedding(inputs))
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(asyncio.run, self.aembedding(inputs)).result()
@@ -0,0 +1,121 @@
+'''
+Dynamic micro-batching for the embedding server.
+Concurrent RPCs are queued and merged into one encode call, then split back per caller.
+'''
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List
+
+import numpy as np
+
+from metrics import metrics
+
+
+class _Request:
+    __slots__ = ('inputs', 'future', 'enqueued_at')
+
+    def __init__(self, inputs: List[str]) -> None:
+        self.inputs = inputs
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class BatchScheduler:
+    '''
+    Collects requests for at most `max_wait_ms` after the first one arrives, or until
+    `max_batch_size` inputs are queued, and runs them through `encode_fn` together.
+    A single request larger than `max_batch_size` is encoded on its own.
+    '''
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], max_batch_size: int = 64,
+                 max_wait_ms: float = 5, name: str = 'embedding.server') -> None:
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._queue = queue.Queue()
+        self._pending = None
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._run, name=f'{name}.batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, inputs: List[str]) -> Future:
+        if self._closed.is_set():
+            raise RuntimeError('BatchScheduler is closed')
+        request = _Request(list(inputs))
+        if not request.inputs:
+            request.future.set_result(np.empty((0, 0), dtype=np.float32))
+            return request.future
+        self._queue.put(request)
+        metrics.gauge(f'{self.name}.queue_depth', self._queue.qsize())
+        return request.future
+
+    def encode(self, inputs: List[str], timeout: float = None) -> np.ndarray:
+        return self.submit(inputs).result(timeout=timeout)
+
+    def _next(self, timeout: float = None) -> _Request:
+        if self._pending is not None:
+            request, self._pending = self._pending, None
+            return request
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self) -> List[_Request]:
+        first = self._next()
+        if first is None:
+            return []
+        batch = [first]
+        size = len(first.inputs)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._next(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # closing, let the next _collect see the sentinel again
+                self._queue.put(None)
+                break
+            if size + len(request.inputs) > self.max_batch_size:
+                # keep it for the next batch instead of overshooting this one
+                self._pending = request
+                break
+            batch.append(request)
+            size += len(request.inputs)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            if not batch:
+                return
+            metrics.gauge(f'{self.name}.queue_depth', self._queue.qsize())
+            inputs = [text for request in batch for text in request.inputs]
+            start = time.perf_counter()
+            try:
+                embeddings = np.asarray(self.encode_fn(inputs))
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                metrics.incr(f'{self.name}.errors')
+                continue
+            now = time.perf_counter()
+            metrics.incr(f'{self.name}.batches')
+            metrics.observe(f'{self.name}.batch_size', len(inputs))
+            metrics.observe(f'{self.name}.batch_requests', len(batch))
+            metrics.observe(f'{self.name}.encode_latency', now - start)
+            offset = 0
+            for request in batch:
+                n = len(request.inputs)
+                metrics.observe(f'{self.name}.queue_wait', start - request.enqueued_at)
+                request.future.set_result(embeddings[offset:offset + n])
+                offset += n
+
+    def close(self) -> None:
+        if not self._closed.is_set():
+            self._closed.set()
+            self._queue.put(None)
+            self._worker.join()
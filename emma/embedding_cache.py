@@ -0,0 +1,301 @@
+'''
+Content-addressed cache in front of the embedding backends.
+Vectors are keyed by (model, version, dimensions, sha256(text)) and kept in a bounded in-process
+LRU backed by a memory-mapped float32 store on disk.
+'''
+import asyncio
+import fcntl
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import dotenv
+import numpy as np
+
+from metrics import metrics
+from utils import sliced_norm_l2_batch
+
+dotenv.load_dotenv()
+
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 20000))
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', os.path.expanduser('~/.cache/emma/embeddings'))
+EMBEDDING_CACHE_DISK_CAPACITY = int(os.getenv('EMBEDDING_CACHE_DISK_CAPACITY', 200000))
+
+DIGEST_SIZE = 32
+EMPTY_KEY = bytes(DIGEST_SIZE)
+
+
+def cache_key(model: str, text: str, dimensions: Optional[int] = None) -> bytes:
+    return hashlib.sha256(f'{model}\x00{dimensions or 0}\x00{text}'.encode('utf-8')).digest()
+
+
+def model_name(backend) -> str:
+    if isinstance(backend, type):
+        return backend.__name__
+    return getattr(backend, 'name', None) or backend.__class__.__name__
+
+
+class DiskVectorStore:
+    '''
+    Fixed-capacity ring of float32 vectors in `vectors.f32` with their digests in `keys.bin`.
+    When full the oldest slot is overwritten (FIFO). Writes are serialised across processes
+    with flock, and every read checks the digest stored in the slot before and after copying
+    the vector, so a vector that is or was being overwritten by another process is a miss.
+    '''
+    def __init__(self, path: str, dim: int, capacity: int = EMBEDDING_CACHE_DISK_CAPACITY) -> None:
+        self.path = path
+        self.dim = dim
+        self.capacity = capacity
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, 'lock'), 'a+')
+        with self._file_lock():
+            self.vectors = self._open(os.path.join(path, 'vectors.f32'), np.float32, (capacity, dim))
+            self.keys = self._open(os.path.join(path, 'keys.bin'), np.uint8, (capacity, DIGEST_SIZE))
+            self.head = self._open(os.path.join(path, 'head.i64'), np.int64, (1,))
+        self.index: Dict[bytes, int] = {}
+        for slot in np.flatnonzero(self.keys.any(axis=1)):
+            self.index[self.keys[slot].tobytes()] = int(slot)
+
+    @staticmethod
+    def _open(filename: str, dtype, shape) -> np.memmap:
+        mode = 'r+' if os.path.exists(filename) else 'w+'
+        return np.memmap(filename, dtype=dtype, mode=mode, shape=shape)
+
+    @contextmanager
+    def _file_lock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        slot = self.index.get(key)
+        if slot is None:
+            return None
+        if self.keys[slot].tobytes() != key:
+            del self.index[key]
+            return None
+        vector = np.array(self.vectors[slot])
+        if self.keys[slot].tobytes() != key:
+            self.index.pop(key, None)
+            return None
+        return vector
+
+    def put(self, key: bytes, vector: np.ndarray) -> None:
+        with self._file_lock():
+            slot = int(self.head[0]) % self.capacity
+            old_key = self.keys[slot].tobytes()
+            if old_key != EMPTY_KEY:
+                self.index.pop(old_key, None)
+                metrics.incr('embedding.cache.disk_evictions')
+            # clear the key first so a concurrent reader never pairs it with a half written vector
+            self.keys[slot] = 0
+            self.vectors[slot] = vector
+            self.keys[slot] = np.frombuffer(key, dtype=np.uint8)
+            self.head[0] = slot + 1
+            self.index[key] = slot
+
+    def flush(self) -> None:
+        self.vectors.flush()
+        self.keys.flush()
+        self.head.flush()
+
+
+class EmbeddingCache:
+    '''
+    Two tier cache: an LRU of `size` vectors in memory, then one DiskVectorStore per
+    (model, dimensions). Set cache_dir to '' to keep everything in memory.
+    '''
+    def __init__(self, size: int = EMBEDDING_CACHE_SIZE, cache_dir: str = EMBEDDING_CACHE_DIR,
+                 disk_capacity: int = EMBEDDING_CACHE_DISK_CAPACITY) -> None:
+        self.size = size
+        self.cache_dir = cache_dir
+        self.disk_capacity = disk_capacity
+        self._lru = OrderedDict()
+        self._stores: Dict[tuple, DiskVectorStore] = {}
+        self._lock = threading.Lock()
+
+    def _store(self, model: str, dimensions: Optional[int], dim: int = None) -> Optional[DiskVectorStore]:
+        if not self.cache_dir:
+            return None
+        store = self._stores.get((model, dimensions))
+        if store is None:
+            name = f"{re.sub(r'[^A-Za-z0-9_.-]', '_', model)}-{dimensions or 'full'}"
+            path = os.path.join(self.cache_dir, name)
+            if dim is None:
+                # open an existing store without knowing dim yet
+                try:
+                    with open(os.path.join(path, 'dim')) as f:
+                        dim = int(f.read())
+                except (FileNotFoundError, ValueError):
+                    return None
+            store = DiskVectorStore(path, dim, self.disk_capacity)
+            with open(os.path.join(path, 'dim'), 'w') as f:
+                f.write(str(dim))
+            self._stores[(model, dimensions)] = store
+        return store
+
+    def get(self, model: str, text: str, dimensions: Optional[int] = None) -> Optional[np.ndarray]:
+        key = cache_key(model, text, dimensions)
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                metrics.incr('embedding.cache.memory_hits')
+                return vector
+            store = self._store(model, dimensions)
+            vector = store.get(key) if store else None
+            if vector is not None:
+                self._remember(key, vector)
+                metrics.incr('embedding.cache.disk_hits')
+                return vector
+        metrics.incr('embedding.cache.misses')
+        return None
+
+    def put(self, model: str, text: str, vector, dimensions: Optional[int] = None) -> np.ndarray:
+        key = cache_key(model, text, dimensions)
+        # a row of a backend response may be a view into the whole response buffer
+        vector = np.array(vector, dtype=np.float32, copy=True)
+        with self._lock:
+            self._remember(key, vector)
+            store = self._store(model, dimensions, vector.shape[-1])
+            if store is not None and store.dim == vector.shape[-1]:
+                store.put(key, vector)
+        return vector
+
+    def _remember(self, key: bytes, vector: np.ndarray) -> None:
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+            metrics.incr('embedding.cache.memory_evictions')
+
+    def flush(self) -> None:
+        with self._lock:
+            for store in self._stores.values():
+                store.flush()
+
+    def stats(self) -> dict:
+        memory_hits = metrics.counter('embedding.cache.memory_hits')
+        disk_hits = metrics.counter('embedding.cache.disk_hits')
+        misses = metrics.counter('embedding.cache.misses')
+        total = memory_hits + disk_hits + misses
+        return {'memory_hits': memory_hits,
+                'disk_hits': disk_hits,
+                'misses': misses,
+                'hit_rate': (memory_hits + disk_hits) / total if total else 0.0,
+                'memory_entries': len(self._lru)}
+
+
+class CachedEmbedding:
+    '''
+    Wraps any embedding backend (class or instance) exposing `embedding(inputs)` or
+    `embeddings(inputs=...)`. Only texts missing from the cache are sent to the backend,
+    duplicates within one call are embedded once.
+    '''
+    def __init__(self, backend, cache: EmbeddingCache = None, dimensions: Optional[int] = None, name: str = None) -> None:
+        self.backend = backend
+        self.cache = cache or get_embedding_cache()
+        self.dimensions = dimensions
+        self.name = name or model_name(backend)
+        # backends serving several models (e.g. Ollama) must not share cache entries, nor may
+        # a backend whose model changed behind the same name (cache_version)
+        identity = [getattr(backend, 'model', None), getattr(backend, 'cache_version', None)]
+        self.cache_name = '/'.join([self.name] + [part for part in identity if isinstance(part, str)])
+
+    def __getattr__(self, attr):
+        if attr == 'backend':
+            raise AttributeError(attr)
+        return getattr(self.backend, attr)
+
+    def _backend_embeddings(self, inputs: List[str]) -> List:
+        if hasattr(self.backend, 'embeddings'):
+            return self.backend.embeddings(inputs=inputs)
+        return self.backend.embedding(inputs)
+
+    async def _backend_aembeddings(self, inputs: List[str]) -> List:
+        if hasattr(self.backend, 'aembeddings'):
+            return await self.backend.aembeddings(inputs=inputs)
+        # backends without an async client run in a worker thread instead of blocking the loop
+        return await asyncio.to_thread(self._backend_embeddings, inputs)
+
+    def _lookup(self, inputs: List[str]) -> Tuple[List, List[str]]:
+        results = [self.cache.get(self.cache_name, text, self.dimensions) for text in inputs]
+        missing = list(dict.fromkeys(text for text, vector in zip(inputs, results) if vector is None))
+        return results, missing
+
+    def _merge(self, inputs: List[str], results: List, missing: List[str], vectors: List) -> List[np.ndarray]:
+        if vectors is None or len(vectors) != len(missing):
+            raise ValueError(f'{self.name} returned {0 if vectors is None else len(vectors)} vectors for {len(missing)} inputs')
+        if self.dimensions:
+            vectors = sliced_norm_l2_batch(vectors, self.dimensions)
+        computed = {text: self.cache.put(self.cache_name, text, vector, self.dimensions) for text, vector in zip(missing, vectors)}
+        return [computed[text] if vector is None else vector for text, vector in zip(inputs, results)]
+
+    def embeddings(self, model=None, inputs: List[str] = None) -> List[np.ndarray]:
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        results, missing = self._lookup(inputs)
+        if not missing:
+            return results
+        return self._merge(inputs, results, missing, self._backend_embeddings(missing))
+
+    async def aembeddings(self, model=None, inputs: List[str] = None) -> List[np.ndarray]:
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        results, missing = self._lookup(inputs)
+        if not missing:
+            return results
+        return self._merge(inputs, results, missing, await self._backend_aembeddings(missing))
+
+    def embedding(self, inputs: List[str]) -> List[np.ndarray]:
+        return self.embeddings(inputs=inputs)
+
+    def stream_embeddings(self, batches: Iterable[List[str]]) -> Iterator[List[np.ndarray]]:
+        '''
+        Yield the vectors of each batch in order. Only the uncached texts are streamed to
+        backends with `stream_embeddings`, other backends get one embeddings call per batch.
+        '''
+        if not hasattr(self.backend, 'stream_embeddings'):
+            for batch in batches:
+                yield self.embeddings(inputs=list(batch))
+            return
+        # filled by the request thread of the stream, drained here in the same order
+        pending = deque()
+
+        def missing_batches():
+            for batch in batches:
+                batch = list(batch)
+                results, missing = self._lookup(batch)
+                pending.append((batch, results, missing))
+                if missing:
+                    yield missing
+
+        for vectors in self.backend.stream_embeddings(missing_batches()):
+            while True:
+                batch, results, missing = pending.popleft()
+                if not missing:
+                    yield results
+                    continue
+                yield self._merge(batch, results, missing, vectors)
+                break
+        while pending:
+            yield pending.popleft()[1]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
@@ -0,0 +1,343 @@
+'''
+Process-wide gRPC clients (sync and grpc.aio) for the local embedding server.
+Credentials are read once and a small pool of long-lived channels is reused by every call.
+'''
+import asyncio
+import functools
+import itertools
+import os
+import threading
+import time
+import weakref
+from typing import Iterable, Iterator, List
+
+import dotenv
+import grpc
+import numpy as np
+import pyarrow as pa
+
+import proto.embedding_query_pb2 as embedding_query_pb2
+import proto.embedding_query_pb2_grpc as embedding_query_pb2_grpc
+from logger import logger
+from metrics import metrics
+
+dotenv.load_dotenv()
+
+GRPC_STATIC_TOKEN = os.getenv('GRPC_STATIC_TOKEN')
+EMBEDDING_TARGET_NAME = os.getenv('EMBEDDING_TARGET_NAME', '115.223.19.227')
+EMBEDDING_CHANNEL_POOL = int(os.getenv('EMBEDDING_CHANNEL_POOL', 4))
+EMBEDDING_TIMEOUT = float(os.getenv('EMBEDDING_TIMEOUT', 30))
+EMBEDDING_STREAM_BATCH = int(os.getenv('EMBEDDING_STREAM_BATCH', 64))
+EMBEDDING_STREAM_IN_FLIGHT = int(os.getenv('EMBEDDING_STREAM_IN_FLIGHT', 4))
+# plain-text channel with the token sent as call metadata, for local development only
+EMBEDDING_INSECURE = os.getenv('EMBEDDING_INSECURE', '0') == '1'
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.initial_reconnect_backoff_ms', 500),
+    ('grpc.max_reconnect_backoff_ms', 10000),
+    ('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),
+    ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH),
+    # give every pooled channel its own subchannel, otherwise grpc shares one connection
+    ('grpc.use_local_subchannel_pool', 1),
+]
+
+# the server must accept the client keepalive pings, otherwise it answers with GOAWAY
+SERVER_OPTIONS = [
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.min_ping_interval_without_data_ms', 10000),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),
+    ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH),
+]
+
+RETRYABLE_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+
+
+@functools.lru_cache(maxsize=None)
+def load_channel_credentials(ssl_dir: str = None, token: str = None) -> grpc.ChannelCredentials:
+    ssl_dir = ssl_dir or os.getenv('SSL_DIR')
+    token = token or GRPC_STATIC_TOKEN
+
+    def metadata_callback(context, callback):
+        callback([('authorization', token)], None)
+
+    with open(f'{ ssl_dir }/ca/ca.crt', 'rb') as f:
+        root_certificates = f.read()
+    with open(f'{ ssl_dir }/client/client.key', 'rb') as f:
+        private_key = f.read()
+    with open(f'{ ssl_dir }/client/client.crt', 'rb') as f:
+        certificate_chain = f.read()
+    ssl_credentials = grpc.ssl_channel_credentials(root_certificates=root_certificates,
+                                                   private_key=private_key,
+                                                   certificate_chain=certificate_chain)
+    auth_credentials = grpc.metadata_call_credentials(metadata_callback)
+    return grpc.composite_channel_credentials(ssl_credentials, auth_credentials)
+
+
+def encode_embeddings(embeddings) -> bytes:
+    '''
+    Serialise an (n, dim) matrix as one Arrow fixed_size_list<float32> column.
+    The values buffer is the contiguous float32 matrix itself, there are no per-row offsets.
+    '''
+    matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+    # arrow rejects list_size 0, an empty request still needs a valid schema
+    dim = matrix.shape[1] or 1
+    pa_array = pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), dim)
+    batch = pa.RecordBatch.from_arrays([pa_array], ['embeddings'])
+    buffer = pa.BufferOutputStream()
+    with pa.ipc.new_stream(buffer, batch.schema) as writer:
+        writer.write_batch(batch)
+    return buffer.getvalue().to_pybytes()
+
+
+def decode_embeddings(serialized: bytes) -> np.ndarray:
+    '''
+    Return the embeddings as an (n, dim) float32 array. For the fixed_size_list<float32>
+    format this is a read-only view over the received bytes, nothing is copied. Responses
+    from older servers (variable size lists) are converted.
+    '''
+    buffer = pa.BufferReader(serialized)
+    with pa.ipc.open_stream(buffer) as reader:
+        batch = reader.read_next_batch()
+    column = batch.column(0)
+    if pa.types.is_fixed_size_list(column.type) and pa.types.is_float32(column.type.value_type):
+        dim = column.type.list_size
+        return column.flatten().to_numpy(zero_copy_only=True).reshape(-1, dim)
+    return np.asarray(column.to_pylist(), dtype=np.float32)
+
+
+class _ChannelPool:
+    def __init__(self, target: str = None, credentials: grpc.ChannelCredentials = None,
+                 pool_size: int = None, target_name_override: str = None, timeout: float = None,
+                 insecure: bool = None, token: str = None) -> None:
+        self.target = target or os.getenv('EMBEDDING_SERVER')
+        self.pool_size = pool_size or EMBEDDING_CHANNEL_POOL
+        self.timeout = timeout or EMBEDDING_TIMEOUT
+        self.insecure = EMBEDDING_INSECURE if insecure is None else insecure
+        self.options = list(CHANNEL_OPTIONS)
+        target_name_override = target_name_override or EMBEDDING_TARGET_NAME
+        if target_name_override and not self.insecure:
+            self.options.append(('grpc.ssl_target_name_override', target_name_override))
+        # secure channels carry the token in their call credentials
+        self.metadata = (('authorization', token or GRPC_STATIC_TOKEN or ''),) if self.insecure else None
+        self._credentials = credentials
+        self._channels = [None] * self.pool_size
+        self._stubs = [None] * self.pool_size
+        self._counter = itertools.count()
+
+    @property
+    def credentials(self) -> grpc.ChannelCredentials:
+        if self._credentials is None:
+            self._credentials = load_channel_credentials()
+        return self._credentials
+
+    def _slot(self) -> int:
+        return next(self._counter) % self.pool_size
+
+    def _record(self, inputs: List[str], start: float, name: str = 'embedding.client') -> None:
+        latency = time.perf_counter() - start
+        metrics.incr(f'{name}.calls')
+        metrics.incr(f'{name}.inputs', len(inputs))
+        metrics.observe(f'{name}.latency', latency)
+        logger.info(f'GetEmbeddings inputs={len(inputs)} latency={latency * 1000:.1f}ms')
+
+
+class EmbeddingClient(_ChannelPool):
+    '''
+    Keeps `pool_size` secure channels open to the embedding server and hands them out
+    round-robin. A channel that fails with UNAVAILABLE is closed and re-created once
+    before the error is raised to the caller.
+    '''
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def _create_channel(self) -> grpc.Channel:
+        metrics.incr('embedding.client.channels_created')
+        if self.insecure:
+            return grpc.insecure_channel(self.target, options=self.options)
+        return grpc.secure_channel(self.target, self.credentials, options=self.options)
+
+    def _stub(self, slot: int) -> embedding_query_pb2_grpc.EmbeddingServiceStub:
+        stub = self._stubs[slot]
+        if stub is None:
+            with self._lock:
+                if self._stubs[slot] is None:
+                    self._channels[slot] = self._create_channel()
+                    self._stubs[slot] = embedding_query_pb2_grpc.EmbeddingServiceStub(self._channels[slot])
+                stub = self._stubs[slot]
+        return stub
+
+    def _reset(self, slot: int) -> None:
+        with self._lock:
+            channel = self._channels[slot]
+            self._channels[slot] = None
+            self._stubs[slot] = None
+        if channel is not None:
+            channel.close()
+        metrics.incr('embedding.client.reconnects')
+
+    def _call(self, method: str, request, timeout: float = None):
+        slot = self._slot()
+        timeout = timeout or self.timeout
+        try:
+            return getattr(self._stub(slot), method)(request, timeout=timeout, metadata=self.metadata, wait_for_ready=True)
+        except grpc.RpcError as e:
+            if e.code() not in RETRYABLE_CODES:
+                raise
+            logger.error(f'Embedding channel {slot} failed with {e.code()}, reconnecting')
+            self._reset(slot)
+            return getattr(self._stub(slot), method)(request, timeout=timeout, metadata=self.metadata, wait_for_ready=True)
+
+    def embeddings(self, inputs: List[str], timeout: float = None, dimensions: int = None) -> np.ndarray:
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        start = time.perf_counter()
+        try:
+            response = self._call('GetEmbeddings', embedding_query_pb2.EmbeddingQuery(queries=inputs, dimensions=dimensions or 0), timeout)
+        except grpc.RpcError:
+            metrics.incr('embedding.client.errors')
+            raise
+        embeddings = decode_embeddings(response.serialized_embeddings)
+        self._record(inputs, start)
+        return embeddings
+
+    def stream_embeddings(self, batches: Iterable[List[str]], max_in_flight: int = None,
+                          timeout: float = None, dimensions: int = None) -> Iterator[np.ndarray]:
+        '''
+        Send query batches over one StreamEmbeddings call and yield one (n, dim) array per
+        batch, in order. At most `max_in_flight` batches are sent ahead of the consumer, so
+        memory stays bounded however long `batches` is. Not retried, a failure mid-stream
+        is raised to the caller.
+        '''
+        window = threading.Semaphore(max_in_flight or EMBEDDING_STREAM_IN_FLIGHT)
+        done = threading.Event()
+
+        def requests():
+            for batch in batches:
+                while not window.acquire(timeout=0.1):
+                    if done.is_set():
+                        return
+                yield embedding_query_pb2.EmbeddingQuery(queries=list(batch), dimensions=dimensions or 0)
+
+        stub = self._stub(self._slot())
+        responses = stub.StreamEmbeddings(requests(), timeout=timeout, metadata=self.metadata, wait_for_ready=True)
+        try:
+            for response in responses:
+                start = time.perf_counter()
+                embeddings = decode_embeddings(response.serialized_embeddings)
+                metrics.incr('embedding.client.stream_batches')
+                metrics.incr('embedding.client.inputs', len(embeddings))
+                metrics.observe('embedding.client.stream_decode', time.perf_counter() - start)
+                window.release()
+                yield embeddings
+        except grpc.RpcError:
+            metrics.incr('embedding.client.errors')
+            raise
+        finally:
+            done.set()
+            responses.cancel()
+
+    def close(self) -> None:
+        with self._lock:
+            channels = [c for c in self._channels if c is not None]
+            self._channels = [None] * self.pool_size
+            self._stubs = [None] * self.pool_size
+        for channel in channels:
+            channel.close()
+
+
+class AsyncEmbeddingClient(_ChannelPool):
+    '''
+    grpc.aio version of EmbeddingClient for the async chat path. Same channel pool,
+    credentials and reconnect behaviour, but waiting for vectors never blocks the event loop.
+    Channels belong to the loop that created them, use get_async_embedding_client().
+    '''
+    def _create_channel(self) -> grpc.aio.Channel:
+        metrics.incr('embedding.aclient.channels_created')
+        if self.insecure:
+            return grpc.aio.insecure_channel(self.target, options=self.options)
+        return grpc.aio.secure_channel(self.target, self.credentials, options=self.options)
+
+    def _stub(self, slot: int) -> embedding_query_pb2_grpc.EmbeddingServiceStub:
+        if self._stubs[slot] is None:
+            self._channels[slot] = self._create_channel()
+            self._stubs[slot] = embedding_query_pb2_grpc.EmbeddingServiceStub(self._channels[slot])
+        return self._stubs[slot]
+
+    async def _reset(self, slot: int) -> None:
+        channel = self._channels[slot]
+        self._channels[slot] = None
+        self._stubs[slot] = None
+        if channel is not None:
+            await channel.close()
+        metrics.incr('embedding.aclient.reconnects')
+
+    async def _call(self, method: str, request, timeout: float = None):
+        slot = self._slot()
+        timeout = timeout or self.timeout
+        try:
+            return await getattr(self._stub(slot), method)(request, timeout=timeout, metadata=self.metadata, wait_for_ready=True)
+        except grpc.aio.AioRpcError as e:
+            if e.code() not in RETRYABLE_CODES:
+                raise
+            logger.error(f'Async embedding channel {slot} failed with {e.code()}, reconnecting')
+            await self._reset(slot)
+            return await getattr(self._stub(slot), method)(request, timeout=timeout, metadata=self.metadata, wait_for_ready=True)
+
+    async def embeddings(self, inputs: List[str], timeout: float = None, dimensions: int = None) -> np.ndarray:
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        start = time.perf_counter()
+        try:
+            response = await self._call('GetEmbeddings', embedding_query_pb2.EmbeddingQuery(queries=inputs, dimensions=dimensions or 0), timeout)
+        except grpc.RpcError:
+            metrics.incr('embedding.aclient.errors')
+            raise
+        embeddings = decode_embeddings(response.serialized_embeddings)
+        self._record(inputs, start, 'embedding.aclient')
+        return embeddings
+
+    async def close(self) -> None:
+        channels = [c for c in self._channels if c is not None]
+        self._channels = [None] * self.pool_size
+        self._stubs = [None] * self.pool_size
+        for channel in channels:
+            await channel.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_embedding_client() -> EmbeddingClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = EmbeddingClient()
+    return _client
+
+
+def close_embedding_client() -> None:
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_embedding_client() -> AsyncEmbeddingClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncEmbeddingClient()
+    return client
@@ -0,0 +1,127 @@
+'''
+Ollama embedding backend. Uses the batch /api/embed endpoint and falls back to
+concurrent single-prompt /api/embeddings calls on servers that do not have it.
+'''
+import asyncio
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import dotenv
+import httpx
+import numpy as np
+import ollama
+
+from logger import logger
+from metrics import metrics
+
+dotenv.load_dotenv()
+
+OLLAMA_EMBED_BATCH = int(os.getenv('OLLAMA_EMBED_BATCH', 64))
+OLLAMA_EMBED_CONCURRENCY = int(os.getenv('OLLAMA_EMBED_CONCURRENCY', 8))
+OLLAMA_EMBED_RETRIES = int(os.getenv('OLLAMA_EMBED_RETRIES', 3))
+TRANSIENT_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+def is_transient(e: Exception) -> bool:
+    if isinstance(e, ollama.ResponseError):
+        return e.status_code in TRANSIENT_STATUS
+    return isinstance(e, (httpx.TransportError, httpx.TimeoutException))
+
+
+class OllamaEmbedding:
+    def __init__(self, model: str = 'mxbai-embed-large', host: str = None, batch_size: int = None,
+                 concurrency: int = None, retries: int = None, backoff: float = 0.5, timeout: float = 60) -> None:
+        self.model = model
+        self.host = host
+        self.batch_size = batch_size or OLLAMA_EMBED_BATCH
+        self.concurrency = concurrency or OLLAMA_EMBED_CONCURRENCY
+        self.retries = OLLAMA_EMBED_RETRIES if retries is None else retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # None until the first call tells us whether the server has /api/embed
+        self.batch_supported = None
+        # event loop -> (client, transport). An httpx connection pool belongs to the loop it was
+        # opened on, so each loop reuses one client; the transport is what closes its connections.
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self) -> ollama.AsyncClient:
+        loop = asyncio.get_running_loop()
+        entry = self._clients.get(loop)
+        if entry is None:
+            transport = httpx.AsyncHTTPTransport()
+            entry = self._clients[loop] = (ollama.AsyncClient(host=self.host, timeout=self.timeout, transport=transport), transport)
+        return entry[0]
+
+    async def aclose(self) -> None:
+        '''Close the connections of the running event loop's client.'''
+        entry = self._clients.pop(asyncio.get_running_loop(), None)
+        if entry is not None:
+            await entry[1].aclose()
+
+    async def _with_retry(self, call):
+        for attempt in range(self.retries + 1):
+            try:
+                return await call()
+            except Exception as e:
+                if attempt == self.retries or not is_transient(e):
+                    raise
+                metrics.incr('embedding.ollama.retries')
+                logger.error(f'Ollama embedding attempt {attempt + 1} failed: {e}, retrying')
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def _embed_batch(self, client: ollama.AsyncClient, semaphore: asyncio.Semaphore, chunk: List[str]):
+        async with semaphore:
+            response = await self._with_retry(lambda: client.embed(model=self.model, input=chunk))
+        metrics.incr('embedding.ollama.batch_calls')
+        return response['embeddings']
+
+    async def _embed_one(self, client: ollama.AsyncClient, semaphore: asyncio.Semaphore, prompt: str):
+        async with semaphore:
+            response = await self._with_retry(lambda: client.embeddings(model=self.model, prompt=prompt))
+        metrics.incr('embedding.ollama.single_calls')
+        return response['embedding']
+
+    async def _embed_chunk(self, client: ollama.AsyncClient, semaphore: asyncio.Semaphore, chunk: List[str]):
+        if self.batch_supported is not False:
+            try:
+                embeddings = await self._embed_batch(client, semaphore, chunk)
+                self.batch_supported = True
+                return embeddings
+            except ollama.ResponseError as e:
+                if e.status_code != 404 or self.batch_supported:
+                    raise
+                logger.info(f'Ollama server at {self.host or "default host"} has no /api/embed, using /api/embeddings')
+                self.batch_supported = False
+        return await asyncio.gather(*[self._embed_one(client, semaphore, prompt) for prompt in chunk])
+
+    async def aembedding(self, inputs: List[str]) -> np.ndarray:
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if not inputs:
+            return np.empty((0, 0), dtype=np.float32)
+        client = self._client()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        chunks = [inputs[i:i + self.batch_size] for i in range(0, len(inputs), self.batch_size)]
+        results = await asyncio.gather(*[self._embed_chunk(client, semaphore, chunk) for chunk in chunks])
+        return np.asarray([vector for chunk in results for vector in chunk], dtype=np.float32)
+
+    async def aembeddings(self, model=None, inputs: List[str] = None) -> np.ndarray:
+        return await self.aembedding(inputs)
+
+    async def _aembedding_once(self, inputs: List[str]) -> np.ndarray:
+        # the private loop of a synchronous call ends with it, and so does its client
+        try:
+            return await self.aembedding(inputs)
+        finally:
+            await self.aclose()
+
+    def embedding(self, inputs: List[str]) -> np.ndarray:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._aembedding_once(inputs))
+        # called from inside an event loop: run on a private loop in a worker thread
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(asyncio.run, self._aembedding_once(inputs)).result()
@@ -0,0 +1,179 @@
+'''
+ONNX Runtime inference for the local embedding model.
+export_onnx() traces the whole SentenceTransformer pipeline (transformer, pooling, dense)
+into one graph, optionally writes a dynamically int8-quantised copy and checks both against
+the PyTorch model. OnnxEncoder then serves `encode()` without importing torch.
+
+    python embedding_onnx.py --model /path/to/xiaobu-embedding-v2 --output /path/to/xiaobu-embedding-v2/onnx
+'''
+import argparse
+import importlib.util
+import inspect
+import os
+from typing import List
+
+import dotenv
+import numpy as np
+import orjson
+
+from logger import logger
+
+dotenv.load_dotenv()
+
+EMBEDDING_ONNX_THREADS = int(os.getenv('EMBEDDING_ONNX_THREADS', 0))
+MODEL_FILE = 'model.onnx'
+QUANTIZED_FILE = 'model.int8.onnx'
+CONFIG_FILE = 'onnx_config.json'
+# minimum cosine between ONNX and PyTorch vectors accepted by export_onnx
+MIN_COSINE = {MODEL_FILE: 0.9999, QUANTIZED_FILE: 0.98}
+SAMPLE_SENTENCES = [
+    '孕期每天需要补充多少叶酸？',
+    '妊娠糖尿病的饮食应该注意什么',
+    'How much weight gain is normal during the second trimester?',
+    '产后抑郁有哪些早期表现，家人应该如何帮助？',
+    'Iron supplements and constipation',
+    '胎动',
+    '孕晚期出现下肢水肿是否需要就医，什么情况下要警惕子痫前期？',
+    'Is it safe to drink coffee while breastfeeding?',
+]
+
+
+def cosine_agreement(reference: np.ndarray, candidate: np.ndarray) -> np.ndarray:
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    candidate = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    return (reference * candidate).sum(axis=1)
+
+
+class OnnxEncoder:
+    '''
+    Drop-in for SentenceTransformer.encode on CPU. Inputs are sorted by length before
+    batching so each batch is padded as little as possible.
+    '''
+    def __init__(self, model_dir: str, quantized: bool = False, threads: int = None, batch_size: int = 32) -> None:
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, CONFIG_FILE), 'rb') as f:
+            self.config = orjson.loads(f.read())
+        options = ort.SessionOptions()
+        # one request runs at a time per process (the BatchScheduler merges them), so give it every core
+        options.intra_op_num_threads = threads or EMBEDDING_ONNX_THREADS or os.cpu_count()
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.model_file = os.path.join(model_dir, QUANTIZED_FILE if quantized else MODEL_FILE)
+        self.session = ort.InferenceSession(self.model_file, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(self.config['max_seq_length'])
+        self.tokenizer.enable_padding(pad_id=self.config['pad_token_id'], pad_token=self.config['pad_token'])
+        self.batch_size = batch_size
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.config['dim']
+
+    def _run(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        features = {'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                    'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+                    'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64)}
+        return self.session.run(None, {name: features[name] for name in self.input_names})[0]
+
+    def encode(self, inputs: List[str], normalize_embeddings: bool = False, batch_size: int = None, **kwargs) -> np.ndarray:
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if not inputs:
+            return np.empty((0, self.config['dim']), dtype=np.float32)
+        batch_size = batch_size or self.batch_size
+        order = np.argsort([-len(text) for text in inputs], kind='stable')
+        embeddings = np.empty((len(inputs), self.config['dim']), dtype=np.float32)
+        for i in range(0, len(inputs), batch_size):
+            index = order[i:i + batch_size]
+            embeddings[index] = self._run([inputs[j] for j in index])
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.where(norms == 0, 1, norms)
+        return embeddings
+
+
+def load_encoder(model_path: str, engine: str, onnx_dir: str = None):
+    '''engine is "torch", "onnx" or "onnx-int8"; ONNX graphs are looked up in onnx_dir or <model_path>/onnx.'''
+    if engine == 'torch':
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_path, local_files_only=True)
+    if engine not in ('onnx', 'onnx-int8'):
+        raise ValueError(f'Unknown embedding engine {engine!r}, expected torch, onnx or onnx-int8')
+    onnx_dir = onnx_dir or os.path.join(model_path, 'onnx')
+    quantized = engine == 'onnx-int8'
+    model_file = os.path.join(onnx_dir, QUANTIZED_FILE if quantized else MODEL_FILE)
+    # a server without onnxruntime or the exported graph still serves, just on the slower torch path
+    if importlib.util.find_spec('onnxruntime') is None:
+        logger.warning(f'Embedding engine {engine} needs onnxruntime, falling back to torch')
+        return load_encoder(model_path, 'torch')
+    if not os.path.exists(model_file):
+        logger.warning(f'Embedding engine {engine}: {model_file} not found, falling back to torch')
+        return load_encoder(model_path, 'torch')
+    return OnnxEncoder(onnx_dir, quantized=quantized)
+
+
+def export_onnx(model_path: str, output_dir: str, quantize: bool = True, opset: int = 17) -> dict:
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    class SentenceEmbedding(torch.nn.Module):
+        def __init__(self, model, input_names):
+            super().__init__()
+            self.model = model
+            self.input_names = input_names
+
+        def forward(self, *inputs):
+            return self.model(dict(zip(self.input_names, inputs)))['sentence_embedding']
+
+    os.makedirs(output_dir, exist_ok=True)
+    model = SentenceTransformer(model_path, device='cpu', local_files_only=True)
+    model.eval()
+    features = model.tokenize(SAMPLE_SENTENCES)
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in features]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['sentence_embedding'] = {0: 'batch'}
+    # newer torch defaults to the dynamo exporter, the TorchScript one handles HF models without extra deps
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(SentenceEmbedding(model, input_names), tuple(features[name] for name in input_names),
+                          os.path.join(output_dir, MODEL_FILE), input_names=input_names,
+                          output_names=['sentence_embedding'], dynamic_axes=dynamic_axes, opset_version=opset, **kwargs)
+    model.tokenizer.save_pretrained(output_dir)
+    config = {'model_path': model_path,
+              'dim': model.get_sentence_embedding_dimension(),
+              'max_seq_length': model.max_seq_length,
+              'pad_token_id': model.tokenizer.pad_token_id,
+              'pad_token': model.tokenizer.pad_token,
+              'agreement': {}}
+    with open(os.path.join(output_dir, CONFIG_FILE), 'wb') as f:
+        f.write(orjson.dumps(config))
+    files = [MODEL_FILE]
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(os.path.join(output_dir, MODEL_FILE), os.path.join(output_dir, QUANTIZED_FILE),
+                         weight_type=QuantType.QInt8)
+        files.append(QUANTIZED_FILE)
+
+    reference = model.encode(SAMPLE_SENTENCES, normalize_embeddings=True)
+    for file in files:
+        encoder = OnnxEncoder(output_dir, quantized=file == QUANTIZED_FILE)
+        cosine = cosine_agreement(reference, encoder.encode(SAMPLE_SENTENCES, normalize_embeddings=True))
+        config['agreement'][file] = float(cosine.min())
+        if cosine.min() < MIN_COSINE[file]:
+            raise ValueError(f'{file} disagrees with {model_path}: min cosine {cosine.min():.5f} < {MIN_COSINE[file]}')
+    with open(os.path.join(output_dir, CONFIG_FILE), 'wb') as f:
+        f.write(orjson.dumps(config))
+    return config
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--output')
+    parser.add_argument('--no-quantize', action='store_true')
+    args = parser.parse_args()
+    config = export_onnx(args.model, args.output or os.path.join(args.model, 'onnx'), quantize=not args.no_quantize)
+    print(f"Exported {args.model}: dim {config['dim']}, min cosine vs torch {config['agreement']}")
@@ -0,0 +1,57 @@
+'''
+Embedding backends by name. A backend's module is imported the first time it is asked for,
+so importing the retrieval and agent code does not pull in torch, dashscope or volcengine.
+EMBEDDING_BACKEND picks the default.
+'''
+import importlib
+import os
+import threading
+from typing import Dict, Tuple
+
+import dotenv
+
+dotenv.load_dotenv()
+
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'local')
+
+# name -> ('module:attribute', instantiate). LocalEmbedding is used through its
+# class-level gRPC client, constructing it would load the model.
+BACKENDS: Dict[str, Tuple[str, bool]] = {
+    'local': ('embedding:LocalEmbedding', False),
+    'ali': ('embedding:AliEmbedding', True),
+    'doubao': ('embedding:DoubaoEmbedding', True),
+    'ollama': ('embedding_ollama:OllamaEmbedding', True),
+}
+
+_backends = {}
+_lock = threading.Lock()
+
+
+def register_backend(name: str, target: str, instantiate: bool = True) -> None:
+    with _lock:
+        BACKENDS[name] = (target, instantiate)
+        _backends.pop(name, None)
+
+
+def load_backend(name: str = None):
+    name = name or EMBEDDING_BACKEND
+    try:
+        target, _ = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown embedding backend {name!r}, expected one of {sorted(BACKENDS)}')
+    module, attr = target.split(':')
+    return getattr(importlib.import_module(module), attr)
+
+
+def get_backend(name: str = None):
+    name = name or EMBEDDING_BACKEND
+    backend = _backends.get(name)
+    if backend is None:
+        with _lock:
+            backend = _backends.get(name)
+            if backend is None:
+                backend = load_backend(name)
+                if BACKENDS[name][1]:
+                    backend = backend()
+                _backends[name] = backend
+    return backend
@@ -2,6 +2,7 @@
 Common Utility functions. Please modify the functions as needed.
 '''
 
+import adb
 from db import db, UserHistory
 from pydantic import BaseModel
 from typing import List, Optional
@@ -29,11 +30,8 @@ def delete_session(user_id, session_id):
     UserHistory.update(is_deleted=True).where((UserHistory.user_id == user_id) & (UserHistory.session_id == session_id)).execute()
 
 
-def get_history(user_id, session_id, limit=40):
-    '''
-    Won't use user_meta in this version. Remove Redis
-    '''
-    results = UserHistory.select(
+def _history_query(user_id, session_id, limit):
+    return UserHistory.select(
         UserHistory.role,
         UserHistory.message,
         UserHistory.state,
@@ -46,21 +44,35 @@ def get_history(user_id, session_id, limit=40):
         UserHistory.created_at.desc()
     ).limit(limit)
 
+
+def _to_history(results):
     history = None
     if results:
         history = {
-            'state': list(results)[-1].state,
+            'state': results[-1].state,
             'history': [
                 HistoryItem(
                     role=h.role, 
                     content=h.message
                 ).model_dump()
-                for h in sorted(list(results), key=lambda x: x.created_at)
+                for h in sorted(results, key=lambda x: x.created_at)
             ]
         }
     return history
 
 
+def get_history(user_id, session_id, limit=40):
+    '''
+    Won't use user_meta in this version. Remove Redis
+    '''
+    return _to_history(list(_history_query(user_id, session_id, limit)))
+
+
+async def aget_history(user_id, session_id, limit=40):
+    '''get_history() for async handlers, on the asyncpg pool.'''
+    return _to_history(await adb.fetch(_history_query(user_id, session_id, limit)))
+
+
 def update_history(user_id: str, session_id: str, user_meta: dict, state: str, records: HistoryItem | list[HistoryItem]) -> History:
     '''
     Remove redis cache in this version 
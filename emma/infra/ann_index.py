@@ -0,0 +1,86 @@
+'''
+Manage the ANN indexes of the vector tables. Builds use CREATE INDEX CONCURRENTLY and
+rebuilds swap in a fresh index, so both run against live traffic.
+Run from emma/:
+    python infra/ann_index.py health
+    python infra/ann_index.py create
+    python infra/ann_index.py rebuild --table Vector1792 --m 24 --ef-construction 128 --maintenance-work-mem 4GB
+    python infra/ann_index.py create --table Vector1792 --organization dehan0001
+    python infra/ann_index.py create --table MemoryModel --method ivfflat --lists 200
+    python infra/ann_index.py create --table Vector1792 --quantization binary --organization dehan0001
+    python infra/ann_index.py storage --table Vector1792 --organization dehan0001
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+
+import db as models
+from db import db, SEARCH_PATH
+from vector_index import INDEXES, QUANTIZATIONS, VectorIndex, create_index, drop_index, index_health, rebuild_index, storage_report
+
+
+def selected_indexes(args):
+    if args.table is None:
+        if args.organization or args.column or args.method or args.quantization or args.params:
+            raise SystemExit('--table is required with --column, --method, --organization, --quantization or index parameters')
+        return INDEXES
+    table = getattr(models, args.table)
+    return [VectorIndex(table, args.column or 'embedding', args.method or 'hnsw', params=args.params,
+                        organization=args.organization, quantization=args.quantization)]
+
+
+def print_health(report):
+    for row in sorted(report, key=lambda r: (r['table'], r['index'])):
+        state = 'MISSING' if row.get('missing') else 'ok' if row['valid'] else 'INVALID'
+        print(f"{row['table']:20s} {row['index']:50s} {row['method']:8s} {state:8s} "
+              f"{row['size_bytes'] / 2 ** 20:9.1f} MB {row['scans']:10d} scans "
+              f"{row['options']} {row['predicate'] or ''}")
+
+
+def print_storage(report):
+    rows = report['rows']
+    print(f"{report['table']}: {rows} rows, table {report['table_bytes'] / 2 ** 20:.1f} MB")
+    for name, size in report['vector_bytes'].items():
+        print(f"  {name:6s} {size:6d} bytes/vector {size * rows / 2 ** 20:9.1f} MB")
+    for index in report['indexes']:
+        print(f"  {index['index']:50s} {index['size_bytes'] / 2 ** 20:9.1f} MB {index['predicate'] or ''}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['create', 'rebuild', 'drop', 'health', 'storage'])
+    parser.add_argument('--table', help='model name in db.py, e.g. Vector1792 or MemoryModel')
+    parser.add_argument('--column')
+    parser.add_argument('--method', choices=['hnsw', 'ivfflat'])
+    parser.add_argument('--organization', help='build a partial index for one organization')
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, help='index a halfvec or binary form of the column')
+    parser.add_argument('--m', type=int)
+    parser.add_argument('--ef-construction', type=int)
+    parser.add_argument('--lists', type=int)
+    parser.add_argument('--maintenance-work-mem', help="e.g. '2GB'")
+    parser.add_argument('--parallel-workers', type=int)
+    args = parser.parse_args()
+    args.params = {key: getattr(args, key) for key in ('m', 'ef_construction', 'lists') if getattr(args, key)}
+
+    if args.command == 'storage' and args.table is None:
+        raise SystemExit('--table is required with storage')
+    indexes = selected_indexes(args) if args.command not in ('health', 'storage') else []
+    db.connect()
+    db.execute_sql(f'SET search_path TO {SEARCH_PATH}')
+    try:
+        if args.command == 'health':
+            print_health(index_health(getattr(models, args.table) if args.table else None))
+        if args.command == 'storage':
+            print_storage(storage_report(getattr(models, args.table), args.organization))
+        for index in indexes:
+            print(f'{args.command} {index}...')
+            if args.command == 'create':
+                create_index(index, args.maintenance_work_mem, args.parallel_workers)
+            elif args.command == 'rebuild':
+                rebuild_index(index, args.maintenance_work_mem, args.parallel_workers)
+            else:
+                drop_index(index)
+    finally:
+        db.close()
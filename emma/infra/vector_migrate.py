@@ -0,0 +1,83 @@
+'''
+Schema changes to existing vector tables that db.create_tables cannot apply.
+Run from emma/: python infra/vector_migrate.py <step> [<step> ...]
+Steps are idempotent. Backfills use pgvector >= 0.7 functions (subvector, l2_normalize).
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from playhouse.migrate import PostgresqlMigrator, migrate
+from db import db, Vector1792, MATRYOSHKA_DIM, SEARCH_PATH
+from partitioning import is_partitioned
+from vector_index import VectorIndex, create_index
+
+BACKFILL_BATCH = 5000
+
+
+def add_missing_column(table, name, field):
+    columns = [c.name for c in db.get_columns(table._meta.table_name)]
+    if name not in columns:
+        migrate(PostgresqlMigrator(db).add_column(table._meta.table_name, name, field))
+
+
+def backfill(table_name, assignment, condition):
+    # small batches keep row locks and WAL bursts short on a live table
+    while True:
+        cursor = db.execute_sql(f'UPDATE {table_name} SET {assignment} '
+                                f'WHERE id IN (SELECT id FROM {table_name} WHERE {condition} LIMIT {BACKFILL_BATCH})')
+        print(f'{table_name}: {cursor.rowcount} rows backfilled')
+        if cursor.rowcount < BACKFILL_BATCH:
+            break
+
+
+def matryoshka(table=Vector1792):
+    '''Short normalised prefix column for two-stage retrieval, with its HNSW index.'''
+    table_name = table._meta.table_name
+    add_missing_column(table, 'embedding_short', table.embedding_short)
+    backfill(table_name, f'embedding_short = l2_normalize(subvector(embedding, 1, {MATRYOSHKA_DIM}))', 'embedding_short IS NULL')
+    create_index(VectorIndex(table, 'embedding_short'))
+
+
+def content_hash(table=Vector1792):
+    '''sha256 of each chunk's text, used by incremental re-ingestion.'''
+    add_missing_column(table, 'content_hash', table.content_hash)
+    backfill(table._meta.table_name, "content_hash = encode(sha256(convert_to(text, 'UTF8')), 'hex')", 'content_hash IS NULL')
+
+
+def identity(table=Vector1792):
+    '''embedding_model / sentence_splitter columns copied out of meta, with the filter index retrieval uses.'''
+    table_name = table._meta.table_name
+    for name in ('embedding_model', 'sentence_splitter'):
+        add_missing_column(table, name, getattr(table, name))
+    backfill(table_name, "embedding_model = meta->>'embedding_model', sentence_splitter = meta->>'sentence_splitter'",
+             "embedding_model IS NULL AND meta->>'embedding_model' IS NOT NULL")
+    # the same name db.create_tables gives the index declared in the model's Meta
+    name = next(index._name for index in table._meta.fields_to_index() if index._name.endswith('_embedding_model_sentence_splitter'))
+    # partitioned tables are created with the index, CONCURRENTLY is not possible on them
+    if not is_partitioned(table_name):
+        db.execute_sql(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table_name} (organization, embedding_model, sentence_splitter)')
+    db.execute_sql(f'ANALYZE {table_name}')
+
+
+STEPS = {
+    'matryoshka': matryoshka,
+    'content_hash': content_hash,
+    'identity': identity,
+}
+
+
+if __name__ == '__main__':
+    steps = sys.argv[1:]
+    unknown = [step for step in steps if step not in STEPS]
+    if not steps or unknown:
+        print(f"Usage: python infra/vector_migrate.py {{{','.join(STEPS)}}} ...")
+        sys.exit(1)
+    db.connect()
+    db.execute_sql(f'SET search_path TO {SEARCH_PATH}')
+    try:
+        for step in steps:
+            print(f'Running {step}...')
+            STEPS[step]()
+    finally:
+        db.close()
@@ -0,0 +1,50 @@
+'''
+Organization partitions of the vector tables. Both changes copy rows online, writes are only
+blocked for the final catch-up and the switch.
+Run from emma/:
+    python infra/vector_partition.py list --table Vector1792
+    python infra/vector_partition.py convert --table Vector1792
+    python infra/vector_partition.py split --table Vector1792 --organization dehan0001
+convert rebuilds a table created before partitioning, run it after the vector_migrate.py steps.
+The old table stays as <table>_unpartitioned until it is dropped by hand, and a pg_search BM25
+index on the old table has to be created again on the new one.
+split moves a large organization out of the shared DEFAULT partition into its own, with its
+own ANN indexes.
+'''
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+
+import db as models
+from db import db, SEARCH_PATH
+from partitioning import convert_table, partitions, split_organization
+
+
+def print_partitions(report):
+    for row in report:
+        print(f"{'  ' * row['level']}{row['partition']:50s} {row['rows']:10d} rows "
+              f"{row['size_bytes'] / 2 ** 20:9.1f} MB  {row['bound']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['list', 'convert', 'split'])
+    parser.add_argument('--table', required=True, help='model name in db.py, e.g. Vector1792')
+    parser.add_argument('--organization', help='organization to give its own partition')
+    args = parser.parse_args()
+    if args.command == 'split' and not args.organization:
+        raise SystemExit('--organization is required with split')
+
+    table = getattr(models, args.table)
+    db.connect()
+    db.execute_sql(f'SET search_path TO {SEARCH_PATH}')
+    try:
+        if args.command == 'convert':
+            print(f'{table._meta.table_name} converted, the old table is kept as {convert_table(table)}')
+        elif args.command == 'split':
+            print(f'{args.organization} moved to {split_organization(table, args.organization)}')
+        print_partitions(partitions(table))
+    finally:
+        db.close()
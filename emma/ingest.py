@@ -0,0 +1,338 @@
+'''
+Staged document ingestion: split -> embed -> write -> publish.
+A thread streams batches from the embedding backend into a bounded queue, so memory per
+document is bounded by the queue instead of the document length. The write stage COPYs every
+batch as it arrives, in PostgreSQL's binary format, into a temporary staging table of the
+connection, outside any transaction. The publish stage then moves the staged rows into the
+VectorNNN table and deletes the document's stale rows in one short transaction per document,
+under an advisory lock on its doc_id. Several documents run in parallel, each on its own connection.
+Re-ingesting a document is incremental on tables with a content_hash column: chunks whose
+text hash and splitter/model identity match a stored row are kept, only new or changed
+chunks are embedded and rows that no longer occur are deleted.
+'''
+import hashlib
+import io
+import os
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+import dotenv
+import numpy as np
+import orjson
+from peewee import BigIntegerField, CharField, IntegerField, TextField
+from pgvector.peewee import VectorField
+from playhouse.postgres_ext import BinaryJSONField
+from pydantic import BaseModel
+
+from db import db, in_worker_thread, release_connection, Document, Vector1792, MATRYOSHKA_DIM
+from embedding_client import EMBEDDING_STREAM_BATCH
+from logger import logger
+from metrics import metrics
+from retrieval_cache import get_retrieval_cache
+from utils import sliced_norm_l2_batch
+
+dotenv.load_dotenv()
+
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 4))
+# embedded batches waiting to be written, per document
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 4))
+
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+NULL = struct.pack('!i', -1)
+# a stored vector is only reusable when it was produced the same way
+IDENTITY_KEYS = ('embedding_model', 'sentence_splitter')
+# temporary table of the ingesting connection; chunk is the index of the row's chunk in the document
+STAGING_TABLE = 'ingest_staging'
+STAGING_CHUNK = IntegerField(column_name='chunk')
+
+
+def _encode_value(field, value) -> bytes:
+    if value is None:
+        return NULL
+    if isinstance(field, VectorField):
+        # pgvector binary input: int16 dim, int16 unused, float4[dim] big-endian
+        vector = np.asarray(value, dtype='>f4')
+        data = struct.pack('!hh', vector.shape[0], 0) + vector.tobytes()
+    elif isinstance(field, BinaryJSONField):
+        # jsonb binary input: version byte then the JSON text
+        data = b'\x01' + orjson.dumps(value)
+    elif isinstance(field, (CharField, TextField)):
+        data = value.encode('utf-8')
+    elif isinstance(field, BigIntegerField):
+        data = struct.pack('!q', value)
+    elif isinstance(field, IntegerField):
+        data = struct.pack('!i', value)
+    else:
+        raise TypeError(f'No binary COPY encoding for {type(field).__name__} {field.name}')
+    return struct.pack('!i', len(data)) + data
+
+
+def encode_copy(fields: List, rows: Iterable[tuple]) -> bytes:
+    '''Rows as a complete binary COPY stream for the given peewee fields.'''
+    out = io.BytesIO()
+    out.write(COPY_HEADER)
+    ncols = struct.pack('!h', len(fields))
+    for row in rows:
+        out.write(ncols)
+        for field, value in zip(fields, row):
+            out.write(_encode_value(field, value))
+    out.write(COPY_TRAILER)
+    return out.getvalue()
+
+
+def copy_rows(table, fields: List, rows: Iterable[tuple]) -> None:
+    '''COPY rows into a model's table, or into the table of that name.'''
+    table_name = table if isinstance(table, str) else table._meta.table_name
+    columns = ', '.join(field.column_name for field in fields)
+    data = io.BytesIO(encode_copy(fields, rows))
+    db.cursor().copy_expert(f'COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT binary)', data)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def diff_chunks(existing: Iterable[Tuple[int, str, dict]], hashes: List[str], meta: dict) -> Tuple[List[int], List[int]]:
+    '''
+    Match the chunk hashes of a new version of a document against its stored (id, hash, meta) rows.
+    Returns (indexes of chunks that need embedding, ids of rows to delete). Repeated chunks are
+    matched one to one, so a chunk that now occurs less often loses its surplus rows.
+    '''
+    identity = tuple(meta.get(key) for key in IDENTITY_KEYS)
+    reusable: Dict[str, List[int]] = {}
+    stale = []
+    for row_id, chunk_hash, row_meta in existing:
+        if tuple((row_meta or {}).get(key) for key in IDENTITY_KEYS) == identity:
+            reusable.setdefault(chunk_hash, []).append(row_id)
+        else:
+            stale.append(row_id)
+    todo = []
+    for i, chunk_hash in enumerate(hashes):
+        if reusable.get(chunk_hash):
+            reusable[chunk_hash].pop()
+        else:
+            todo.append(i)
+    stale.extend(row_id for ids in reusable.values() for row_id in ids)
+    return todo, stale
+
+
+class IngestReport(BaseModel):
+    doc_id: str
+    chunks: int = 0
+    unchanged: int = 0
+    embedded: int = 0
+    deleted: int = 0
+
+    @property
+    def saved(self) -> float:
+        '''Share of the document's chunks that did not have to be embedded again.'''
+        return self.unchanged / self.chunks if self.chunks else 0.0
+
+
+class StageStats:
+    '''Items and busy seconds per stage, logged per document and exported as metrics.'''
+    def __init__(self) -> None:
+        self.items: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+
+    def record(self, stage: str, items: int, seconds: float) -> None:
+        self.items[stage] = self.items.get(stage, 0) + items
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        metrics.incr(f'ingest.{stage}.items', items)
+        metrics.observe(f'ingest.{stage}.seconds', seconds)
+
+    def throughput(self) -> Dict[str, float]:
+        return {stage: self.items[stage] / self.seconds[stage] if self.seconds[stage] else 0.0 for stage in self.items}
+
+
+class IngestionPipeline:
+    def __init__(self, vectorization=None, table=Vector1792, batch_size: int = None, queue_size: int = None,
+                 workers: int = None, dimensions: int = None) -> None:
+        if vectorization is None:
+            from vectorization import Vectorization
+            vectorization = Vectorization()
+        self.vectorization = vectorization
+        self.table = table
+        self.batch_size = batch_size or EMBEDDING_STREAM_BATCH
+        self.queue_size = queue_size or INGEST_QUEUE_SIZE
+        self.workers = workers or INGEST_WORKERS
+        self.dimensions = dimensions
+        self.with_short = hasattr(table, 'embedding_short')
+        self.with_hash = hasattr(table, 'content_hash')
+        self.with_identity = all(hasattr(table, key) for key in IDENTITY_KEYS)
+        names = (['doc_id', 'text', 'embedding', 'organization', 'meta']
+                 + (['embedding_short'] if self.with_short else [])
+                 + (['content_hash'] if self.with_hash else [])
+                 + (list(IDENTITY_KEYS) if self.with_identity else []))
+        self.fields = [table._meta.fields[name] for name in names]
+
+    def _rows(self, doc_id: str, organization: str, meta: dict, texts: List[str], embeddings: np.ndarray, chunks: List[int] = None):
+        shorts = sliced_norm_l2_batch(embeddings, MATRYOSHKA_DIM) if self.with_short else None
+        identity = tuple(meta.get(key) for key in IDENTITY_KEYS)
+        for i, (text, embedding) in enumerate(zip(texts, embeddings)):
+            row = (doc_id, text, embedding, organization, meta)
+            if self.with_short:
+                row += (shorts[i],)
+            if self.with_hash:
+                row += (content_hash(text),)
+            if self.with_identity:
+                row += identity
+            if chunks is not None:
+                row += (chunks[i],)
+            yield row
+
+    def _plan(self, doc_id: str, organization: str, inputs: List[str], meta: dict) -> Tuple[List[int], List[int]]:
+        table = self.table
+        existing = (table.select(table.id, table.content_hash, table.text, table.meta)
+                    .where((table.doc_id == doc_id) & (table.organization == organization)).tuples())
+        # rows stored before the content_hash migration are hashed here
+        existing = [(row_id, chunk_hash or content_hash(text), row_meta) for row_id, chunk_hash, text, row_meta in existing]
+        return diff_chunks(existing, [content_hash(text) for text in inputs], meta)
+
+    def _lock(self, doc_id: str) -> None:
+        # held until commit; unlike row locks it also serialises the first ingestion of a doc_id
+        db.execute_sql("SELECT pg_advisory_xact_lock(hashtext('ingest:' || %s))", (doc_id,))
+
+    def _create_staging(self) -> None:
+        columns = ', '.join(field.column_name for field in self.fields)
+        db.execute_sql(f'DROP TABLE IF EXISTS {STAGING_TABLE}')
+        db.execute_sql(f'CREATE TEMP TABLE {STAGING_TABLE} AS SELECT {columns} FROM {self.table._meta.table_name} WITH NO DATA')
+        db.execute_sql(f'ALTER TABLE {STAGING_TABLE} ADD COLUMN {STAGING_CHUNK.column_name} integer')
+
+    def _embed(self, inputs: List[str], indexes: List[int], batches: queue.Queue, stop: threading.Event, stats: StageStats) -> None:
+        def put(item):
+            # give up when the writer failed instead of blocking on a full queue forever
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        try:
+            chunks = ([inputs[i] for i in indexes[j:j + self.batch_size]] for j in range(0, len(indexes), self.batch_size))
+            done = 0
+            start = time.perf_counter()
+            for embeddings in self.vectorization.embedding_model.stream_embeddings(chunks):
+                embeddings = np.asarray(embeddings, dtype=np.float32)
+                if self.dimensions:
+                    embeddings = sliced_norm_l2_batch(embeddings, self.dimensions)
+                stats.record('embed', len(embeddings), time.perf_counter() - start)
+                put((indexes[done:done + len(embeddings)], embeddings))
+                done += len(embeddings)
+                if stop.is_set():
+                    return
+                start = time.perf_counter()
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def _stage(self, doc_id: str, organization: str, meta: dict, inputs: List[str], indexes: List[int],
+               staged: set, total: int, stats: StageStats, progress=None) -> None:
+        '''Embed the chunks at `indexes` and COPY every batch into the staging table as it arrives.'''
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        embedder = threading.Thread(target=self._embed, args=(inputs, indexes, batches, stop, stats),
+                                    name=f'ingest.embed.{doc_id}', daemon=True)
+        embedder.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, embeddings = item
+                write_start = time.perf_counter()
+                copy_rows(STAGING_TABLE, self.fields + [STAGING_CHUNK],
+                          self._rows(doc_id, organization, meta, [inputs[i] for i in batch], embeddings, batch))
+                stats.record('write', len(batch), time.perf_counter() - write_start)
+                staged.update(batch)
+                if progress:
+                    progress(len(staged), total)
+        finally:
+            stop.set()
+            embedder.join()
+
+    def _publish(self, todo: List[int]) -> None:
+        columns = ', '.join(field.column_name for field in self.fields)
+        db.execute_sql(f'INSERT INTO {self.table._meta.table_name} ({columns}) SELECT {columns} FROM {STAGING_TABLE} '
+                       f'WHERE {STAGING_CHUNK.column_name} = ANY(%s)', (todo,))
+
+    def ingest(self, document, progress=None, incremental: bool = True) -> IngestReport:
+        '''
+        Split, embed and COPY one document. progress(done, total) is called after every embedded
+        batch, total being the number of chunks that need embedding. With incremental=False (or
+        without a content_hash column) the stored rows are replaced and every chunk is embedded.
+        '''
+        stats = StageStats()
+        start = time.perf_counter()
+        inputs, meta = self.vectorization.split_document(document)
+        stats.record('split', len(inputs), time.perf_counter() - start)
+        doc_id, organization = document.doc_id, document.metadata['organization']
+        report = IngestReport(doc_id=doc_id, chunks=len(inputs))
+        incremental = incremental and self.with_hash
+        # a connection the caller opened, and may have set up, is left open
+        own_connection = db.is_closed()
+        try:
+            self._create_staging()
+            # planned without locks and checked again under the lock before anything is published
+            todo = self._plan(doc_id, organization, inputs, meta)[0] if incremental else list(range(len(inputs)))
+            staged = set()
+            while True:
+                self._stage(doc_id, organization, meta, inputs, [i for i in todo if i not in staged],
+                            staged, len(todo), stats, progress)
+                with db.atomic():
+                    self._lock(doc_id)
+                    if incremental:
+                        todo, stale = self._plan(doc_id, organization, inputs, meta)
+                        if any(i not in staged for i in todo):
+                            # a concurrent ingestion of the document changed its rows, embed the difference
+                            continue
+                        if stale:
+                            self.table.delete().where((self.table.organization == organization)
+                                                      & self.table.id.in_(stale)).execute()
+                        report.deleted = len(stale)
+                    else:
+                        report.deleted = self.table.delete().where(self.table.doc_id == doc_id).execute()
+                    publish_start = time.perf_counter()
+                    self._publish(todo)
+                    stats.record('publish', len(todo), time.perf_counter() - publish_start)
+                    stored, created = Document.get_or_create(doc_id=doc_id,
+                                                             defaults={'filename': document.metadata['filename'],
+                                                                       'organization': organization})
+                    if not created:
+                        # a re-upload may rename the file, save() also bumps updated_at
+                        stored.filename = document.metadata['filename']
+                        stored.save()
+                break
+        finally:
+            if not db.is_closed() and not db.in_transaction():
+                db.execute_sql(f'DROP TABLE IF EXISTS {STAGING_TABLE}')
+            if own_connection:
+                release_connection()
+        report.unchanged = len(inputs) - len(todo)
+        report.embedded = len(todo)
+        cache = get_retrieval_cache()
+        if cache and (report.embedded or report.deleted):
+            # cached answers for this organization no longer match the stored chunks
+            cache.invalidate(organization)
+        for name in ('unchanged', 'embedded', 'deleted'):
+            metrics.incr(f'ingest.chunks.{name}', getattr(report, name))
+        rates = ', '.join(f'{stage} {rate:.0f}/s' for stage, rate in stats.throughput().items())
+        logger.info(f'Ingested {doc_id} in {time.perf_counter() - start:.2f}s: {report.chunks} chunks, '
+                    f'{report.unchanged} unchanged, {report.embedded} embedded, {report.deleted} deleted '
+                    f'({report.saved:.0%} embedding saved; {rates})')
+        return report
+
+    def ingest_many(self, documents, progress=None, incremental: bool = True) -> Dict[str, IngestReport]:
+        '''Ingest documents in parallel, `workers` at a time. Returns the report of each doc_id.'''
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ingest') as pool:
+            futures = {document.doc_id: pool.submit(in_worker_thread, self.ingest, document, progress, incremental)
+                       for document in documents}
+            return {doc_id: future.result() for doc_id, future in futures.items()}
@@ -0,0 +1,141 @@
+'''
+In-process index of the FAQ memories (MemoryModel) of each organization. The FAQ tables are
+small, so instead of asking PostgreSQL to sort every row of the organization by cosine distance,
+the normalised embeddings are kept in one float32 matrix per organization and a search is a single
+matrix-vector product. PostgreSQL stays the source of truth: an organization is loaded on its
+first search, reloaded when Memory.load_memory inserts into it, and again after
+MEMORY_INDEX_TTL seconds so rows written by other worker processes show up.
+Organizations with more than MEMORY_INDEX_MAX_ROWS memories are left to the SQL path.
+'''
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import dotenv
+import numpy as np
+from peewee import fn
+
+import adb
+from db import MemoryModel
+from metrics import metrics
+from utils import sliced_norm_l2_batch
+
+dotenv.load_dotenv()
+
+MEMORY_INDEX = os.getenv('MEMORY_INDEX', '1') == '1'
+MEMORY_INDEX_TTL = int(os.getenv('MEMORY_INDEX_TTL', 300))
+MEMORY_INDEX_MAX_ROWS = int(os.getenv('MEMORY_INDEX_MAX_ROWS', 20000))
+# organizations kept in memory at once, least recently searched first out
+MEMORY_INDEX_ORGANIZATIONS = int(os.getenv('MEMORY_INDEX_ORGANIZATIONS', 64))
+
+
+class OrganizationIndex:
+    def __init__(self, ids, texts: List[str], answers: List[str], embeddings) -> None:
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.texts = texts
+        self.answers = answers
+        dim = MemoryModel.embedding.dimensions
+        self.matrix = sliced_norm_l2_batch(embeddings, dim) if len(ids) else np.zeros((0, dim), dtype=np.float32)
+
+    @classmethod
+    def from_rows(cls, rows) -> 'OrganizationIndex':
+        # pgvector's binary form: int16 dim, int16 unused, then big-endian float32 values
+        vectors = [np.frombuffer(row.vector, dtype='>f4', offset=4) for row in rows]
+        return cls([row.id for row in rows], [row.text for row in rows], [row.ans for row in rows], vectors)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query_embedding, topk: int = 10) -> List[MemoryModel]:
+        '''The topk memories by cosine similarity, as MemoryModel rows with a `similarity` attribute.'''
+        start = time.perf_counter()
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        scores = self.matrix @ (query / norm if norm else query)
+        topk = min(topk, len(scores))
+        top = np.argpartition(-scores, topk - 1)[:topk] if 0 < topk < len(scores) else np.arange(topk)
+        # equal scores keep id order
+        top = top[np.lexsort((self.ids[top], -scores[top]))]
+        rows = []
+        for i in top:
+            row = MemoryModel(id=int(self.ids[i]), text=self.texts[i], ans=self.answers[i])
+            row.similarity = float(scores[i])
+            rows.append(row)
+        metrics.observe('memory.index.search.seconds', time.perf_counter() - start)
+        return rows
+
+
+class MemoryIndex:
+    def __init__(self, ttl: int = MEMORY_INDEX_TTL, max_rows: int = MEMORY_INDEX_MAX_ROWS,
+                 organizations: int = MEMORY_INDEX_ORGANIZATIONS) -> None:
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.organizations = organizations
+        # organization -> (monotonic load time, OrganizationIndex or None when too large)
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _rows_query(self, organization: str):
+        # one row over the limit is enough to know the organization is too large; the binary form
+        # of the vectors loads an order of magnitude faster than parsing their text
+        return (MemoryModel.select(MemoryModel.id, MemoryModel.text, MemoryModel.ans,
+                                   fn.vector_send(MemoryModel.embedding).coerce(False).alias('vector'))
+                .where(MemoryModel.organization == organization).order_by(MemoryModel.id).limit(self.max_rows + 1))
+
+    def _cached(self, organization: str):
+        '''(found, index); index is None for an organization too large for memory.'''
+        with self._lock:
+            if organization not in self._indexes:
+                return False, None
+            loaded_at, index = self._indexes[organization]
+            if time.monotonic() - loaded_at > self.ttl:
+                del self._indexes[organization]
+                return False, None
+            self._indexes.move_to_end(organization)
+            return True, index
+
+    def _store(self, organization: str, rows, started: float) -> Optional[OrganizationIndex]:
+        if len(rows) > self.max_rows:
+            index = None
+            metrics.incr('memory.index.too_large')
+        else:
+            index = OrganizationIndex.from_rows(rows)
+        metrics.incr('memory.index.loads')
+        metrics.observe('memory.index.load.seconds', time.perf_counter() - started)
+        with self._lock:
+            self._indexes[organization] = (time.monotonic(), index)
+            self._indexes.move_to_end(organization)
+            while len(self._indexes) > self.organizations:
+                self._indexes.popitem(last=False)
+        return index
+
+    def get(self, organization: str) -> Optional[OrganizationIndex]:
+        '''The organization's index, loaded if needed. None if it is too large to keep in memory.'''
+        found, index = self._cached(organization)
+        if found:
+            return index
+        started = time.perf_counter()
+        return self._store(organization, list(self._rows_query(organization)), started)
+
+    async def aget(self, organization: str) -> Optional[OrganizationIndex]:
+        found, index = self._cached(organization)
+        if found:
+            return index
+        started = time.perf_counter()
+        return self._store(organization, await adb.fetch(self._rows_query(organization)), started)
+
+    def refresh(self, organization: str) -> None:
+        '''Reload an organization after its memories changed, if it is loaded at all.'''
+        with self._lock:
+            loaded = self._indexes.pop(organization, None) is not None
+        if loaded:
+            self.get(organization)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+
+
+memory_index = MemoryIndex()
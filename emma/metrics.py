@@ -0,0 +1,65 @@
+# Description: Lightweight in-process counters and latency recorders
+import threading
+from collections import defaultdict, deque
+from typing import Dict
+
+import numpy as np
+
+
+class Metrics:
+    '''
+    Process-wide counters, gauges and latency windows. Values are kept in memory and
+    exposed through snapshot(); serve/metrics.py publishes them over HTTP.
+    '''
+    def __init__(self, window: int = 2048) -> None:
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._observations = defaultdict(lambda: deque(maxlen=self.window))
+
+    def incr(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            self._observations[name].append(value)
+
+    def counter(self, name: str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def summary(self, name: str) -> Dict[str, float]:
+        with self._lock:
+            values = np.array(self._observations.get(name, ()), dtype=np.float64)
+        if values.size == 0:
+            return {'count': 0}
+        return {'count': int(values.size),
+                'mean': float(values.mean()),
+                'p50': float(np.percentile(values, 50)),
+                'p95': float(np.percentile(values, 95)),
+                'p99': float(np.percentile(values, 99)),
+                'max': float(values.max())}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            names = list(self._observations)
+        return {'counters': counters,
+                'gauges': gauges,
+                'observations': {name: self.summary(name) for name in names}}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._observations.clear()
+
+
+metrics = Metrics()
@@ -1,20 +1,9 @@
-import os
 import datetime
 from peewee import *
-from playhouse.postgres_ext import PostgresqlExtDatabase, BinaryJSONField, ArrayField
-from dotenv import load_dotenv
+from playhouse.postgres_ext import BinaryJSONField, ArrayField
+from db import db
 from utils import make_table_name
 
-load_dotenv()
-
-db = PostgresqlExtDatabase(
-    os.getenv("DB_NAME"),
-    user=os.getenv("DB_USER"),
-    password=os.getenv("DB_PASSWORD"),
-    host=os.getenv("DB_HOST", "localhost"),
-    port=os.getenv("DB_PORT", 19032)
-)
-
 
 class BaseModel(Model):
     class Meta:
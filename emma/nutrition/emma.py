@@ -12,6 +12,7 @@ from prompt import get_food_nutrients_prompt, emma_glu_summary, emma_exercise_su
 from nutrition.model import NutritionMacro, NutritionMicro, NutritionMineral, EmmaComment, DietaryData, DietarySummary, UserPreferenceData, UserBasicInfo
 from nutrition.db import db, UserPreference, MealData, ExerciseData, ExerciseDatabase
 from serve.db import Product
+import adb
 from fastapi import HTTPException
 from utils import extract_json_from_text
 from logger import logger
@@ -24,7 +25,7 @@ BLOOM_KEY = os.getenv('BLOOM_KEY')
 async def analyze_food(user_id, image_base64: str, meal_type: int) -> list[NutritionMacro, NutritionMicro, NutritionMineral]:
     url = f"data:image/jpeg;base64,{image_base64}"
     # get products
-    products = get_products()
+    products = await aget_products()
     userinfo = await get_user_info(user_id, is_formated=False)
     if type(userinfo) is str:
         userinfo = {'pre_weight': 59.3, 'is_twin': False, 'height': 1.77, 'ga': 12}
@@ -143,9 +144,16 @@ async def get_user_preference_summary(user_id: str) -> str:
     return resp
 
         
-def get_products() -> str:
-    products = Product.select()
+def _format_products(products) -> str:
     return "\n".join([f"{i+1}. {p.name}: {p.brief}" for i, p in enumerate(products)])
+
+
+def get_products() -> str:
+    return _format_products(Product.select())
+
+
+async def aget_products() -> str:
+    return _format_products(await adb.fetch(Product.select()))
         
 
 async def get_user_info(user_id: str, is_formated=False) -> str:
@@ -196,12 +204,22 @@ def get_meal_data(user_id: str, date: datetime, offset: int) -> list[MealData]:
     return meals
 
 
+async def aget_meal_data(user_id: str, date: datetime, offset: int) -> list[MealData]:
+    return await adb.fetch(get_meal_data(user_id, date, offset))
+
+
 def calculate_nutrition_per_day(user_id: str, date: datetime) -> dict:
     '''
     Get 7 days meal record to calculate the nutrition from food per day
     '''
-    # get meal data
-    meals = get_meal_data(user_id, date, 7)
+    return _nutrition_per_day(get_meal_data(user_id, date, 7))
+
+
+async def acalculate_nutrition_per_day(user_id: str, date: datetime) -> dict:
+    return _nutrition_per_day(await aget_meal_data(user_id, date, 7))
+
+
+def _nutrition_per_day(meals) -> str:
     # group them by date
     # Group meals by day
     daily_totals = {}
@@ -0,0 +1,241 @@
+'''
+Organization partitions of the vector tables (see db.PartitionedModel) and the online
+operations that reshape them. infra/vector_partition.py is the command line front end.
+
+Both operations copy rows while the table stays in use: a trigger records the ids of rows
+written in the meantime, the bulk copy runs in small batches, the recorded rows are replayed
+and only the final replay and the switch run under a lock that blocks writes (reads go on).
+- convert: move a table created before partitioning into a partitioned copy and swap names.
+- split: give one organization its own LIST partition, taking its rows out of the DEFAULT one.
+'''
+import hashlib
+import re
+from typing import List, Optional
+
+from db import db, VECTOR_HASH_PARTITIONS
+from logger import logger
+
+COPY_BATCH = 5000
+
+CAPTURE_FUNCTION = '''
+CREATE OR REPLACE FUNCTION emma_capture_change() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    EXECUTE format('INSERT INTO %%I (id) VALUES ($1)', TG_ARGV[0])
+        USING CASE TG_OP WHEN 'DELETE' THEN OLD.id ELSE NEW.id END;
+    RETURN NULL;
+END $$
+'''
+
+
+def _literal(value: str) -> str:
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def partition_name(table, organization: str) -> str:
+    '''Name of the LIST partition that holds one organization.'''
+    slug = re.sub(r'[^a-z0-9_]', '_', organization.lower())
+    name = f'{table._meta.table_name}_org_{slug}'
+    if slug != organization or len(name) > 63:
+        # keep names unique when the organization had to be rewritten or truncated
+        name = f'{name[:56]}_{hashlib.sha1(organization.encode()).hexdigest()[:6]}'
+    return name
+
+
+def is_partitioned(table_name: str) -> bool:
+    return db.execute_sql("SELECT 1 FROM pg_class WHERE oid = to_regclass(%s) AND relkind = 'p'", (table_name,)).fetchone() is not None
+
+
+def leaf_partitions(table_name: str) -> List[str]:
+    '''The tables that actually hold rows, the table itself when it is not partitioned.'''
+    if not is_partitioned(table_name):
+        return [table_name]
+    cursor = db.execute_sql(
+        'WITH RECURSIVE tree AS (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(%s) '
+        'UNION ALL SELECT i.inhrelid FROM pg_inherits i JOIN tree t ON i.inhparent = t.inhrelid) '
+        "SELECT c.relname FROM tree JOIN pg_class c ON c.oid = tree.inhrelid WHERE c.relkind = 'r' ORDER BY c.relname",
+        (table_name,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def organization_partition(table, organization: str) -> Optional[str]:
+    '''The organization's own partition, None while it lives in the shared DEFAULT partition.'''
+    name = partition_name(table, organization)
+    row = db.execute_sql('SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s) AND inhparent = to_regclass(%s)',
+                         (name, table._meta.table_name)).fetchone()
+    return name if row else None
+
+
+def partitions(table) -> List[dict]:
+    '''Every partition with its bound, estimated rows and size, for spotting organizations to split out.'''
+    cursor = db.execute_sql(
+        'WITH RECURSIVE tree AS (SELECT inhrelid, 1 AS level FROM pg_inherits WHERE inhparent = to_regclass(%s) '
+        'UNION ALL SELECT i.inhrelid, t.level + 1 FROM pg_inherits i JOIN tree t ON i.inhparent = t.inhrelid) '
+        'SELECT c.relname, t.level, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint, pg_total_relation_size(c.oid) '
+        "FROM tree t JOIN pg_class c ON c.oid = t.inhrelid WHERE c.relkind = 'r' ORDER BY pg_total_relation_size(c.oid) DESC",
+        (table._meta.table_name,))
+    return [{'partition': name, 'level': level, 'bound': bound, 'rows': max(rows, 0), 'size_bytes': size}
+            for name, level, bound, rows, size in cursor.fetchall()]
+
+
+def _columns(table_name: str) -> str:
+    cursor = db.execute_sql('SELECT attname FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attnum > 0 '
+                            'AND NOT attisdropped ORDER BY attnum', (table_name,))
+    return ', '.join(row[0] for row in cursor.fetchall())
+
+
+class _OnlineCopy:
+    '''Copies the rows of source (of one organization, or all of them) into target while source takes writes.'''
+    def __init__(self, source: str, target: str, organization: Optional[str] = None) -> None:
+        self.source = source
+        self.target = target
+        self.organization = organization
+        self.condition = self._condition('organization')
+        self.log = f'{target[:50]}_changes'
+        self.columns = _columns(source)
+
+    def _condition(self, column: str) -> str:
+        return 'TRUE' if self.organization is None else f'{column} = {_literal(self.organization)}'
+
+    def capture(self) -> None:
+        # CREATE TRIGGER waits for writers already running, so every row is either committed
+        # before the bulk copy starts or recorded in the log
+        db.execute_sql(CAPTURE_FUNCTION)
+        db.execute_sql(f'CREATE UNLOGGED TABLE IF NOT EXISTS {self.log} (id integer NOT NULL)')
+        db.execute_sql(f'CREATE TRIGGER {self.log}_new AFTER INSERT OR UPDATE ON {self.source} FOR EACH ROW '
+                       f"WHEN ({self._condition('NEW.organization')}) EXECUTE FUNCTION emma_capture_change({_literal(self.log)})")
+        db.execute_sql(f'CREATE TRIGGER {self.log}_old AFTER UPDATE OR DELETE ON {self.source} FOR EACH ROW '
+                       f"WHEN ({self._condition('OLD.organization')}) EXECUTE FUNCTION emma_capture_change({_literal(self.log)})")
+
+    def bulk_copy(self) -> int:
+        # rows inserted after capture() are in the log, the copy does not chase them
+        until = db.execute_sql(f'SELECT max(id) FROM {self.source} WHERE {self.condition}').fetchone()[0]
+        copied, last = 0, -1
+        while until is not None:
+            with db.atomic():
+                cursor = db.execute_sql(
+                    f'WITH batch AS (SELECT {self.columns} FROM {self.source} WHERE {self.condition} AND id > %s AND id <= %s '
+                    f'ORDER BY id LIMIT {COPY_BATCH}), '
+                    f'ins AS (INSERT INTO {self.target} ({self.columns}) SELECT {self.columns} FROM batch ON CONFLICT DO NOTHING) '
+                    f'SELECT count(*), max(id) FROM batch', (last, until))
+                count, last_id = cursor.fetchone()
+            if not count:
+                return copied
+            copied += count
+            last = last_id
+            logger.info(f'{self.target}: {copied} rows copied')
+        return copied
+
+    def replay(self, limit: Optional[int] = COPY_BATCH) -> int:
+        '''
+        Bring the rows recorded in the log up to date in target, in batches of limit until a batch
+        comes back short. limit=None replays everything, which only ends under a write lock.
+        '''
+        replayed = 0
+        while True:
+            with db.atomic():
+                batch = f'SELECT ctid FROM {self.log}' + (f' LIMIT {limit}' if limit else '')
+                cursor = db.execute_sql(f'DELETE FROM {self.log} WHERE ctid IN ({batch}) RETURNING id')
+                logged = [row[0] for row in cursor.fetchall()]
+                ids = sorted(set(logged))
+                if ids:
+                    db.execute_sql(f'DELETE FROM {self.target} WHERE id = ANY(%s)', (ids,))
+                    db.execute_sql(f'INSERT INTO {self.target} ({self.columns}) SELECT {self.columns} FROM {self.source} '
+                                   f'WHERE {self.condition} AND id = ANY(%s)', (ids,))
+            replayed += len(ids)
+            if limit is None or len(logged) < limit:
+                return replayed
+
+    def drop_capture(self) -> None:
+        db.execute_sql(f'DROP TRIGGER IF EXISTS {self.log}_new ON {self.source}')
+        db.execute_sql(f'DROP TRIGGER IF EXISTS {self.log}_old ON {self.source}')
+        db.execute_sql(f'DROP TABLE IF EXISTS {self.log}')
+
+
+def _build_ann_indexes(table, partition: str) -> None:
+    # imported here, vector_index itself looks partitions up in this module
+    from vector_index import INDEXES, VectorIndex, create_index
+    for index in INDEXES:
+        if index.table is table:
+            create_index(VectorIndex(table, index.column, index.method, index.metric, index.params,
+                                     quantization=index.quantization, partition=partition))
+
+
+def split_organization(table, organization: str) -> str:
+    '''Move one organization out of the DEFAULT partition into a LIST partition of its own.'''
+    table_name = table._meta.table_name
+    if not is_partitioned(table_name):
+        raise ValueError(f'{table_name} is not partitioned yet, run convert first')
+    if organization_partition(table, organization):
+        raise ValueError(f'{organization} already has its own partition')
+    name = partition_name(table, organization)
+    # LIKE copies the indexes of the parent, ATTACH then adopts them instead of building new ones
+    db.execute_sql(f'CREATE TABLE IF NOT EXISTS {name} (LIKE {table_name} INCLUDING DEFAULTS INCLUDING INDEXES INCLUDING STORAGE)')
+    db.execute_sql(f'ALTER TABLE {name} DROP CONSTRAINT IF EXISTS {name}_organization')
+    # lets ATTACH skip scanning the new partition
+    db.execute_sql(f'ALTER TABLE {name} ADD CONSTRAINT {name}_organization CHECK (organization = {_literal(organization)})')
+    copy = _OnlineCopy(table_name, name, organization)
+    copy.capture()
+    try:
+        copy.bulk_copy()
+        _build_ann_indexes(table, name)
+        copy.replay()
+        with db.atomic():
+            # blocks writes for the rest of the transaction, reads go on
+            db.execute_sql(f'LOCK TABLE {table_name} IN EXCLUSIVE MODE')
+            copy.replay(limit=None)
+            db.execute_sql(f'DELETE FROM {table_name}_default WHERE organization = %s', (organization,))
+            # scans the DEFAULT partition once more to check nothing of the organization is left
+            db.execute_sql(f'ALTER TABLE {table_name} ATTACH PARTITION {name} FOR VALUES IN ({_literal(organization)})')
+    finally:
+        copy.drop_capture()
+    db.execute_sql(f'ANALYZE {name}')
+    return name
+
+
+def convert_table(model) -> str:
+    '''
+    Rebuild a table created before partitioning as a partitioned one. The old table is kept as
+    <table>_unpartitioned until it is dropped by hand.
+    '''
+    table_name = model._meta.table_name
+    if is_partitioned(table_name):
+        raise ValueError(f'{table_name} is already partitioned')
+    staging = f'{table_name}_partitioned'
+    db.execute_sql(f'CREATE TABLE IF NOT EXISTS {staging} (LIKE {table_name} INCLUDING DEFAULTS INCLUDING STORAGE) '
+                   f'PARTITION BY LIST (organization)')
+    db.execute_sql(f'ALTER TABLE {staging} DROP CONSTRAINT IF EXISTS {staging}_pkey')
+    db.execute_sql(f'ALTER TABLE {staging} ADD PRIMARY KEY (id, organization)')
+    model.create_default_partitions(staging)
+    # the secondary indexes are built while the copy is empty and kept up to date by the copy
+    renames = []
+    for index in model._meta.fields_to_index():
+        sql, params = model._schema._create_index(index, safe=True).query()
+        db.execute_sql(sql.replace(f'"{index._name}"', f'"{index._name}_p"').replace(f'ON "{table_name}"', f'ON "{staging}"'), params)
+        renames.append(index._name)
+    copy = _OnlineCopy(table_name, staging)
+    copy.capture()
+    try:
+        copy.bulk_copy()
+        for leaf in leaf_partitions(staging):
+            _build_ann_indexes(model, leaf)
+        copy.replay()
+        with db.atomic():
+            db.execute_sql(f'LOCK TABLE {table_name} IN EXCLUSIVE MODE')
+            copy.replay(limit=None)
+            copy.drop_capture()
+            for (name,) in db.execute_sql('SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s', (table_name,)).fetchall():
+                db.execute_sql(f'ALTER INDEX {name} RENAME TO {name[:48]}_unpartitioned')
+            db.execute_sql(f'ALTER TABLE {table_name} RENAME TO {table_name}_unpartitioned')
+            db.execute_sql(f'ALTER TABLE {staging} RENAME TO {table_name}')
+            for leaf in [f'{staging}_default'] + [f'{staging}_h{i}' for i in range(VECTOR_HASH_PARTITIONS)]:
+                db.execute_sql(f'ALTER TABLE {leaf} RENAME TO {leaf.replace(staging, table_name, 1)}')
+            # partition indexes (ANN ones included) are named after the staging tables
+            for (name,) in db.execute_sql('SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND indexname LIKE %s', (f'{staging}%',)).fetchall():
+                db.execute_sql(f'ALTER INDEX {name} RENAME TO {name.replace(staging, table_name, 1)}')
+            for name in renames:
+                db.execute_sql(f'ALTER INDEX {name}_p RENAME TO {name}')
+            db.execute_sql(f'ALTER SEQUENCE IF EXISTS {table_name}_id_seq OWNED BY {table_name}.id')
+    finally:
+        copy.drop_capture()
+    db.execute_sql(f'ANALYZE {table_name}')
+    return f'{table_name}_unpartitioned'
@@ -14,7 +14,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x15\x65mbedding_query.proto\x12\x0f\x65mbedding_query\"!\n\x0e\x45mbeddingQuery\x12\x0f\n\x07queries\x18\x01 \x03(\t\"2\n\x11\x45mbeddingResponse\x12\x1d\n\x15serialized_embeddings\x18\x01 \x01(\x0c\x32h\n\x10\x45mbeddingService\x12T\n\rGetEmbeddings\x12\x1f.embedding_query.EmbeddingQuery\x1a\".embedding_query.EmbeddingResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x15\x65mbedding_query.proto\x12\x0f\x65mbedding_query\"5\n\x0e\x45mbeddingQuery\x12\x0f\n\x07queries\x18\x01 \x03(\t\x12\x12\n\ndimensions\x18\x02 \x01(\x05\"2\n\x11\x45mbeddingResponse\x12\x1d\n\x15serialized_embeddings\x18\x01 \x01(\x0c\x32\xc5\x01\n\x10\x45mbeddingService\x12T\n\rGetEmbeddings\x12\x1f.embedding_query.EmbeddingQuery\x1a\".embedding_query.EmbeddingResponse\x12[\n\x10StreamEmbeddings\x12\x1f.embedding_query.EmbeddingQuery\x1a\".embedding_query.EmbeddingResponse(\x01\x30\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -22,9 +22,9 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'embedding_query_pb2', _glob
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_EMBEDDINGQUERY']._serialized_start=42
-  _globals['_EMBEDDINGQUERY']._serialized_end=75
-  _globals['_EMBEDDINGRESPONSE']._serialized_start=77
-  _globals['_EMBEDDINGRESPONSE']._serialized_end=127
-  _globals['_EMBEDDINGSERVICE']._serialized_start=129
-  _globals['_EMBEDDINGSERVICE']._serialized_end=233
+  _globals['_EMBEDDINGQUERY']._serialized_end=95
+  _globals['_EMBEDDINGRESPONSE']._serialized_start=97
+  _globals['_EMBEDDINGRESPONSE']._serialized_end=147
+  _globals['_EMBEDDINGSERVICE']._serialized_start=150
+  _globals['_EMBEDDINGSERVICE']._serialized_end=347
 # @@protoc_insertion_point(module_scope)
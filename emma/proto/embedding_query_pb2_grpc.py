@@ -44,6 +44,11 @@ class EmbeddingServiceStub(object):
                 request_serializer=embedding__query__pb2.EmbeddingQuery.SerializeToString,
                 response_deserializer=embedding__query__pb2.EmbeddingResponse.FromString,
                 _registered_method=True)
+        self.StreamEmbeddings = channel.stream_stream(
+                '/embedding_query.EmbeddingService/StreamEmbeddings',
+                request_serializer=embedding__query__pb2.EmbeddingQuery.SerializeToString,
+                response_deserializer=embedding__query__pb2.EmbeddingResponse.FromString,
+                _registered_method=True)
 
 
 class EmbeddingServiceServicer(object):
@@ -55,6 +60,13 @@ class EmbeddingServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def StreamEmbeddings(self, request_iterator, context):
+        """bulk ingestion: one response per query batch, in request order
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_EmbeddingServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -63,6 +75,11 @@ def add_EmbeddingServiceServicer_to_server(servicer, server):
                     request_deserializer=embedding__query__pb2.EmbeddingQuery.FromString,
                     response_serializer=embedding__query__pb2.EmbeddingResponse.SerializeToString,
             ),
+            'StreamEmbeddings': grpc.stream_stream_rpc_method_handler(
+                    servicer.StreamEmbeddings,
+                    request_deserializer=embedding__query__pb2.EmbeddingQuery.FromString,
+                    response_serializer=embedding__query__pb2.EmbeddingResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'embedding_query.EmbeddingService', rpc_method_handlers)
@@ -100,3 +117,30 @@ class EmbeddingService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def StreamEmbeddings(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/embedding_query.EmbeddingService/StreamEmbeddings',
+            embedding__query__pb2.EmbeddingQuery.SerializeToString,
+            embedding__query__pb2.EmbeddingResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -0,0 +1,128 @@
+'''
+Rerankers for retrieved chunks. rerank(query, texts, topk) returns (index, score) pairs,
+best first. The default is a local cross-encoder on CPU; the LLM reranker is kept as an
+option (RERANKER=llm).
+'''
+import asyncio
+import os
+from abc import ABC, abstractmethod
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import dotenv
+
+from logger import logger
+from metrics import metrics
+from utils import extract_json_from_text
+
+dotenv.load_dotenv()
+
+RERANKER = os.getenv('RERANKER', 'cross-encoder')
+RERANK_MODEL_PATH = os.getenv('RERANK_MODEL_PATH', 'BAAI/bge-reranker-base')
+RERANK_LLM_MODEL = os.getenv('RERANK_LLM_MODEL', 'qwen2-72b-instruct')
+RERANK_BATCH_SIZE = int(os.getenv('RERANK_BATCH_SIZE', 32))
+RERANK_MIN_SCORE = float(os.getenv('RERANK_MIN_SCORE')) if os.getenv('RERANK_MIN_SCORE') else None
+
+
+class Reranker(ABC):
+    @abstractmethod
+    def rerank(self, query: str, texts: List[str], topk: int = 5) -> List[Tuple[int, float]]:
+        ...
+
+    async def arerank(self, query: str, texts: List[str], topk: int = 5) -> List[Tuple[int, float]]:
+        return await asyncio.to_thread(self.rerank, query, texts, topk)
+
+
+class CrossEncoderReranker(Reranker):
+    '''Scores every (query, chunk) pair with a cross-encoder, in batches of batch_size.'''
+    def __init__(self, model_path: str = RERANK_MODEL_PATH, batch_size: int = RERANK_BATCH_SIZE,
+                 max_length: int = 512, min_score: float = RERANK_MIN_SCORE) -> None:
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.min_score = min_score
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        # loaded on the first rerank so importing retrieval code stays cheap
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_path, max_length=self.max_length, device='cpu')
+        return self._model
+
+    def rerank(self, query: str, texts: List[str], topk: int = 5) -> List[Tuple[int, float]]:
+        if not texts:
+            return []
+        model = self.model
+        start = time.perf_counter()
+        scores = model.predict([(query, text) for text in texts], batch_size=self.batch_size)
+        metrics.observe('rerank.cross_encoder.latency', time.perf_counter() - start)
+        ranked = sorted(enumerate(float(score) for score in scores), key=lambda item: -item[1])
+        if self.min_score is not None:
+            ranked = [item for item in ranked if item[1] >= self.min_score]
+        return ranked[:topk]
+
+
+def parse_ranking(answer: str, count: int, topk: int) -> List[Tuple[int, float]]:
+    '''(index, score) pairs from an LLM answer naming the 1-based ids of the best of count chunks.'''
+    try:
+        doc_ids = [int(doc_id) for doc_id in extract_json_from_text(answer or '').get('documents', [])]
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.error(f'LLM rerank returned an unusable answer: {e}')
+        return []
+    doc_ids = [doc_id for doc_id in dict.fromkeys(doc_ids) if 1 <= doc_id <= count][:topk]
+    # the LLM only gives an order, score by position
+    return [(doc_id - 1, 1.0 / rank) for rank, doc_id in enumerate(doc_ids, start=1)]
+
+
+class LLMReranker(Reranker):
+    '''The previous behaviour: ask an LLM for the ids of the most relevant numbered chunks.'''
+    def __init__(self, model: str = RERANK_LLM_MODEL) -> None:
+        self.model = model
+
+    async def arerank(self, query: str, texts: List[str], topk: int = 5) -> List[Tuple[int, float]]:
+        # litellm is only imported when the LLM reranker is actually used
+        from llm import llm
+        from prompt import rerank_prompt
+
+        if not texts:
+            return []
+        cleaned = [text.replace('#', '').replace('\n', '') for text in texts]
+        documents = ''.join(f'{i}. {text}\n' for i, text in enumerate(cleaned, start=1))
+        result = await llm(rerank_prompt().render(query=query, documents=documents, topk=topk), self.model, stream=False, is_text=True)
+        return parse_ranking(result, len(texts), topk)
+
+    def rerank(self, query: str, texts: List[str], topk: int = 5) -> List[Tuple[int, float]]:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.arerank(query, texts, topk))
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(asyncio.run, self.arerank(query, texts, topk)).result()
+
+
+RERANKERS = {
+    'cross-encoder': CrossEncoderReranker,
+    'llm': LLMReranker,
+}
+
+_rerankers = {}
+_rerankers_lock = threading.Lock()
+
+
+def get_reranker(name: str = None) -> Reranker:
+    '''One shared instance per reranker name, so the cross-encoder is loaded once per process.'''
+    name = name or RERANKER
+    if name not in RERANKERS:
+        raise ValueError(f'Unknown reranker {name!r}, expected one of {sorted(RERANKERS)}')
+    if name not in _rerankers:
+        with _rerankers_lock:
+            if name not in _rerankers:
+                _rerankers[name] = RERANKERS[name]()
+    return _rerankers[name]
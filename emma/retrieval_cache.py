@@ -0,0 +1,141 @@
+'''
+Redis cache for vector retrieval results, shared by every worker process.
+Entries are keyed by (organization, embedding model, splitter, normalised query, topk) and
+expire after RETRIEVAL_CACHE_TTL seconds. Each organization has a generation counter that is
+stored with every entry; bumping it (invalidate) makes all older entries of that organization
+misses without having to find and delete them.
+'''
+import hashlib
+import os
+import re
+import time
+import unicodedata
+from typing import List, Optional, Tuple
+
+import dotenv
+import orjson
+import redis
+
+from logger import logger
+from metrics import metrics
+
+dotenv.load_dotenv()
+
+# opt-in: without a Redis server every retrieval would pay for a failed connection
+RETRIEVAL_CACHE = os.getenv('RETRIEVAL_CACHE', '0') == '1'
+RETRIEVAL_CACHE_TTL = int(os.getenv('RETRIEVAL_CACHE_TTL', 600))
+# seconds the cache is skipped after Redis could not be reached
+RETRIEVAL_CACHE_COOLDOWN = float(os.getenv('RETRIEVAL_CACHE_COOLDOWN', 30))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+PREFIX = 'emma:retrieval'
+
+
+def normalize_query(query: str) -> str:
+    '''Fold width/case, collapse whitespace and drop trailing punctuation, so trivially different questions share an entry.'''
+    query = unicodedata.normalize('NFKC', query).casefold()
+    query = re.sub(r'\s+', ' ', query).strip()
+    return query.rstrip('?!.。？！~… ')
+
+
+class RetrievalCache:
+    def __init__(self, client: redis.Redis = None, ttl: int = RETRIEVAL_CACHE_TTL, prefix: str = PREFIX,
+                 cooldown: float = RETRIEVAL_CACHE_COOLDOWN) -> None:
+        self.client = client or redis.Redis.from_url(REDIS_URL)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.cooldown = cooldown
+        self._down_until = 0.0
+        # organizations whose invalidation failed; their entries are not served by this process
+        self._stale = set()
+
+    def _available(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+    def _failed(self, action: str, e: redis.RedisError) -> None:
+        metrics.incr('retrieval.cache.errors')
+        if isinstance(e, (redis.ConnectionError, redis.TimeoutError)):
+            self._down_until = time.monotonic() + self.cooldown
+            action += f', skipping the cache for {self.cooldown:.0f}s'
+        logger.error(f'Retrieval cache {action} failed: {e}')
+
+    def _generation_key(self, organization: str) -> str:
+        return f'{self.prefix}:gen:{organization}'
+
+    def key(self, organization: str, embedding_model: str, splitter: str, query: str, topk: int, variant: str = '') -> str:
+        digest = hashlib.sha256('\x00'.join([embedding_model, splitter, normalize_query(query), str(topk), variant]).encode('utf-8'))
+        return f'{self.prefix}:{organization}:{digest.hexdigest()}'
+
+    def _stat(self, pipe, name: str) -> None:
+        metrics.incr(f'retrieval.cache.{name}')
+        pipe.hincrby(f'{self.prefix}:stats', name, 1)
+
+    def get(self, organization: str, key: str) -> Tuple[Optional[List[dict]], int]:
+        '''Returns (chunks or None, current generation); pass the generation on to put().'''
+        if not self._available() or (organization in self._stale and not self.invalidate(organization)):
+            metrics.incr('retrieval.cache.skipped')
+            return None, -1
+        try:
+            raw, generation = self.client.mget(key, self._generation_key(organization))
+            generation = int(generation or 0)
+            entry = orjson.loads(raw) if raw else None
+            hit = entry is not None and entry['generation'] == generation
+            pipe = self.client.pipeline(transaction=False)
+            self._stat(pipe, 'hits' if hit else 'misses')
+            pipe.execute()
+        except redis.RedisError as e:
+            # a broken cache must never break retrieval
+            self._failed('get', e)
+            return None, -1
+        return (entry['chunks'] if hit else None), generation
+
+    def put(self, key: str, chunks: List[dict], generation: int) -> None:
+        # tagging with the generation read before the query keeps results computed
+        # across an invalidation from being served afterwards
+        if generation < 0 or not self._available():
+            return
+        try:
+            self.client.set(key, orjson.dumps({'generation': generation, 'chunks': chunks}), ex=self.ttl)
+        except redis.RedisError as e:
+            self._failed('put', e)
+
+    def invalidate(self, organization: str) -> bool:
+        '''
+        Make the organization's entries misses. Returns False when Redis could not be told; until a
+        later invalidation succeeds this process then skips the organization's entries, other
+        processes may serve them until they expire.
+        '''
+        try:
+            self.client.incr(self._generation_key(organization))
+        except redis.RedisError as e:
+            self._stale.add(organization)
+            metrics.incr('retrieval.cache.invalidation_failures')
+            self._failed(f'invalidation for {organization}', e)
+            return False
+        self._stale.discard(organization)
+        metrics.incr('retrieval.cache.invalidations')
+        return True
+
+    def stats(self) -> Optional[dict]:
+        '''Hit rate over all processes sharing the Redis instance, None when Redis cannot be reached.'''
+        try:
+            counts = {k.decode(): int(v) for k, v in self.client.hgetall(f'{self.prefix}:stats').items()}
+        except redis.RedisError as e:
+            self._failed('stats', e)
+            return None
+        hits, misses = counts.get('hits', 0), counts.get('misses', 0)
+        # failed invalidations are counted per process, like /v1/metrics
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+                'invalidation_failures': metrics.counter('retrieval.cache.invalidation_failures'),
+                'stale_organizations': sorted(self._stale)}
+
+
+_cache = None
+
+
+def get_retrieval_cache() -> Optional[RetrievalCache]:
+    global _cache
+    if not RETRIEVAL_CACHE:
+        return None
+    if _cache is None:
+        _cache = RetrievalCache()
+    return _cache
@@ -1,4 +1,4 @@
-from history import get_history
+from history import aget_history
 from prompt import router_prompt
 from pydantic import BaseModel
 from typing import List, Dict, Type
@@ -32,7 +32,7 @@ class UserIntentionRouter(Router):
         
     async def classify(self, query):
         # get history from redis
-        histories = get_history(self.user_id, self.session_id, limit=10)
+        histories = await aget_history(self.user_id, self.session_id, limit=10)
         if not histories:
             histories = []
         else:
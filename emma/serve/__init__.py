@@ -1 +1 @@
-__all__ = ['webapi', 'product', 'userinfo', 'emma']
\ No newline at end of file
+__all__ = ['webapi', 'product', 'userinfo', 'emma', 'metrics', 'lifecycle']
\ No newline at end of file
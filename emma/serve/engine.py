@@ -12,7 +12,7 @@ from typing import Dict, Any, AsyncGenerator
 import uuid
 import time
 from prompt import emma_chat, emma_future, emma_fitness, emma_nutrition, emma_format_chat
-from nutrition.emma import get_user_info, get_user_preference_summary, get_glu_summary, get_products, calculate_nutrition_per_day
+from nutrition.emma import get_user_info, get_user_preference_summary, get_glu_summary, aget_products, acalculate_nutrition_per_day
 from utils import extract_json_from_text
 
 
@@ -66,7 +66,7 @@ async def workflow(query: Query, config: str, websocket) -> AsyncGenerator[Dict[
             'userinfo': await get_user_info(config['user_id'], is_formated=True),
             'food_preference': await get_user_preference_summary(config['user_id']),
             'glu_summary': await get_glu_summary(config['user_id']),
-            'products': get_products()
+            'products': await aget_products()
         }
         async for chunk in emma_dietary_agent.act(question, 0, 'default', emma_nutrition, context, stream=False):
             response = chunk.choices[0].message.content
@@ -81,8 +81,8 @@ async def workflow(query: Query, config: str, websocket) -> AsyncGenerator[Dict[
             'userinfo': await get_user_info(config['user_id'], is_formated=True),
             'food_preference': await get_user_preference_summary(config['user_id']),
             'glu_summary': await get_glu_summary(config['user_id']),
-            'meal': calculate_nutrition_per_day(config['user_id'], datetime.datetime.now()),
-            'products': get_products()
+            'meal': await acalculate_nutrition_per_day(config['user_id'], datetime.datetime.now()),
+            'products': await aget_products()
         }
         async for chunk in emma_nutrition_agent.act(question, 0, 'default', emma_nutrition, context):
             response = chunk.choices[0].message.content
@@ -0,0 +1,27 @@
+import adb
+from db import db, release_connection
+
+
+class ReleaseConnection:
+    '''
+    ASGI middleware that returns the peewee connection to the pool when a request or a websocket
+    session ends. Async handlers share the event loop thread and its connection, none of them
+    keeps a transaction open across an await, so the connection can go back between requests.
+    Worker threads (asyncio.to_thread, thread pools) have connections of their own, which
+    db.in_worker_thread returns.
+    '''
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if scope['type'] in ('http', 'websocket'):
+                release_connection()
+
+
+def init_app(app):
+    app.add_middleware(ReleaseConnection)
+    app.add_event_handler('shutdown', adb.close)
+    app.add_event_handler('shutdown', db.close_all)
@@ -0,0 +1,35 @@
+import asyncio
+from fastapi import APIRouter
+from db import db
+from metrics import metrics
+from retrieval_cache import get_retrieval_cache
+
+
+router = APIRouter()
+
+
+@router.get("/v1/metrics")
+async def get_metrics():
+    return {"status": 1, "metrics": metrics.snapshot()}
+
+
+@router.get("/v1/metrics/retrieval_cache")
+async def get_retrieval_cache_metrics():
+    # counters kept in Redis cover every worker process, /v1/metrics only this one
+    cache = get_retrieval_cache()
+    if cache is None:
+        return {"status": 0, "message": "retrieval cache disabled"}
+    stats = await asyncio.to_thread(cache.stats)
+    if stats is None:
+        return {"status": 0, "message": "retrieval cache unavailable"}
+    return {"status": 1, "metrics": stats}
+
+
+@router.get("/v1/metrics/db_pool")
+async def get_db_pool_metrics():
+    # the peewee pool of this worker process; adb's asyncpg pool is separate
+    return {"status": 1, "metrics": db.stats()}
+
+
+def init_app(app):
+    app.include_router(router)
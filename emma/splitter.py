@@ -5,7 +5,6 @@ from docx import Document
 import os
 import uuid
 from peewee import IntegrityError
-from embedding import LocalEmbedding
 import time
 import hashlib
 from PIL import Image
@@ -0,0 +1,22 @@
+import peewee
+import pytest
+
+from db import db, Document, Vector1792
+
+
+@pytest.fixture
+def scratch_vector_table():
+    try:
+        db.connect(reuse_if_open=True)
+        if not db.execute_sql("SELECT 1 FROM pg_extension WHERE extname = 'vector'").fetchone():
+            pytest.skip('needs pgvector in the test database')
+    except (peewee.OperationalError, peewee.InterfaceError):
+        pytest.skip('needs a PostgreSQL test database')
+    # everything happens in a throwaway schema inside a transaction that is rolled back
+    with db.atomic() as transaction:
+        db.execute_sql('CREATE SCHEMA test_scratch')
+        db.execute_sql('SET LOCAL search_path TO test_scratch, public')
+        db.create_tables([Document, Vector1792])
+        yield Vector1792
+        transaction.rollback()
+    db.close()
@@ -0,0 +1,84 @@
+import asyncio
+import uuid
+
+import numpy as np
+import peewee
+import pytest
+
+import adb
+from db import db, Document, UserHistory, Vector1792
+from history import get_history
+from ingest import copy_rows
+from vector_index import cosine_distance
+
+SCHEMA = 'test_adb'
+
+
+@pytest.fixture
+def committed_tables():
+    # asyncpg connections only see committed rows, so this schema is really created and dropped
+    try:
+        db.connect(reuse_if_open=True)
+        if not db.execute_sql("SELECT 1 FROM pg_extension WHERE extname = 'vector'").fetchone():
+            pytest.skip('needs pgvector in the test database')
+    except (peewee.OperationalError, peewee.InterfaceError):
+        pytest.skip('needs a PostgreSQL test database')
+    db.execute_sql(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    db.execute_sql(f'CREATE SCHEMA {SCHEMA}')
+    db.execute_sql(f'SET search_path TO {SCHEMA}, public')
+    db.create_tables([UserHistory, Document, Vector1792])
+    yield
+    db.execute_sql(f'DROP SCHEMA {SCHEMA} CASCADE')
+    db.close()
+
+
+def test_placeholders_are_numbered():
+    sql, params = adb._sql(UserHistory.select().where((UserHistory.message % 'a%') & (UserHistory.role == 'user')))
+    assert '$1' in sql and '$2' in sql and '%s' not in sql
+    assert params == ['a%', 'user']
+
+
+@pytest.mark.parametrize('sql', [
+    "SELECT * FROM emma_user_history WHERE role = %s AND message = '100%s'",
+    "SELECT * FROM emma_user_history WHERE message = '100%s' AND role = %s",
+])
+def test_literal_placeholder_is_rejected(sql):
+    with pytest.raises(ValueError, match='2 placeholders for 1 parameters'):
+        adb._sql(UserHistory.raw(sql, 'user'))
+
+
+def test_rows_match_the_sync_path(committed_tables):
+    session_id = uuid.uuid4()
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((5, 1792)).astype(np.float32)
+    copy_rows(Vector1792, [Vector1792.doc_id, Vector1792.text, Vector1792.embedding, Vector1792.organization, Vector1792.meta],
+              [('d', f'chunk {i}', vector, 'org', {'page': i}) for i, vector in enumerate(vectors)])
+    Document.create(doc_id='d', filename='guide.md', organization='org')
+    query = (Vector1792.select(Vector1792.id, Vector1792.text, Vector1792.meta,
+                               cosine_distance(Vector1792.embedding, vectors[2]).alias('distance'), Document.filename)
+             .join(Document, on=(Vector1792.doc_id == Document.doc_id), attr='doc')
+             .where(Vector1792.organization == 'org').order_by(cosine_distance(Vector1792.embedding, vectors[2])).limit(3))
+
+    async def run():
+        try:
+            async with adb.transaction() as conn:
+                await conn.execute(f'SET LOCAL search_path TO {SCHEMA}, public')
+                for i, role in enumerate(['user', 'assistant', 'user']):
+                    await adb.create(UserHistory, conn, user_id='u', session_id=session_id, role=role,
+                                     message=f'message {i}', state='0')
+                rows = await adb.fetch(query, conn)
+            async with adb.transaction() as conn:
+                await conn.execute(f'SET LOCAL search_path TO {SCHEMA}, public')
+                history = await adb.fetch(UserHistory.select().where(UserHistory.session_id == session_id), conn)
+            return rows, history
+        finally:
+            await adb.close()
+
+    rows, history = asyncio.run(run())
+    expected = list(query)
+    assert [(row.id, row.text, row.meta, row.doc.filename) for row in rows] == [
+        (row.id, row.text, row.meta, row.doc.filename) for row in expected]
+    assert np.allclose([row.distance for row in rows], [row.distance for row in expected])
+    assert [row.message for row in history] == ['message 0', 'message 1', 'message 2']
+    assert history[0].session_id == session_id and history[0].is_deleted is False
+    assert get_history('u', session_id)['history'][1] == {'role': 'assistant', 'content': 'message 1'}
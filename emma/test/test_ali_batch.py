@@ -0,0 +1,120 @@
+import gzip
+import os
+import random
+import shutil
+
+import numpy as np
+import orjson
+import pytest
+
+import embedding_ali_batch
+from embedding_ali_batch import AliBatchPipeline, job_id
+
+
+def vector(text, dim=8):
+    rng = np.random.default_rng(abs(hash(text)) % (2 ** 32))
+    return rng.standard_normal(dim).astype(np.float32)
+
+
+class LocalStore:
+    def __init__(self, root):
+        self.root = root
+
+    def upload(self, file_path, object_name):
+        target = os.path.join(self.root, object_name)
+        shutil.copy(file_path, target)
+        return f'file://{target}'
+
+
+class LocalService:
+    '''Stands in for BatchTextEmbedding: jobs finish after a few polls with shuffled result lines.'''
+    def __init__(self, root, polls=2, fail=False):
+        self.root = root
+        self.polls = polls
+        self.fail = fail
+        self.tasks = {}
+        self.submitted = 0
+
+    def submit(self, url):
+        self.submitted += 1
+        task_id = f'task-{self.submitted}'
+        with open(url[len('file://'):], encoding='utf-8') as f:
+            texts = f.read().split('\n')
+        self.tasks[task_id] = [texts, 0]
+        return task_id
+
+    def fetch(self, task_id):
+        task = self.tasks[task_id]
+        task[1] += 1
+        if task[1] <= self.polls:
+            return 'RUNNING', None
+        if self.fail:
+            return 'FAILED', None
+        lines = [orjson.dumps({'output': {'code': 200, 'text_index': i, 'embedding': vector(text).tolist()}})
+                 for i, text in enumerate(task[0])]
+        random.shuffle(lines)
+        path = os.path.join(self.root, f'{task_id}.txt.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(b'\n'.join(lines))
+        return 'SUCCEEDED', f'file://{path}'
+
+
+@pytest.fixture
+def pipeline_args(tmp_path):
+    (tmp_path / 'store').mkdir()
+    return {'store': LocalStore(str(tmp_path / 'store')), 'state_dir': str(tmp_path / 'state'),
+            'poll_interval': 0.001, 'max_poll_interval': 0.01}
+
+
+def test_batch_pipeline_aligns_results_across_jobs(tmp_path, pipeline_args):
+    service = LocalService(str(tmp_path))
+    pipeline = AliBatchPipeline(service=service, job_size=7, max_jobs=3, **pipeline_args)
+    texts = [f'text {i}' for i in range(30)]
+    matrix = pipeline.embedding(texts)
+    assert matrix.shape == (30, 8)
+    assert service.submitted == 5
+    np.testing.assert_allclose(matrix, np.stack([vector(text) for text in texts]))
+
+
+def test_batch_pipeline_resumes_instead_of_resubmitting(tmp_path, pipeline_args):
+    service = LocalService(str(tmp_path), polls=1000)
+    texts = ['a', 'b', 'c']
+    pipeline = AliBatchPipeline(service=service, timeout=0.05, **pipeline_args)
+    with pytest.raises(TimeoutError):
+        pipeline.embedding(texts)
+    assert service.submitted == 1
+    # a new process picks up the persisted task id and keeps polling it
+    service.polls = 0
+    matrix = AliBatchPipeline(service=service, **pipeline_args).embedding(texts)
+    assert service.submitted == 1
+    np.testing.assert_allclose(matrix, np.stack([vector(text) for text in texts]))
+    # finished jobs are served from the saved matrix
+    AliBatchPipeline(service=service, **pipeline_args).embedding(texts)
+    assert service.submitted == 1
+
+
+def test_failed_job_is_resubmitted_on_next_run(tmp_path, pipeline_args):
+    service = LocalService(str(tmp_path), fail=True)
+    pipeline = AliBatchPipeline(service=service, **pipeline_args)
+    with pytest.raises(RuntimeError):
+        pipeline.embedding(['x', 'y'])
+    assert 'task_id' not in pipeline.load_state(job_id(pipeline.model, ['x', 'y']))
+    service.fail = False
+    assert pipeline.embedding(['x', 'y']).shape == (2, 8)
+    assert service.submitted == 2
+
+
+def test_input_store_is_built_for_the_bucket_on_first_submit(tmp_path, pipeline_args, monkeypatch):
+    buckets = []
+    root = pipeline_args.pop('store').root
+
+    class RecordingStore(LocalStore):
+        def __init__(self, bucket_name):
+            buckets.append(bucket_name)
+            super().__init__(root)
+
+    monkeypatch.setattr(embedding_ali_batch, 'S3InputStore', RecordingStore)
+    pipeline = AliBatchPipeline(service=LocalService(str(tmp_path)), bucket_name='faq-embedding', **pipeline_args)
+    assert buckets == []
+    assert pipeline.embedding(['x', 'y']).shape == (2, 8)
+    assert buckets == ['faq-embedding']
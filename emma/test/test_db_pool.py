@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import time
+
+import peewee
+import pytest
+
+from db import db, in_worker_thread, HealthCheckedPool
+from metrics import metrics
+
+APPLICATION = 'emma_test_pool'
+
+
+@pytest.fixture
+def pool():
+    try:
+        db.connect(reuse_if_open=True)
+    except (peewee.OperationalError, peewee.InterfaceError):
+        pytest.skip('needs a PostgreSQL test database')
+    params = dict(db.connect_params, application_name=APPLICATION)
+    pool = HealthCheckedPool(db.database, max_connections=4, stale_timeout=60, timeout=10, ping_after=0, **params)
+    yield pool
+    pool.close_all()
+    db.close()
+
+
+def backends() -> int:
+    return db.execute_sql('SELECT count(*) FROM pg_stat_activity WHERE application_name = %s', (APPLICATION,)).fetchone()[0]
+
+
+def test_connection_count_stays_bounded_under_load(pool):
+    stop = threading.Event()
+    errors = []
+
+    def request():
+        while not stop.is_set():
+            try:
+                with pool.connection_context():
+                    pool.execute_sql('SELECT pg_sleep(0.002)')
+            except Exception as e:
+                errors.append(e)
+                return
+
+    workers = [threading.Thread(target=request, daemon=True) for _ in range(12)]
+    for worker in workers:
+        worker.start()
+    counts = []
+    deadline = time.monotonic() + 2
+    while time.monotonic() < deadline:
+        counts.append(backends())
+        time.sleep(0.05)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    assert not errors
+    assert max(counts) <= 4
+    stats = pool.stats()
+    assert stats['created'] <= 4 and stats['in_use'] == 0 and stats['waiting'] == 0
+    assert stats['idle'] == backends()
+
+
+def test_dropped_connection_is_replaced(pool):
+    with pool.connection_context():
+        pid = pool.execute_sql('SELECT pg_backend_pid()').fetchone()[0]
+    db.execute_sql('SELECT pg_terminate_backend(%s)', (pid,))
+    failed = metrics.counter('db.pool.health_check_failed')
+    with pool.connection_context():
+        assert pool.execute_sql('SELECT pg_backend_pid()').fetchone()[0] != pid
+    assert metrics.counter('db.pool.health_check_failed') == failed + 1
+    assert pool.stats()['created'] == 2
+
+
+def test_worker_threads_return_their_connections(pool):
+    in_use = db.stats()['in_use']
+
+    async def queries():
+        await asyncio.gather(*[asyncio.to_thread(in_worker_thread, db.execute_sql, 'SELECT 1') for _ in range(8)])
+
+    asyncio.run(queries())
+    assert db.stats()['in_use'] == in_use
@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from embedding_batch import BatchScheduler
+
+
+def fake_encode(calls):
+    def encode(inputs):
+        calls.append(len(inputs))
+        time.sleep(0.01)
+        return np.array([[len(text)] for text in inputs], dtype=np.float32)
+    return encode
+
+
+def test_concurrent_requests_are_merged_and_split_back():
+    calls = []
+    scheduler = BatchScheduler(fake_encode(calls), max_batch_size=16, max_wait_ms=20)
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        results = list(pool.map(lambda i: scheduler.encode(['x' * i, 'y' * (i + 1)]), range(32)))
+    scheduler.close()
+    for i, result in enumerate(results):
+        assert result[:, 0].tolist() == [i, i + 1]
+    assert sum(calls) == 64
+    assert len(calls) < 32
+    assert max(calls) <= 16
+
+
+def test_oversized_request_runs_alone():
+    calls = []
+    scheduler = BatchScheduler(fake_encode(calls), max_batch_size=4, max_wait_ms=1)
+    assert scheduler.encode(['a'] * 10).shape == (10, 1)
+    scheduler.close()
+    assert calls == [10]
+
+
+def test_encode_errors_reach_every_caller():
+    def broken(inputs):
+        raise ValueError('model failed')
+    scheduler = BatchScheduler(broken, max_wait_ms=1)
+    with pytest.raises(ValueError):
+        scheduler.encode(['a'])
+    scheduler.close()
@@ -0,0 +1,103 @@
+import asyncio
+
+import numpy as np
+
+from embedding import AliEmbedding
+from embedding_cache import CachedEmbedding, DiskVectorStore, EmbeddingCache, cache_key
+
+
+class CountingBackend:
+    def __init__(self):
+        self.calls = []
+
+    def embedding(self, inputs):
+        self.calls.append(list(inputs))
+        return [np.full(4, len(text), dtype=np.float32) for text in inputs]
+
+
+def test_only_missing_texts_reach_the_backend(tmp_path):
+    backend = CountingBackend()
+    cached = CachedEmbedding(backend, cache=EmbeddingCache(size=10, cache_dir=str(tmp_path)))
+    first = cached.embeddings(inputs=['a', 'bb', 'a'])
+    second = cached.embeddings(inputs=['bb', 'ccc'])
+    assert [v[0] for v in first] == [1, 2, 1]
+    assert [v[0] for v in second] == [2, 3]
+    assert backend.calls == [['a', 'bb'], ['ccc']]
+    assert cached.name == 'CountingBackend'
+
+
+def test_disk_tier_survives_a_new_process_cache(tmp_path):
+    backend = CountingBackend()
+    CachedEmbedding(backend, cache=EmbeddingCache(size=1, cache_dir=str(tmp_path))).embeddings(inputs=['a', 'bb'])
+    cached = CachedEmbedding(backend, cache=EmbeddingCache(size=1, cache_dir=str(tmp_path)))
+    assert [v[0] for v in cached.embeddings(inputs=['a', 'bb'])] == [1, 2]
+    assert backend.calls == [['a', 'bb']]
+
+
+def test_disk_tier_evicts_oldest_when_full(tmp_path):
+    backend = CountingBackend()
+    cache = EmbeddingCache(size=1, cache_dir=str(tmp_path), disk_capacity=2)
+    cached = CachedEmbedding(backend, cache=cache)
+    cached.embeddings(inputs=['a', 'bb', 'ccc'])
+    cached.embeddings(inputs=['a'])
+    assert backend.calls == [['a', 'bb', 'ccc'], ['a']]
+
+
+def test_cache_version_separates_entries(tmp_path):
+    old, new = CountingBackend(), CountingBackend()
+    old.cache_version, new.cache_version = 'm-torch-v1', 'm-onnx-int8-v1'
+    CachedEmbedding(old, cache=EmbeddingCache(size=1, cache_dir=str(tmp_path))).embeddings(inputs=['a'])
+    cached = CachedEmbedding(new, cache=EmbeddingCache(size=1, cache_dir=str(tmp_path)))
+    cached.embeddings(inputs=['a'])
+    assert cached.cache_name == 'CountingBackend/m-onnx-int8-v1'
+    assert new.calls == [['a']]
+
+
+def test_cached_rows_do_not_keep_the_response_alive(tmp_path):
+    class BatchBackend:
+        def embedding(self, inputs):
+            response = np.ones((len(inputs), 4), dtype=np.float32)
+            response.flags.writeable = False
+            return list(response)
+
+    cached = CachedEmbedding(BatchBackend(), cache=EmbeddingCache(size=10, cache_dir=''))
+    vectors = cached.embeddings(inputs=['a', 'bb'])
+    assert all(vector.base is None for vector in vectors)
+
+
+def test_slot_overwritten_during_read_is_a_miss(tmp_path):
+    store = DiskVectorStore(str(tmp_path), 4, capacity=1)
+    key, other = cache_key('m', 'a'), cache_key('m', 'b')
+    store.put(key, np.ones(4, dtype=np.float32))
+
+    class Overwriting(np.memmap):
+        # another process takes the slot while the vector is being copied
+        def __getitem__(self, item):
+            vector = super().__getitem__(item)
+            store.keys[0] = np.frombuffer(other, dtype=np.uint8)
+            return vector
+
+    store.vectors = store.vectors.view(Overwriting)
+    assert store.get(key) is None
+    assert key not in store.index
+
+
+class SingleTextDashscope:
+    '''The part of dashscope AliEmbedding uses for a single text.'''
+    class TextEmbedding:
+        class Models:
+            text_embedding_v2 = 'text-embedding-v2'
+
+        @staticmethod
+        def call(model, input):
+            response = {'output': {'embeddings': [{'embedding': [float(len(input)), 1.0]}]}}
+            return type('Response', (dict,), {'status_code': 200})(response)
+
+
+def test_a_single_miss_reaches_the_ali_backend_as_one_vector(tmp_path):
+    backend = AliEmbedding.__new__(AliEmbedding)
+    backend.dashscope = SingleTextDashscope
+    cached = CachedEmbedding(backend, cache=EmbeddingCache(size=10, cache_dir=''))
+    cached.cache.put(cached.cache_name, 'a', np.zeros(2))
+    assert [v[0] for v in cached.embeddings(inputs=['a', 'bb'])] == [0, 2]
+    assert [v[0] for v in asyncio.run(cached.aembeddings(inputs=['a', 'ccc']))] == [0, 3]
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import orjson
+import pytest
+
+onnx = pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+tokenizers = pytest.importorskip('tokenizers')
+
+import embedding_onnx
+from embedding_onnx import CONFIG_FILE, MODEL_FILE, QUANTIZED_FILE, OnnxEncoder, load_encoder
+from onnx import TensorProto, helper, numpy_helper
+
+VOCAB = {'[PAD]': 0, '[UNK]': 1, 'a': 2, 'b': 3, 'c': 4}
+# one row per token: a, b and c each point along their own axis, padding is all zeros
+TABLE = np.array([[0, 0, 0], [1, 1, 1], [2, 0, 0], [0, 2, 0], [0, 0, 2]], dtype=np.float32)
+
+
+def write_graph(path, table):
+    '''Mean pooling of a token embedding table over the attention mask, the shape of a SentenceTransformer export.'''
+    nodes = [
+        helper.make_node('Gather', ['table', 'input_ids'], ['tokens']),
+        helper.make_node('Cast', ['attention_mask'], ['mask'], to=TensorProto.FLOAT),
+        helper.make_node('Unsqueeze', ['mask', 'last'], ['mask3']),
+        helper.make_node('Mul', ['tokens', 'mask3'], ['masked']),
+        helper.make_node('ReduceSum', ['masked', 'sequence'], ['summed'], keepdims=0),
+        helper.make_node('ReduceSum', ['mask3', 'sequence'], ['count'], keepdims=0),
+        helper.make_node('Div', ['summed', 'count'], ['sentence_embedding']),
+    ]
+    graph = helper.make_graph(
+        nodes, 'mean_pooling',
+        [helper.make_tensor_value_info(name, TensorProto.INT64, ['batch', 'sequence'])
+         for name in ('input_ids', 'attention_mask')],
+        [helper.make_tensor_value_info('sentence_embedding', TensorProto.FLOAT, ['batch', table.shape[1]])],
+        initializer=[numpy_helper.from_array(table, 'table'),
+                     numpy_helper.from_array(np.array([2], dtype=np.int64), 'last'),
+                     numpy_helper.from_array(np.array([1], dtype=np.int64), 'sequence')])
+    # IR 8 loads on every onnxruntime that supports opset 13
+    onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)], ir_version=8), path)
+
+
+@pytest.fixture
+def onnx_dir(tmp_path):
+    # laid out like <model_path>/onnx, where load_encoder looks by default
+    tmp_path = tmp_path / 'onnx'
+    tmp_path.mkdir()
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel(VOCAB, unk_token='[UNK]'))
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    tokenizer.save(str(tmp_path / 'tokenizer.json'))
+    (tmp_path / CONFIG_FILE).write_bytes(orjson.dumps({'dim': 3, 'max_seq_length': 8, 'pad_token_id': 0, 'pad_token': '[PAD]'}))
+    write_graph(str(tmp_path / MODEL_FILE), TABLE)
+    # the "quantized" graph is told apart by its doubled table
+    write_graph(str(tmp_path / QUANTIZED_FILE), TABLE * 2)
+    return tmp_path
+
+
+class FakeSentenceTransformer:
+    def __init__(self, model_path, **kwargs):
+        self.model_path = model_path
+
+
+@pytest.fixture
+def torch_encoder(monkeypatch):
+    sentence_transformers = pytest.importorskip('sentence_transformers')
+    monkeypatch.setattr(sentence_transformers, 'SentenceTransformer', FakeSentenceTransformer)
+
+
+def test_mean_pooling_ignores_padding_and_keeps_input_order(onnx_dir):
+    encoder = OnnxEncoder(str(onnx_dir), threads=1, batch_size=2)
+    assert encoder.get_sentence_embedding_dimension() == 3
+    # lengths are mixed so the length-sorted batches pad the short inputs
+    embeddings = encoder.encode(['a', 'a b c', 'b', 'c c'])
+    np.testing.assert_allclose(embeddings, [[2, 0, 0], [2 / 3, 2 / 3, 2 / 3], [0, 2, 0], [0, 0, 2]], rtol=1e-6)
+    assert embeddings.dtype == np.float32
+
+
+def test_normalize_embeddings(onnx_dir):
+    encoder = OnnxEncoder(str(onnx_dir), threads=1)
+    embeddings = encoder.encode(['a', 'a b'], normalize_embeddings=True)
+    np.testing.assert_allclose(embeddings, [[1, 0, 0], [2 ** -0.5, 2 ** -0.5, 0]], rtol=1e-6)
+    np.testing.assert_allclose(encoder.encode('b', normalize_embeddings=True), [[0, 1, 0]], rtol=1e-6)
+    assert encoder.encode([]).shape == (0, 3)
+
+
+@pytest.mark.parametrize('engine, model_file, scale', [('onnx', MODEL_FILE, 1), ('onnx-int8', QUANTIZED_FILE, 2)])
+def test_load_encoder_picks_the_graph_for_the_engine(onnx_dir, engine, model_file, scale):
+    encoder = load_encoder('/models/unused', engine, str(onnx_dir))
+    assert isinstance(encoder, OnnxEncoder)
+    assert encoder.model_file == os.path.join(str(onnx_dir), model_file)
+    np.testing.assert_allclose(encoder.encode(['a']), [[2 * scale, 0, 0]], rtol=1e-6)
+
+
+def test_load_encoder_looks_in_the_model_onnx_dir(onnx_dir):
+    encoder = load_encoder(str(onnx_dir.parent), 'onnx')
+    assert encoder.model_file == os.path.join(str(onnx_dir), MODEL_FILE)
+
+
+def test_load_encoder_rejects_unknown_engines():
+    with pytest.raises(ValueError, match='Unknown embedding engine'):
+        load_encoder('/models/unused', 'tensorrt')
+
+
+def test_missing_graph_falls_back_to_torch(onnx_dir, torch_encoder):
+    os.remove(onnx_dir / QUANTIZED_FILE)
+    encoder = load_encoder('/models/xiaobu', 'onnx-int8', str(onnx_dir))
+    assert isinstance(encoder, FakeSentenceTransformer)
+    assert encoder.model_path == '/models/xiaobu'
+    # the fp32 graph is still there and still used
+    assert isinstance(load_encoder('/models/xiaobu', 'onnx', str(onnx_dir)), OnnxEncoder)
+
+
+def test_missing_onnxruntime_falls_back_to_torch(onnx_dir, torch_encoder, monkeypatch):
+    find_spec = embedding_onnx.importlib.util.find_spec
+    monkeypatch.setattr(embedding_onnx.importlib.util, 'find_spec',
+                        lambda name, *args: None if name == 'onnxruntime' else find_spec(name, *args))
+    encoder = load_encoder('/models/xiaobu', 'onnx', str(onnx_dir))
+    assert isinstance(encoder, FakeSentenceTransformer)
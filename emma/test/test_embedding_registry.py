@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import embedding_registry
+from embedding_registry import get_backend, load_backend, register_backend
+
+EMMA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Counting:
+    created = 0
+
+    def __init__(self):
+        Counting.created += 1
+
+
+def test_backends_are_created_once_on_first_use():
+    register_backend('counting', f'{__name__}:Counting')
+    assert Counting.created == 0
+    assert get_backend('counting') is get_backend('counting')
+    assert Counting.created == 1
+    register_backend('counting-class', f'{__name__}:Counting', instantiate=False)
+    assert get_backend('counting-class') is Counting
+    with pytest.raises(ValueError):
+        load_backend('missing')
+    embedding_registry.BACKENDS.pop('counting')
+    embedding_registry.BACKENDS.pop('counting-class')
+
+
+def test_importing_embedding_does_not_load_providers():
+    code = ('import sys, embedding; '
+            'print(",".join(m for m in ("torch", "sentence_transformers", "dashscope", "volcengine", "ollama", "fastapi") '
+            'if m in sys.modules))')
+    proc = subprocess.run([sys.executable, '-c', code], cwd=EMMA_DIR, capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip() == ''
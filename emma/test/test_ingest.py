@@ -0,0 +1,124 @@
+import struct
+import threading
+import time
+import weakref
+from types import SimpleNamespace
+
+import numpy as np
+import peewee
+import pytest
+
+from db import db, Document, Vector1792
+from ingest import COPY_HEADER, COPY_TRAILER, IngestionPipeline, diff_chunks, encode_copy
+
+
+def test_encode_copy_binary_layout():
+    fields = [Vector1792._meta.fields[name] for name in ('doc_id', 'embedding', 'meta', 'embedding_short')]
+    vector = np.array([1.0, -0.5, 0.25], dtype=np.float32)
+    data = encode_copy(fields, [('孕', vector, {'a': 1}, None)])
+    assert data.startswith(COPY_HEADER) and data.endswith(COPY_TRAILER)
+    body = data[len(COPY_HEADER):-len(COPY_TRAILER)]
+    expected = (struct.pack('!h', 4)
+                + struct.pack('!i', 3) + '孕'.encode('utf-8')
+                + struct.pack('!ihh', 4 + 12, 3, 0) + vector.astype('>f4').tobytes()
+                + struct.pack('!i', 8) + b'\x01{"a":1}'
+                + struct.pack('!i', -1))
+    assert body == expected
+
+
+def test_diff_chunks_keeps_matching_rows_once():
+    meta = {'embedding_model': 'LocalEmbedding', 'sentence_splitter': 'Llamaindex'}
+    other_model = dict(meta, embedding_model='OllamaEmbedding')
+    existing = [(1, 'a', meta), (2, 'b', meta), (3, 'b', meta), (4, 'c', other_model), (5, 'gone', meta)]
+    todo, stale = diff_chunks(existing, ['a', 'b', 'c', 'new', 'a'], meta)
+    # 'c' was embedded by another model, the second 'a' has no row left to reuse
+    assert todo == [2, 3, 4]
+    assert len(stale) == 3 and {4, 5} < set(stale)
+
+
+SCHEMA = 'test_ingest'
+
+
+class SlowEmbedding:
+    def stream_embeddings(self, batches):
+        for batch in batches:
+            time.sleep(0.2)
+            yield np.ones((len(batch), 1792), dtype=np.float32)
+
+
+class PreSplit:
+    embedding_model = SlowEmbedding()
+
+    def split_document(self, document):
+        return document.chunks, {'embedding_model': 'test', 'sentence_splitter': 'test'}
+
+
+@pytest.fixture
+def committed_vector_table():
+    # the ingestions run on connections of their own, so the tables are really created and dropped
+    try:
+        db.connect(reuse_if_open=True)
+        if not db.execute_sql("SELECT 1 FROM pg_extension WHERE extname = 'vector'").fetchone():
+            pytest.skip('needs pgvector in the test database')
+    except (peewee.OperationalError, peewee.InterfaceError):
+        pytest.skip('needs a PostgreSQL test database')
+    db.execute_sql(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    db.execute_sql(f'CREATE SCHEMA {SCHEMA}')
+    db.execute_sql(f'SET search_path TO {SCHEMA}, public')
+    db.create_tables([Document, Vector1792])
+    yield Vector1792
+    db.execute_sql(f'DROP SCHEMA {SCHEMA} CASCADE')
+    db.execute_sql('RESET search_path')
+    db.close()
+
+
+def test_concurrent_first_ingestion_writes_once(committed_vector_table):
+    document = SimpleNamespace(doc_id='d', metadata={'organization': 'org', 'filename': 'd.md'},
+                               chunks=[f'chunk {i}' for i in range(6)])
+    pipeline = IngestionPipeline(PreSplit(), committed_vector_table, batch_size=2)
+    errors = []
+
+    def ingest():
+        try:
+            db.connect()
+            db.execute_sql(f'SET search_path TO {SCHEMA}, public')
+            pipeline.ingest(document)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=ingest) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert committed_vector_table.select().where(committed_vector_table.doc_id == 'd').count() == 6
+
+
+class CountingEmbedding:
+    '''Records how many of the batches it produced are still alive whenever it produces the next.'''
+    def __init__(self):
+        self.produced = []
+        self.most_alive = 0
+
+    def stream_embeddings(self, batches):
+        for batch in batches:
+            self.most_alive = max(self.most_alive, sum(ref() is not None for ref in self.produced))
+            embeddings = np.ones((len(batch), 1792), dtype=np.float32)
+            self.produced.append(weakref.ref(embeddings))
+            yield embeddings
+
+
+def test_ingestion_holds_a_bounded_number_of_batches(committed_vector_table):
+    vectorization = PreSplit()
+    vectorization.embedding_model = CountingEmbedding()
+    document = SimpleNamespace(doc_id='big', metadata={'organization': 'org', 'filename': 'big.md'},
+                               chunks=[f'chunk {i}' for i in range(60)])
+    pipeline = IngestionPipeline(vectorization, committed_vector_table, batch_size=2, queue_size=2)
+    report = pipeline.ingest(document)
+    assert report.embedded == 60 and len(vectorization.embedding_model.produced) == 30
+    # the queue, the batch being written and the one being queued
+    assert vectorization.embedding_model.most_alive <= 4
+    assert committed_vector_table.select().where(committed_vector_table.doc_id == 'big').count() == 60
@@ -0,0 +1,112 @@
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+# agent.memory pulls in the docx loader and litellm
+pytest.importorskip('docx')
+pytest.importorskip('litellm')
+from agent import memory
+from agent.memory import Memory
+from db import db, MemoryModel
+from metrics import metrics
+
+COUNTERS = ['memory.think.llm_calls', 'memory.think.llm_avoided', 'memory.think.llm_avoided.accept',
+            'memory.think.llm_avoided.reject', 'memory.think.llm_avoided.empty']
+
+
+@pytest.fixture
+def think(monkeypatch):
+    '''athink_about over the given (similarity, ans) matches; returns (answer, counter deltas, LLM prompts).'''
+    monkeypatch.setattr(memory, 'MEMORY_ACCEPT_SIMILARITY', 0.95)
+    monkeypatch.setattr(memory, 'MEMORY_REJECT_SIMILARITY', 0.5)
+
+    def run(matches, llm_answer=None):
+        memories = [SimpleNamespace(text=f'question {i}', ans=ans, similarity=similarity)
+                    for i, (similarity, ans) in enumerate(matches, start=1)]
+        prompts = []
+
+        async def asearch_memory(organization, query, topk=10):
+            return memories
+
+        async def llm(prompt, **kwargs):
+            prompts.append(prompt)
+            return llm_answer
+
+        monkeypatch.setattr(Memory, 'asearch_memory', asearch_memory)
+        monkeypatch.setattr(memory, 'llm', llm)
+        before = {name: metrics.counter(name) for name in COUNTERS}
+        answer = asyncio.run(Memory.athink_about('org', '要写周报么'))
+        return answer, {name: metrics.counter(name) - before[name] for name in COUNTERS}, prompts
+
+    return run
+
+
+@pytest.mark.parametrize('matches, expected, reason', [
+    ([], None, 'empty'),
+    ([(0.97, 'every friday'), (0.96, 'monthly')], 'every friday', 'accept'),
+    ([(0.3, 'every friday')], None, 'reject'),
+])
+def test_clear_matches_skip_the_llm(think, matches, expected, reason):
+    answer, counted, prompts = think(matches, llm_answer='1')
+    assert answer == expected and prompts == []
+    assert counted == {**dict.fromkeys(COUNTERS, 0), 'memory.think.llm_avoided': 1, f'memory.think.llm_avoided.{reason}': 1}
+
+
+def test_ambiguous_match_asks_the_llm(think):
+    answer, counted, prompts = think([(0.8, 'every friday'), (0.7, 'monthly')], llm_answer='2')
+    assert answer == 'monthly'
+    assert len(prompts) == 1 and 'question 1' in prompts[0] and 'question 2' in prompts[0]
+    assert counted == {**dict.fromkeys(COUNTERS, 0), 'memory.think.llm_calls': 1}
+
+
+@pytest.mark.parametrize('llm_answer', ['none of them', '3', '0', 'Fuiyo', '', None])
+def test_unusable_llm_answers_give_none(think, llm_answer):
+    answer, counted, _ = think([(0.8, 'every friday'), (0.7, 'monthly')], llm_answer=llm_answer)
+    assert answer is None and counted['memory.think.llm_calls'] == 1
+
+
+class FakeWordDoc:
+    def load(self, filepath):
+        return self
+
+    def split_content(self):
+        return [{'query': f'question {i}', 'ans': f'answer {i}'} for i in range(5)]
+
+
+class AtomicRecordingEmbedding:
+    '''Yields one vector per text and records how many db.atomic() blocks are open while each batch is embedded.'''
+    def __init__(self, monkeypatch):
+        self.open = 0
+        self.during_embedding = []
+        atomic = db.atomic
+
+        @contextlib.contextmanager
+        def counted(*args, **kwargs):
+            with atomic(*args, **kwargs) as transaction:
+                self.open += 1
+                try:
+                    yield transaction
+                finally:
+                    self.open -= 1
+
+        monkeypatch.setattr(db, 'atomic', counted)
+
+    def stream_embeddings(self, batches):
+        for batch in batches:
+            self.during_embedding.append(self.open)
+            yield [np.full(1792, i + 1, dtype=np.float32) for i in range(len(batch))]
+
+
+def test_load_memory_embeds_outside_the_insert_transactions(scratch_vector_table, monkeypatch):
+    db.create_tables([MemoryModel])
+    engine = AtomicRecordingEmbedding(monkeypatch)
+    monkeypatch.setattr(memory, 'LoadWordDoc', FakeWordDoc)
+    monkeypatch.setattr(memory, 'EMBEDDING_STREAM_BATCH', 2)
+    monkeypatch.setattr(Memory, 'embedding_engine', engine)
+    assert Memory.load_memory('faq.docx', 'org', meta={'source': 'faq.docx'}) == 1
+    assert engine.during_embedding == [0, 0, 0]
+    assert sorted(m.text for m in MemoryModel.select().where(MemoryModel.organization == 'org')) == \
+        [f'question {i}' for i in range(5)]
@@ -0,0 +1,39 @@
+import numpy as np
+
+from db import db, MemoryModel
+from memory_index import MemoryIndex, OrganizationIndex
+from vector_index import cosine_distance
+
+
+def test_search_ranks_by_cosine_similarity():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((300, 1792)).astype(np.float32) * rng.uniform(0.5, 2, (300, 1)).astype(np.float32)
+    index = OrganizationIndex(np.arange(300) + 1, [f'q{i}' for i in range(300)], [f'a{i}' for i in range(300)], vectors)
+    query = rng.standard_normal(1792).astype(np.float32)
+    similarity = vectors @ query / np.linalg.norm(vectors, axis=1) / np.linalg.norm(query)
+    rows = index.search(query, 10)
+    assert [row.id for row in rows] == list(np.argsort(-similarity)[:10] + 1)
+    assert rows[0].text == f'q{rows[0].id - 1}' and rows[0].ans == f'a{rows[0].id - 1}'
+    assert np.allclose([row.similarity for row in rows], np.sort(similarity)[::-1][:10], atol=1e-5)
+    assert len(index.search(query, 500)) == 300
+    assert OrganizationIndex([], [], [], []).search(query, 10) == []
+
+
+def test_index_matches_sql_and_follows_inserts(scratch_vector_table):
+    db.create_tables([MemoryModel])
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((50, 1792)).astype(np.float32)
+    MemoryModel.insert_many([{'text': f'q{i}', 'ans': f'a{i}', 'embedding': vector, 'organization': org, 'meta': {}}
+                             for i, vector in enumerate(vectors) for org in ('org', 'other')]).execute()
+    query = vectors[7] + rng.standard_normal(1792).astype(np.float32) * 0.1
+    sql = [row.id for row in MemoryModel.select(MemoryModel.id).where(MemoryModel.organization == 'org')
+           .order_by(cosine_distance(MemoryModel.embedding, query)).limit(5)]
+    index = MemoryIndex(max_rows=100)
+    assert [row.id for row in index.get('org').search(query, 5)] == sql
+
+    MemoryModel.create(text='new', ans='new answer', embedding=query, organization='org', meta={})
+    assert index.get('org').search(query, 1)[0].text != 'new'
+    index.refresh('org')
+    assert index.get('org').search(query, 1)[0].ans == 'new answer'
+    # larger than max_rows: left to the SQL path
+    assert MemoryIndex(max_rows=10).get('org') is None
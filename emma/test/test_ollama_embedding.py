@@ -0,0 +1,99 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('ollama')
+from embedding_ollama import OllamaEmbedding
+
+
+class StubOllama(ThreadingHTTPServer):
+    request_queue_size = 64
+
+    def __init__(self, batch_supported=True, failures=0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.batch_supported = batch_supported
+        self.failures = failures
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def host(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.requests.append((self.path, body))
+            if self.server.failures:
+                self.server.failures -= 1
+                return self.reply(503, {'error': 'busy'})
+        if self.path == '/api/embed' and self.server.batch_supported:
+            return self.reply(200, {'model': body['model'], 'embeddings': [[float(len(t)), 1.0] for t in body['input']]})
+        if self.path == '/api/embeddings':
+            return self.reply(200, {'embedding': [float(len(body['prompt'])), 1.0]})
+        self.reply(404, {'error': '404 page not found'})
+
+
+@pytest.fixture
+def stub(request):
+    server = StubOllama(**getattr(request, 'param', {}))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_batches_use_the_embed_endpoint(stub):
+    backend = OllamaEmbedding(host=stub.host, batch_size=4)
+    vectors = backend.embedding(['a' * i for i in range(1, 11)])
+    assert vectors[:, 0].tolist() == list(range(1, 11))
+    assert [path for path, _ in stub.requests] == ['/api/embed'] * 3
+    assert backend.batch_supported is True
+
+
+@pytest.mark.parametrize('stub', [{'batch_supported': False}], indirect=True)
+def test_falls_back_to_single_prompts(stub):
+    backend = OllamaEmbedding(host=stub.host, batch_size=8, concurrency=3)
+    vectors = backend.embedding(['a', 'bb', 'ccc'])
+    assert vectors[:, 0].tolist() == [1, 2, 3]
+    assert backend.batch_supported is False
+    assert sum(path == '/api/embeddings' for path, _ in stub.requests) == 3
+
+
+@pytest.mark.parametrize('stub', [{'failures': 2}], indirect=True)
+def test_retries_transient_errors(stub):
+    backend = OllamaEmbedding(host=stub.host, retries=3, backoff=0.01)
+    assert backend.embedding(['abc'])[:, 0].tolist() == [3]
+    assert len(stub.requests) == 3
+
+
+def test_one_client_per_event_loop(stub):
+    backend = OllamaEmbedding(host=stub.host)
+
+    async def calls():
+        await backend.aembedding(['a'])
+        client = backend._client()
+        await backend.aembedding(['bb'])
+        assert backend._client() is client and len(backend._clients) == 1
+        await backend.aclose()
+
+    asyncio.run(calls())
+    backend.embedding(['ccc'])
+    assert len(backend._clients) == 0
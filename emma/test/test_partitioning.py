@@ -0,0 +1,63 @@
+import numpy as np
+
+import partitioning
+from db import db, Vector1792
+from partitioning import _OnlineCopy, convert_table, is_partitioned, split_organization
+
+ORGANIZATION = 'organization1'
+
+
+def add(organization, text):
+    return Vector1792.create(doc_id='d', text=text, embedding=np.ones(1792, dtype=np.float32),
+                             organization=organization, meta={})
+
+
+def write_during_copy(monkeypatch, organization):
+    '''Inserts, updates and deletes rows of organization once the bulk copy is done, before the replay.'''
+    bulk_copy = _OnlineCopy.bulk_copy
+
+    def copy_then_write(self):
+        copied = bulk_copy(self)
+        add(organization, 'inserted during the copy')
+        mine = Vector1792.organization == organization
+        Vector1792.update(text='updated during the copy').where(mine & (Vector1792.text == 'to update')).execute()
+        Vector1792.delete().where(mine & (Vector1792.text == 'to delete')).execute()
+        return copied
+
+    monkeypatch.setattr(_OnlineCopy, 'bulk_copy', copy_then_write)
+
+
+def texts(table_name, organization):
+    cursor = db.execute_sql(f'SELECT text FROM {table_name} WHERE organization = %s ORDER BY text', (organization,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def test_split_keeps_writes_made_during_the_copy(scratch_vector_table, monkeypatch):
+    for organization in (ORGANIZATION, 'other'):
+        for text in ('kept', 'to update', 'to delete'):
+            add(organization, text)
+    write_during_copy(monkeypatch, ORGANIZATION)
+    monkeypatch.setattr(partitioning, '_build_ann_indexes', lambda table, partition: None)
+    name = split_organization(Vector1792, ORGANIZATION)
+    expected = ['inserted during the copy', 'kept', 'updated during the copy']
+    assert texts(name, ORGANIZATION) == expected
+    assert texts('emma_vector1792', ORGANIZATION) == expected
+    assert texts('emma_vector1792_default', ORGANIZATION) == []
+    assert texts('emma_vector1792', 'other') == ['kept', 'to delete', 'to update']
+
+
+def test_convert_keeps_writes_made_during_the_copy(scratch_vector_table, monkeypatch):
+    # a table created before partitioning
+    sql, params = Vector1792._schema._create_table(safe=False).query()
+    db.execute_sql('DROP TABLE emma_vector1792')
+    db.execute_sql(sql.replace(' PARTITION BY LIST (organization)', ''), params)
+    assert not is_partitioned('emma_vector1792')
+    for text in ('kept', 'to update', 'to delete'):
+        add(ORGANIZATION, text)
+    write_during_copy(monkeypatch, ORGANIZATION)
+    monkeypatch.setattr(partitioning, '_build_ann_indexes', lambda table, partition: None)
+    old = convert_table(Vector1792)
+    assert is_partitioned('emma_vector1792')
+    expected = ['inserted during the copy', 'kept', 'updated during the copy']
+    assert texts('emma_vector1792', ORGANIZATION) == expected
+    assert texts(old, ORGANIZATION) == expected
@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+# the agents pull in the docx loader and litellm
+pytest.importorskip('docx')
+pytest.importorskip('litellm')
+from agent.qa import QAAgent
+
+
+class AsyncOnlyRetrieval:
+    def __init__(self):
+        self.queries = []
+
+    def vector_retrieval(self, query, topk=20, raw=False):
+        raise AssertionError('the sync retrieval blocks the event loop')
+
+    async def avector_retrieval(self, query, topk=20, raw=False):
+        self.queries.append((query, topk, raw))
+        return ['vector'], 'retrieved context'
+
+
+def test_act_retrieves_without_blocking_the_loop():
+    agent = QAAgent.__new__(QAAgent)
+    agent.context = None
+    agent.vector_retrieval = AsyncOnlyRetrieval()
+    prompts = []
+
+    async def chat(query, stream=False):
+        prompts.append(query)
+        return 'answer'
+
+    agent.chat = chat
+    assert asyncio.run(agent.act('发票怎么开')) == 'answer'
+    assert agent.vector_retrieval.queries == [('发票怎么开', 5, True)]
+    assert agent.context == 'retrieved context' and 'retrieved context' in prompts[0]
+    # the context is kept for the rest of the conversation
+    asyncio.run(agent.act('还有呢'))
+    assert len(agent.vector_retrieval.queries) == 1
@@ -0,0 +1,74 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import reranker
+from reranker import CrossEncoderReranker, LLMReranker, Reranker, get_reranker, parse_ranking
+from vectorization import RetrievalResult, RetrievedChunk, VectorRetrival
+
+META = {'embedding_model': 'LocalEmbedding', 'sentence_splitter': 'RawMarkdownSplitter'}
+
+
+class LengthModel:
+    '''Stands in for the cross-encoder: longer chunks score higher.'''
+    def __init__(self):
+        self.batches = []
+
+    def predict(self, pairs, batch_size):
+        self.batches.append(batch_size)
+        return np.array([len(text) for _, text in pairs], dtype=np.float32)
+
+
+class FixedRanking(Reranker):
+    def __init__(self, ranking):
+        self.ranking = ranking
+
+    def rerank(self, query, texts, topk=5):
+        return self.ranking[:topk]
+
+
+def test_reranker_is_abstract():
+    with pytest.raises(TypeError):
+        Reranker()
+
+
+def test_cross_encoder_orders_by_score():
+    model = CrossEncoderReranker(batch_size=4)
+    model._model = LengthModel()
+    assert model.rerank('q', ['aa', 'a', 'aaaa', 'aaa'], topk=3) == [(2, 4.0), (3, 3.0), (0, 2.0)]
+    assert model._model.batches == [4]
+    assert model.rerank('q', []) == []
+    assert asyncio.run(model.arerank('q', ['a', 'aa'], topk=1)) == [(1, 2.0)]
+    model.min_score = 2.5
+    assert model.rerank('q', ['aa', 'a', 'aaaa', 'aaa']) == [(2, 4.0), (3, 3.0)]
+
+
+def test_llm_answer_parsing():
+    assert parse_ranking('```json\n{"documents": [3, "1", 3, 9, 2]}\n```', 3, 5) == [(2, 1.0), (0, 0.5), (1, 1 / 3)]
+    assert parse_ranking('{"documents": [2, 1]}', 2, 1) == [(1, 1.0)]
+    assert parse_ranking('{"documents": []}', 2, 5) == []
+    for unusable in ('none of them', '{"documents": ["first"]}', '```json\n[1, 2]\n```', None):
+        assert parse_ranking(unusable, 2, 5) == []
+
+
+def test_get_reranker_selects_one_shared_instance():
+    cross_encoder = get_reranker('cross-encoder')
+    assert isinstance(cross_encoder, CrossEncoderReranker) and cross_encoder is get_reranker('cross-encoder')
+    assert isinstance(get_reranker('llm'), LLMReranker)
+    assert get_reranker() is get_reranker(reranker.RERANKER)
+    with pytest.raises(ValueError):
+        get_reranker('bm25')
+
+
+def test_retrieval_rerank_orders_candidates():
+    retrieval = VectorRetrival('org', embedding_model=object(), metadata=META, cache=False, quantization='', two_stage=False,
+                               reranker=FixedRanking([(2, 0.9), (0, 0.5)]))
+    assert retrieval.rerank('q') == (None, None)
+    retrieval.result = RetrievalResult([RetrievedChunk(id=i, doc_id='d', text=f'chunk {i}', meta={'i': i}) for i in range(3)]
+                                       + [RetrievedChunk(id=0, doc_id='d', text='chunk 0')])
+    result = retrieval.rerank('q', raw=True)
+    assert [(chunk.id, chunk.score) for chunk in result] == [(2, 0.9), (0, 0.5)]
+    context, metas = retrieval.rerank('q', topk=1)
+    assert context == '1. chunk 2' and metas == [{'i': 2}]
+    assert asyncio.run(retrieval.arerank('q', topk=1)) == (context, metas)
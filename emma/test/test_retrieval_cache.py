@@ -0,0 +1,69 @@
+import uuid
+
+import pytest
+import redis
+
+from metrics import metrics
+from retrieval_cache import RetrievalCache, normalize_query
+
+
+def test_equivalent_queries_share_a_key():
+    cache = RetrievalCache(client=redis.Redis())
+    assert normalize_query('  孕期 怎么补  叶酸？ ') == normalize_query('孕期 怎么补 叶酸?')
+    assert normalize_query('ＦＯＬＩＣ Acid') == 'folic acid'
+    key = cache.key('org', 'LocalEmbedding', 'RawMarkdownSplitter', 'Folic acid?', 20)
+    assert key == cache.key('org', 'LocalEmbedding', 'RawMarkdownSplitter', 'folic  ACID', 20)
+    assert key != cache.key('org', 'LocalEmbedding', 'RawMarkdownSplitter', 'folic acid', 5)
+    assert key != cache.key('org2', 'LocalEmbedding', 'RawMarkdownSplitter', 'folic acid', 20)
+
+
+@pytest.fixture
+def cache():
+    client = redis.Redis()
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        pytest.skip('needs a local Redis server')
+    prefix = f'test:{uuid.uuid4().hex}'
+    yield RetrievalCache(client=client, ttl=60, prefix=prefix)
+    for key in client.scan_iter(f'{prefix}:*'):
+        client.delete(key)
+
+
+def test_invalidation_drops_only_that_organization(cache):
+    chunks = [{'id': 1, 'doc_id': 'd', 'text': 't'}]
+    keys = {org: cache.key(org, 'm', 's', 'query', 20) for org in ('a', 'b')}
+    for org, key in keys.items():
+        assert cache.get(org, key) == (None, 0)
+        cache.put(key, chunks, 0)
+        assert cache.get(org, key) == (chunks, 0)
+    cache.invalidate('a')
+    assert cache.get('a', keys['a']) == (None, 1)
+    assert cache.get('b', keys['b']) == (chunks, 0)
+    # a result computed before the invalidation is never served after it
+    cache.put(keys['a'], chunks, 0)
+    assert cache.get('a', keys['a'])[0] is None
+    assert cache.stats()['hits'] == 3
+
+
+def test_unreachable_redis_is_skipped_for_a_while():
+    # nothing listens on port 1
+    cache = RetrievalCache(client=redis.Redis(port=1, socket_connect_timeout=1), cooldown=60)
+    errors, skipped = metrics.counter('retrieval.cache.errors'), metrics.counter('retrieval.cache.skipped')
+    assert cache.get('a', 'key') == (None, -1)
+    assert cache.get('a', 'key') == (None, -1)
+    cache.put('key', [], 0)
+    assert metrics.counter('retrieval.cache.errors') == errors + 1
+    assert metrics.counter('retrieval.cache.skipped') == skipped + 1
+    assert cache.stats() is None
+
+
+def test_failed_invalidation_is_counted_and_surfaced():
+    cache = RetrievalCache(client=redis.Redis(port=1, socket_connect_timeout=1), cooldown=0)
+    failures = metrics.counter('retrieval.cache.invalidation_failures')
+    assert cache.invalidate('a') is False
+    assert metrics.counter('retrieval.cache.invalidation_failures') == failures + 1
+    assert cache._stale == {'a'}
+    # the organization is retried on its next lookup, and not served while that fails
+    assert cache.get('a', 'key') == (None, -1)
+    assert metrics.counter('retrieval.cache.invalidation_failures') == failures + 2
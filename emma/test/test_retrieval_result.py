@@ -0,0 +1,53 @@
+import numpy as np
+
+import vectorization
+from db import db, Document
+from embedding_cache import CachedEmbedding, EmbeddingCache
+from ingest import copy_rows
+from vectorization import RetrievalResult, RetrievedChunk, VectorRetrival
+
+META = {'embedding_model': 'LocalEmbedding', 'sentence_splitter': 'RawMarkdownSplitter'}
+
+
+class FixedEmbedding:
+    def __init__(self, vector):
+        self.vector = vector
+
+    def embeddings(self, inputs):
+        return [self.vector for _ in inputs]
+
+
+def test_render_is_separate_from_collection():
+    result = RetrievalResult([RetrievedChunk(id=1, doc_id='d', text='## 叶酸\n每天 0.4mg', meta={'page': 1}),
+                              RetrievedChunk(id=2, doc_id='d', text='补铁')])
+    result.extend([RetrievedChunk(id=1, doc_id='d', text='## 叶酸\n每天 0.4mg')])
+    assert result.render() == '1.  叶酸每天 0.4mg\n2. 补铁\n3.  叶酸每天 0.4mg\n'
+    assert result.metas == [{'page': 1}, None, None]
+    assert [chunk.id for chunk in result.unique()] == [1, 2]
+
+
+def test_vector_retrieval_executes_one_query(scratch_vector_table, monkeypatch):
+    table = scratch_vector_table
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((30, 1792)).astype(np.float32)
+    fields = [table._meta.fields[name] for name in ('doc_id', 'text', 'embedding', 'organization', 'embedding_model', 'sentence_splitter', 'meta')]
+    copy_rows(table, fields, [('d', f'chunk {i}', vector, 'org', META['embedding_model'], META['sentence_splitter'], META)
+                              for i, vector in enumerate(vectors)])
+    Document.create(doc_id='d', filename='guide.md', organization='org')
+    monkeypatch.setattr(vectorization, 'SEARCH_PATH', 'test_scratch, public')
+
+    executed = []
+    execute_sql = db.execute_sql
+    monkeypatch.setattr(db, 'execute_sql', lambda sql, params=None, *args, **kwargs: executed.append(sql) or execute_sql(sql, params, *args, **kwargs))
+    embedding = CachedEmbedding(FixedEmbedding(vectors[3]), cache=EmbeddingCache(cache_dir=''))
+    retrieval = VectorRetrival('org', embedding_model=embedding, metadata=META, cache=False, quantization='', two_stage=False)
+
+    result, context = retrieval.vector_retrieval('叶酸', topk=5, raw=True)
+    selects = [sql for sql in executed if sql.lstrip().upper().startswith('SELECT')]
+    assert len(selects) == 1, executed
+    assert result[0].text == 'chunk 3' and result[0].filename == 'guide.md'
+    assert len(result) == 5 and context.startswith('1. chunk 3\n')
+    # rendering and reading the accumulated chunks never go back to the database
+    executed.clear()
+    assert retrieval.docs == context and retrieval.doc_meta == [META] * 5 and len(retrieval.result.unique()) == 5
+    assert executed == []
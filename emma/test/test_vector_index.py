@@ -0,0 +1,145 @@
+import numpy as np
+import peewee
+import pytest
+
+from db import db, MemoryModel, Vector1792, Vector2048, VECTOR_HASH_PARTITIONS
+from ingest import copy_rows
+from partitioning import leaf_partitions, partition_name
+from vector_index import VectorIndex, cosine_distance, create_index, rebuild_index, identity_filter, quantization_for, quantized_distance
+
+
+def test_index_definitions():
+    assert VectorIndex(Vector1792, params={'m': 24}).definition() == (
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS emma_vector1792_embedding_hnsw ON emma_vector1792 '
+        'USING hnsw (embedding vector_cosine_ops) WITH (m = 24, ef_construction = 64)')
+    partial = VectorIndex(MemoryModel, method='ivfflat', organization="de'han 01")
+    assert partial.name == 'emma_memory_embedding_ivfflat_de_han_01'
+    assert partial.definition().endswith("WITH (lists = 100) WHERE organization = 'de''han 01'")
+    with pytest.raises(ValueError):
+        VectorIndex(Vector1792, method='flat')
+
+
+def test_wide_columns_use_halfvec_index_and_query():
+    index = VectorIndex(Vector2048)
+    assert '((embedding)::halfvec(2048)) halfvec_cosine_ops' in index.definition()
+    sql, _ = Vector2048.select().order_by(cosine_distance(Vector2048.embedding, [0.1] * 2048)).sql()
+    assert 'CAST("t1"."embedding" AS halfvec(2048)) <=> CAST(%s AS halfvec(2048))' in sql
+    sql, _ = Vector1792.select().order_by(cosine_distance(Vector1792.embedding, [0.1] * 1792)).sql()
+    assert 'halfvec' not in sql
+
+
+def test_quantized_indexes_match_their_query_expressions():
+    binary = VectorIndex(Vector1792, quantization='binary', organization='dehan0001')
+    assert binary.name == 'emma_vector1792_embedding_hnsw_binary_dehan0001'
+    assert '((binary_quantize(embedding))::bit(1792)) bit_hamming_ops' in binary.definition()
+    half = VectorIndex(Vector1792, quantization='half')
+    assert half.name == 'emma_vector1792_embedding_hnsw_half'
+    assert '((embedding)::halfvec(1792)) halfvec_cosine_ops' in half.definition()
+    # the implied halfvec index of wide columns keeps its name
+    assert VectorIndex(Vector2048).name == 'emma_vector2048_embedding_hnsw'
+
+    sql, params = Vector1792.select().order_by(quantized_distance(Vector1792.embedding, [0.5, -1.0, 0.0] + [1.0] * 1789, 'binary')).sql()
+    assert 'CAST(binary_quantize("t1"."embedding") AS bit(1792)) <~> CAST(%s AS bit(1792))' in sql
+    assert params[0] == '100' + '1' * 1789
+
+
+def test_quantization_per_organization():
+    assert quantization_for('dehan0001', '') is None
+    assert quantization_for('dehan0001', 'binary') == 'binary'
+    assert quantization_for('dehan0001', 'half, dehan0001=binary') == 'binary'
+    assert quantization_for('acme', 'dehan0001=binary') is None
+    with pytest.raises(ValueError):
+        quantization_for('acme', 'acme=int8')
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child)
+
+
+def test_identity_filter_is_an_index_condition(scratch_vector_table):
+    table = scratch_vector_table
+    rng = np.random.default_rng(0)
+    fields = [table._meta.fields[name] for name in ('doc_id', 'text', 'embedding', 'organization', 'embedding_model', 'sentence_splitter', 'meta')]
+    rows = []
+    # an organization whose chunks were also embedded with another model, where filtering on organization alone is not enough
+    for organization, model, count in [('target', 'LocalEmbedding', 50), ('target', 'OllamaEmbedding', 2000), ('other', 'LocalEmbedding', 2000)]:
+        meta = {'embedding_model': model, 'sentence_splitter': 'RawMarkdownSplitter'}
+        rows += [('d', 't', rng.standard_normal(1792), organization, model, 'RawMarkdownSplitter', meta) for _ in range(count)]
+    copy_rows(table, fields, rows)
+    db.execute_sql(f'ANALYZE {table._meta.table_name}')
+
+    condition = identity_filter(table, 'target', 'LocalEmbedding', 'RawMarkdownSplitter')
+    query = table.select(table.id).where(condition).order_by(cosine_distance(table.embedding, rng.standard_normal(1792))).limit(20)
+    sql, params = query.sql()
+    assert 'meta' not in sql
+    plan = db.execute_sql('EXPLAIN (FORMAT JSON) ' + sql, params).fetchone()[0][0]['Plan']
+    nodes = list(plan_nodes(plan))
+    # on a partitioned table the index scanned is the partition's copy of the composite index
+    assert any('organization' in node.get('Index Cond', '') and 'embedding_model' in node.get('Index Cond', '') for node in nodes)
+    assert not any('meta' in node.get('Filter', '') for node in nodes)
+
+
+def test_partitioned_table_routes_rows_and_indexes_every_leaf(scratch_vector_table):
+    table = scratch_vector_table
+    copy_rows(table, [table.doc_id, table.text, table.embedding, table.organization, table.meta],
+              [('d1', 'text', np.ones(1792), org, {}) for org in ('dehan0001', 'acme')])
+    leaves = leaf_partitions(table._meta.table_name)
+    assert len(leaves) == VECTOR_HASH_PARTITIONS
+    sql, params = table.select(table.id).where(table.organization == 'acme').sql()
+    scanned = db.execute_sql('EXPLAIN ' + sql, params).fetchall()
+    assert sum(' on emma_vector1792_h' in row[0] for row in scanned) == 1
+
+    assert [index.table_name for index in VectorIndex(table).per_partition()] == leaves
+    assert [index.name for index in VectorIndex(table).per_partition()][0] == 'emma_vector1792_h0_embedding_hnsw'
+    # without a partition of its own an organization gets partial indexes on the shared leaves
+    partial = VectorIndex(table, organization='acme').per_partition()
+    assert all(index.definition().endswith("WHERE organization = 'acme'") for index in partial)
+    assert partition_name(table, 'acme') == 'emma_vector1792_org_acme'
+    assert partition_name(table, 'Acme Corp').startswith('emma_vector1792_org_acme_corp_')
+
+
+@pytest.fixture
+def committed_memory_table():
+    # CREATE/DROP INDEX CONCURRENTLY cannot run in the rolled back scratch transaction
+    try:
+        db.connect(reuse_if_open=True)
+        if not db.execute_sql("SELECT 1 FROM pg_extension WHERE extname = 'vector'").fetchone():
+            pytest.skip('needs pgvector in the test database')
+    except (peewee.OperationalError, peewee.InterfaceError):
+        pytest.skip('needs a PostgreSQL test database')
+    db.execute_sql('DROP SCHEMA IF EXISTS test_vector_index CASCADE')
+    db.execute_sql('CREATE SCHEMA test_vector_index')
+    db.execute_sql('SET search_path TO test_vector_index, public')
+    db.create_tables([MemoryModel])
+    yield MemoryModel
+    db.execute_sql('DROP SCHEMA test_vector_index CASCADE')
+    db.execute_sql('RESET search_path')
+    db.close()
+
+
+def test_rebuild_swaps_the_index_in_one_transaction(committed_memory_table, monkeypatch):
+    create_index(VectorIndex(committed_memory_table))
+    statements = []
+    execute_sql = db.execute_sql
+
+    def recording(sql, *args, **kwargs):
+        statements.append((sql, db.in_transaction()))
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(db, 'execute_sql', recording)
+    rebuild_index(VectorIndex(committed_memory_table, params={'m': 8}))
+    monkeypatch.undo()
+
+    renames = [(sql, in_transaction) for sql, in_transaction in statements if 'RENAME' in sql]
+    assert renames == [('ALTER INDEX emma_memory_embedding_hnsw RENAME TO emma_memory_embedding_hnsw_old', True),
+                       ('ALTER INDEX emma_memory_embedding_hnsw_new RENAME TO emma_memory_embedding_hnsw', True)]
+    # the live name is never missing: the old index is dropped only after the swap
+    drops = [i for i, (sql, _) in enumerate(statements) if sql.startswith('DROP INDEX') and sql.endswith('_hnsw_old')]
+    assert drops[-1] > statements.index(renames[-1])
+    names = [row[0] for row in db.execute_sql(
+        'SELECT indexname FROM pg_indexes WHERE schemaname = %s AND indexname LIKE %s', ('test_vector_index', '%hnsw%'))]
+    assert names == ['emma_memory_embedding_hnsw']
+    options = db.execute_sql("SELECT reloptions FROM pg_class WHERE oid = to_regclass('emma_memory_embedding_hnsw')").fetchone()[0]
+    assert 'm=8' in options
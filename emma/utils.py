@@ -1,12 +1,33 @@
 # Description: Utility functions for the project
-from typing import Any, Dict
+from typing import Any, Dict, List, Tuple
 import re
 import orjson as json
+import numpy as np
 
 
 def make_table_name(model_class):
     model_name = model_class.__name__
     return 'emma_' + model_name.lower()
+
+
+def sliced_norm_l2_batch(vectors, dim=2048) -> np.ndarray:
+    # truncate every row to its first dim values (Matryoshka prefix) and renormalise
+    matrix = np.asarray(vectors, dtype=np.float32)[:, :dim]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def reciprocal_rank_fusion(rankings: List[list], weights: List[float] = None, k: int = 60) -> List[Tuple[Any, float]]:
+    """
+    Merge ranked id lists: score(id) = sum(weight / (k + rank)) over the lists containing it,
+    rank starting at 1. Duplicates within one list only count at their best rank.
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores: Dict[Any, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, item in enumerate(dict.fromkeys(ranking), start=1):
+            scores[item] = scores.get(item, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
     
     
 def extract_json_from_text(text: str) -> Dict[str, Any]:
@@ -0,0 +1,302 @@
+'''
+ANN indexes on the pgvector columns: definitions, concurrent (re)builds, per-query search
+settings and health reporting. infra/ann_index.py is the command line front end.
+pgvector indexes `vector` columns up to 2000 dimensions, wider columns are indexed through
+a halfvec expression and must be queried with cosine_distance() from this module.
+Quantized indexes ('half' or 'binary') index a compact expression of the full vector for the
+first pass of a two-stage search; quantized_distance() builds the matching query expression.
+They can be partial per organization, VECTOR_QUANTIZATION selects the first pass per organization.
+On partitioned tables every index is built per leaf partition, an organization with a partition of
+its own gets a full index there instead of a partial one.
+'''
+import os
+import re
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, List, Optional
+
+import dotenv
+import numpy as np
+from peewee import Cast, Expression, fn
+from pgvector.peewee import HalfVectorField
+
+import adb
+from db import db, Vector512, Vector768, Vector1024, Vector1536, Vector1792, Vector2048, MemoryModel
+from partitioning import leaf_partitions, organization_partition
+
+dotenv.load_dotenv()
+
+VECTOR_EF_SEARCH = int(os.getenv('VECTOR_EF_SEARCH', 100))
+VECTOR_PROBES = int(os.getenv('VECTOR_PROBES', 10))
+# off, strict_order or relaxed_order (pgvector >= 0.8); keeps filtered HNSW scans from returning short
+VECTOR_ITERATIVE_SCAN = os.getenv('VECTOR_ITERATIVE_SCAN', 'off')
+# e.g. 'binary' for every organization or 'dehan0001=binary,acme=half'; unset means exact search
+VECTOR_QUANTIZATION = os.getenv('VECTOR_QUANTIZATION', '')
+HNSW_MAX_DIM = 2000
+HALFVEC_MAX_DIM = 4000
+BIT_MAX_DIM = 64000
+QUANTIZATIONS = ('half', 'binary')
+
+DEFAULT_PARAMS = {'hnsw': {'m': 16, 'ef_construction': 64},
+                  'ivfflat': {'lists': 100}}
+OPCLASSES = {'cosine': 'cosine_ops', 'l2': 'l2_ops', 'ip': 'ip_ops'}
+
+
+def _dimensions(table, column: str) -> int:
+    return getattr(table, column).dimensions
+
+
+def identity_filter(table, organization: str, embedding_model: str, sentence_splitter: str):
+    '''
+    Rows of one organization embedded with one model and splitter. Tables with the identity
+    columns are filtered through their (organization, embedding_model, sentence_splitter) index,
+    the others on the JSONB meta.
+    '''
+    if hasattr(table, 'embedding_model'):
+        return ((table.organization == organization) & (table.embedding_model == embedding_model)
+                & (table.sentence_splitter == sentence_splitter))
+    return ((table.meta['embedding_model'] == embedding_model) & (table.meta['sentence_splitter'] == sentence_splitter)
+            & (table.organization == organization))
+
+
+def quantization_for(organization: str, setting: str = None) -> Optional[str]:
+    '''The first-pass quantization configured for an organization in VECTOR_QUANTIZATION, if any.'''
+    default = None
+    for entry in filter(None, (setting if setting is not None else VECTOR_QUANTIZATION).replace(' ', '').split(',')):
+        name, _, value = entry.rpartition('=')
+        if value not in QUANTIZATIONS:
+            raise ValueError(f'Unknown quantization {value!r} in VECTOR_QUANTIZATION, expected one of {QUANTIZATIONS}')
+        if not name:
+            default = value
+        elif name == organization:
+            return value
+    return default
+
+
+def quantized_distance(field, vector, quantization: str):
+    '''
+    Distance on a compact form of field, the same expression a quantized VectorIndex indexes:
+    cosine on halfvec, or hamming on binary_quantize (the sign bit of every dimension).
+    '''
+    dimensions = field.dimensions
+    if quantization == 'half':
+        halfvec = f'halfvec({dimensions})'
+        return Expression(Cast(field, halfvec), '<=>', Cast(HalfVectorField(dimensions).to_value(vector), halfvec))
+    if quantization == 'binary':
+        bits = ''.join('1' if x > 0 else '0' for x in np.asarray(vector, dtype=np.float32))
+        return Expression(Cast(fn.binary_quantize(field), f'bit({dimensions})'), '<~>', Cast(bits, f'bit({dimensions})'))
+    raise ValueError(f'Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}')
+
+
+def cosine_distance(field, vector):
+    '''field.cosine_distance(vector), cast to halfvec for columns too wide for a vector index.'''
+    if field.dimensions <= HNSW_MAX_DIM:
+        return field.cosine_distance(vector)
+    return quantized_distance(field, vector, 'half')
+
+
+class VectorIndex:
+    def __init__(self, table, column: str = 'embedding', method: str = 'hnsw', metric: str = 'cosine',
+                 params: Dict[str, int] = None, organization: str = None, quantization: str = None,
+                 partition: str = None) -> None:
+        if method not in DEFAULT_PARAMS:
+            raise ValueError(f'Unknown index method {method!r}, expected hnsw or ivfflat')
+        if quantization is not None and quantization not in QUANTIZATIONS:
+            raise ValueError(f'Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}')
+        self.table = table
+        self.column = column
+        self.method = method
+        self.metric = 'hamming' if quantization == 'binary' else metric
+        self.params = {**DEFAULT_PARAMS[method], **(params or {})}
+        self.organization = organization
+        self.partition = partition
+        self.dimensions = _dimensions(table, column)
+        # columns too wide for a vector index are always indexed as halfvec
+        self.quantization = quantization or ('half' if self.dimensions > HNSW_MAX_DIM else None)
+        limit = BIT_MAX_DIM if self.quantization == 'binary' else HALFVEC_MAX_DIM
+        if self.dimensions > limit:
+            raise ValueError(f'{self.table_name}.{column} has {self.dimensions} dimensions, pgvector indexes at most {limit}')
+
+    @property
+    def table_name(self) -> str:
+        return self.partition or self.table._meta.table_name
+
+    @property
+    def name(self) -> str:
+        name = f'{self.table_name}_{self.column}_{self.method}'
+        if self.quantization == 'binary' or (self.quantization == 'half' and self.dimensions <= HNSW_MAX_DIM):
+            name += f'_{self.quantization}'
+        if self.organization:
+            name += '_' + re.sub(r'[^a-z0-9_]', '_', self.organization.lower())
+        return name[:63]
+
+    def definition(self, name: str = None, concurrently: bool = True) -> str:
+        if self.quantization == 'half':
+            target = f'(({self.column})::halfvec({self.dimensions})) halfvec_{OPCLASSES[self.metric]}'
+        elif self.quantization == 'binary':
+            target = f'((binary_quantize({self.column}))::bit({self.dimensions})) bit_hamming_ops'
+        else:
+            target = f'{self.column} vector_{OPCLASSES[self.metric]}'
+        options = ', '.join(f'{key} = {int(value)}' for key, value in self.params.items())
+        sql = (f'CREATE INDEX {"CONCURRENTLY " if concurrently else ""}IF NOT EXISTS {name or self.name} '
+               f'ON {self.table_name} USING {self.method} ({target}) WITH ({options})')
+        if self.organization:
+            sql += " WHERE organization = '{}'".format(self.organization.replace("'", "''"))
+        return sql
+
+    def per_partition(self) -> List['VectorIndex']:
+        '''The indexes that actually get built: one per leaf partition of a partitioned table.'''
+        if self.partition:
+            return [self]
+        organization = self.organization
+        partitions = leaf_partitions(self.table_name)
+        if organization and partitions != [self.table_name]:
+            own = organization_partition(self.table, organization)
+            if own:
+                partitions, organization = [own], None
+            else:
+                partitions = [name for name in partitions if name.startswith(f'{self.table_name}_h')]
+        return [VectorIndex(self.table, self.column, self.method, self.metric, self.params, organization,
+                            self.quantization, partition=name) for name in partitions]
+
+    def __repr__(self) -> str:
+        return f'VectorIndex({self.name}, {self.params})'
+
+
+# the indexes every deployment should have; per-organization partial indexes are added on demand
+INDEXES: List[VectorIndex] = [
+    VectorIndex(Vector512),
+    VectorIndex(Vector768),
+    VectorIndex(Vector1024),
+    VectorIndex(Vector1536),
+    VectorIndex(Vector1792),
+    VectorIndex(Vector1792, 'embedding_short'),
+    VectorIndex(Vector2048),
+    VectorIndex(MemoryModel),
+]
+
+
+def _index_exists(name: str) -> bool:
+    # resolved through search_path like the unqualified names in the DDL
+    return db.execute_sql('SELECT 1 FROM pg_class WHERE oid = to_regclass(%s) AND relkind = %s', (name, 'i')).fetchone() is not None
+
+
+def _drop(name: str) -> None:
+    db.execute_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def _maintenance(maintenance_work_mem: str = None, parallel_workers: int = None) -> None:
+    # HNSW builds are much faster when the graph fits in maintenance_work_mem
+    if maintenance_work_mem:
+        db.execute_sql(f"SET maintenance_work_mem = '{maintenance_work_mem}'")
+    if parallel_workers is not None:
+        db.execute_sql(f'SET max_parallel_maintenance_workers = {int(parallel_workers)}')
+
+
+def create_index(index: VectorIndex, maintenance_work_mem: str = None, parallel_workers: int = None) -> None:
+    '''Build the index without blocking writes. A leftover invalid build is dropped first.'''
+    _maintenance(maintenance_work_mem, parallel_workers)
+    for leaf in index.per_partition():
+        if _index_exists(leaf.name) and not _is_valid(leaf.name):
+            _drop(leaf.name)
+        db.execute_sql(leaf.definition())
+
+
+def rebuild_index(index: VectorIndex, maintenance_work_mem: str = None, parallel_workers: int = None) -> None:
+    '''
+    Build a replacement next to the live index, then swap it in. Both renames commit together, so
+    every query sees one of the two indexes and parameters can change without downtime; the old
+    index is only dropped once it is out of the way.
+    '''
+    _maintenance(maintenance_work_mem, parallel_workers)
+    for leaf in index.per_partition():
+        staging, retired = f'{leaf.name[:59]}_new', f'{leaf.name[:59]}_old'
+        _drop(staging)
+        _drop(retired)
+        db.execute_sql(leaf.definition(name=staging))
+        with db.atomic():
+            if _index_exists(leaf.name):
+                db.execute_sql(f'ALTER INDEX {leaf.name} RENAME TO {retired}')
+            db.execute_sql(f'ALTER INDEX {staging} RENAME TO {leaf.name}')
+        _drop(retired)
+
+
+def drop_index(index: VectorIndex) -> None:
+    for leaf in index.per_partition():
+        _drop(leaf.name)
+
+
+def _is_valid(name: str) -> bool:
+    row = db.execute_sql('SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                         'WHERE c.relname = %s', (name,)).fetchone()
+    return bool(row and row[0])
+
+
+def index_health(table=None) -> List[dict]:
+    '''Every ANN index on the vector tables with validity, size, scans and options, plus missing defaults.'''
+    defaults = [leaf for index in INDEXES if table is None or index.table is table for leaf in index.per_partition()]
+    tables = {index.table_name for index in defaults}
+    cursor = db.execute_sql(
+        "SELECT c.relname, t.relname, am.amname, i.indisvalid, pg_relation_size(c.oid), "
+        "coalesce(s.idx_scan, 0), c.reloptions, pg_get_expr(i.indpred, i.indrelid) "
+        "FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "JOIN pg_class t ON t.oid = i.indrelid "
+        "JOIN pg_am am ON am.oid = c.relam "
+        "LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = i.indexrelid "
+        "WHERE am.amname IN ('hnsw', 'ivfflat') AND t.relname = ANY(%s)", (sorted(tables),))
+    report = [{'index': name, 'table': table_name, 'method': method, 'valid': valid, 'size_bytes': size,
+               'scans': scans, 'options': dict(option.split('=', 1) for option in options or ()), 'predicate': predicate}
+              for name, table_name, method, valid, size, scans, options, predicate in cursor.fetchall()]
+    present = {row['index'] for row in report}
+    for index in defaults:
+        if index.name not in present:
+            report.append({'index': index.name, 'table': index.table_name, 'method': index.method, 'valid': False,
+                           'size_bytes': 0, 'scans': 0, 'options': {}, 'predicate': None, 'missing': True})
+    return report
+
+
+def vector_bytes(dimensions: int) -> Dict[str, int]:
+    '''Stored size of one vector in each representation: varlena header plus pgvector's own header.'''
+    return {'full': 8 + 4 * dimensions, 'half': 8 + 2 * dimensions, 'binary': 8 + (dimensions + 7) // 8}
+
+
+def storage_report(table, organization: str = None) -> dict:
+    '''Rows, table size, bytes per vector representation and the ANN indexes of one vector table.'''
+    condition, params = ('WHERE organization = %s', (organization,)) if organization else ('', ())
+    rows = db.execute_sql(f'SELECT count(*) FROM {table._meta.table_name} {condition}', params).fetchone()[0]
+    # a partitioned table has no storage of its own
+    table_bytes = db.execute_sql('SELECT sum(pg_table_size(to_regclass(name))) FROM unnest(%s::text[]) AS name',
+                                 (leaf_partitions(table._meta.table_name),)).fetchone()[0]
+    indexes = [{'index': row['index'], 'size_bytes': row['size_bytes'], 'predicate': row['predicate']}
+               for row in index_health(table) if not row.get('missing')]
+    return {'table': table._meta.table_name, 'rows': rows, 'table_bytes': table_bytes,
+            'vector_bytes': vector_bytes(table.embedding.dimensions), 'indexes': indexes}
+
+
+def _search_settings(ef_search: Optional[int], probes: Optional[int], limit: int) -> List[str]:
+    statements = [f'SET LOCAL hnsw.ef_search = {max(int(ef_search or VECTOR_EF_SEARCH), int(limit))}',
+                  f'SET LOCAL ivfflat.probes = {int(probes or VECTOR_PROBES)}']
+    if VECTOR_ITERATIVE_SCAN != 'off':
+        statements.append(f"SET LOCAL hnsw.iterative_scan = '{VECTOR_ITERATIVE_SCAN}'")
+    return statements
+
+
+@contextmanager
+def search_settings(ef_search: Optional[int] = None, probes: Optional[int] = None, limit: int = 0):
+    '''
+    Run the enclosed queries in a transaction with ANN search settings scoped to it (SET LOCAL).
+    ef_search is raised to `limit`, HNSW never returns more rows than ef_search.
+    '''
+    with db.atomic():
+        for statement in _search_settings(ef_search, probes, limit):
+            db.execute_sql(statement)
+        yield
+
+
+@asynccontextmanager
+async def asearch_settings(ef_search: Optional[int] = None, probes: Optional[int] = None, limit: int = 0):
+    '''search_settings() on a pooled asyncpg connection, which it yields for adb.fetch().'''
+    async with adb.transaction() as conn:
+        for statement in _search_settings(ef_search, probes, limit):
+            await conn.execute(statement)
+        yield conn
@@ -1,16 +1,25 @@
 from llama_index.core.node_parser import SentenceSplitter
-from embedding import sliced_norm_l2, LocalEmbedding
-from db import db, Document, Vector1792
-import time
+from embedding_registry import get_backend
+from embedding_cache import CachedEmbedding, model_name
+import adb
+from db import db, in_worker_thread, Document, Vector1792, MATRYOSHKA_DIM, SEARCH_PATH
+from utils import sliced_norm_l2_batch, reciprocal_rank_fusion
+from vector_index import asearch_settings, cosine_distance, identity_filter, quantization_for, quantized_distance, search_settings
+from retrieval_cache import RetrievalCache, get_retrieval_cache
+from ingest import IngestionPipeline
+import os
 from jinja2 import Template
-from llm import llm
-from prompt import rerank_prompt
+from reranker import Reranker, LLMReranker, get_reranker, RERANKER
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field
-from typing import List
+from pydantic import BaseModel, Field, RootModel
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 
 load_dotenv()
 
+TWO_STAGE_RETRIEVAL = os.getenv('TWO_STAGE_RETRIEVAL', '0') == '1'
+
 
 class VectorModel(BaseModel):
     doc_id: str
@@ -20,20 +29,96 @@ class VectorModel(BaseModel):
     meta: dict
 
 
+class RetrievedChunk(BaseModel):
+    id: int
+    doc_id: str
+    text: str
+    meta: Optional[dict] = None
+    score: float = 0.0
+    vector_rank: Optional[int] = None
+    keyword_rank: Optional[int] = None
+    distance: Optional[float] = None
+    filename: Optional[str] = None
+    path: Optional[str] = None
+
+
+class RetrievalResult(RootModel[List[RetrievedChunk]]):
+    '''
+    The chunks of one or more retrievals, each filled from a single query execution.
+    Turning them into prompt context is a separate step, render(), done only when needed.
+    '''
+    root: List[RetrievedChunk] = Field(default_factory=list)
+
+    def __iter__(self):
+        return iter(self.root)
+
+    def __len__(self) -> int:
+        return len(self.root)
+
+    def __getitem__(self, i):
+        return self.root[i]
+
+    @property
+    def chunks(self) -> List[RetrievedChunk]:
+        return self.root
+
+    def extend(self, chunks) -> None:
+        self.root.extend(chunks)
+
+    def unique(self) -> 'RetrievalResult':
+        # the same chunk can come back from several retrieval calls
+        return RetrievalResult(list({chunk.id: chunk for chunk in self.root}.values()))
+
+    @property
+    def metas(self) -> List[Optional[dict]]:
+        return [chunk.meta for chunk in self.root]
+
+    def render(self) -> str:
+        '''Numbered chunk list for the prompt.'''
+        lines = []
+        for i, chunk in enumerate(self.root, start=1):
+            # markdown headers and line breaks would break the numbered list
+            text = chunk.text.replace('#', '').replace('\n', '')
+            lines.append(f'{i}. {text}\n')
+        return ''.join(lines)
+
+
+def to_chunk(row) -> RetrievedChunk:
+    if isinstance(row, RetrievedChunk):
+        return row
+    distance = getattr(row, 'distance', None)
+    doc = getattr(row, 'doc', None)
+    return RetrievedChunk(id=row.id, doc_id=row.doc_id, text=row.text, meta=row.meta,
+                          score=1 - distance if distance is not None else 0.0, distance=distance,
+                          filename=doc.filename if doc else None, path=doc.path if doc else None)
+
+
+def cached_embedding(embedding_model=None) -> CachedEmbedding:
+    embedding_model = embedding_model or get_backend()
+    if isinstance(embedding_model, CachedEmbedding):
+        return embedding_model
+    return CachedEmbedding(embedding_model)
+
+
 class Vectorization:
     def __init__(self, embedding_model=None, sentence_splitter=None):
-        self.embedding_model = embedding_model or LocalEmbedding()
+        self.embedding_model = cached_embedding(embedding_model)
         self.sentence_splitter = sentence_splitter or SentenceSplitter(chunk_size=512, chunk_overlap=128)
 
     def create_sentence_vector(self, text, doc_id=None, dimensions=None, is_store=False, table=Vector1792):
         doc_id = doc_id or 'default'
         embedding = self.embedding_model.embedding([text])[0]
-        meta = {'embedding_model': self.embedding_model.__class__.__name__}
+        meta = {'embedding_model': model_name(self.embedding_model)}
         if is_store:
-            table.insert(doc_id=doc_id, text=text, embedding=embedding, meta=meta).execute()
+            row = {'doc_id': doc_id, 'text': text, 'embedding': embedding, 'meta': meta}
+            if hasattr(table, 'embedding_short'):
+                row['embedding_short'] = sliced_norm_l2_batch([embedding], MATRYOSHKA_DIM)[0]
+            if hasattr(table, 'embedding_model'):
+                row['embedding_model'] = meta['embedding_model']
+            table.insert(**row).execute()
         return embedding
 
-    def create_doc_vectors(self, document: Document, dimensions=None, is_store=True, table=Vector1792):
+    def split_document(self, document: Document):
         meta = {}
         doc_txt = document.text
         # sentence split
@@ -47,107 +132,221 @@ class Vectorization:
         else:
             inputs = self.sentence_splitter.split(doc_txt)
             meta['sentence_splitter'] = repr(self.sentence_splitter)
-        # embedding
-        meta['embedding_model'] = self.embedding_model.__class__.__name__
-        print('start to embedding...')
-        start = time.time()
-        embeddings = self.embedding_model.embeddings(inputs=inputs)
-        print(time.time() - start)
-        # embedding storage
-        if is_store:
-            if dimensions:
-                assert ''.join(filter(str.isdigit, table.__name__)) == str(dimensions), 'Table dimensions not match'
-                embeddings = [sliced_norm_l2(emb, dimensions) for emb in embeddings]
-            vector_objs = [{
-                'doc_id': document.doc_id,
-                'text': vm[0],
-                'embedding': vm[1],
-                'organization': document.metadata['organization'],
-                'meta': meta} for vm in zip(inputs, embeddings)]
-            with db.atomic():
-                table.insert_many(vector_objs).execute()
-                Document.get_or_create(doc_id=document.doc_id,
-                                       defaults={'filename': document.metadata['filename'],
-                                                 'organization': document.metadata['organization']})
-        return embeddings
+        meta['embedding_model'] = model_name(self.embedding_model)
+        return inputs, meta
+
+    def create_doc_vectors(self, document: Document, dimensions=None, is_store=True, table=Vector1792, batch_size=None, progress=None, incremental=True):
+        '''
+        Split, embed and store a document. When storing, chunks are streamed to the embedding
+        server in batches of `batch_size` and each batch is staged as soon as its vectors
+        arrive, so only a few batches are held in memory; the staged rows are published in one
+        short transaction at the end. A re-uploaded document only has its
+        new or changed chunks embedded and its stale rows deleted, see ingest.IngestionPipeline.
+        Returns the IngestReport, or the embeddings themselves when is_store is False.
+        progress(done, total) is called after every stored batch.
+        '''
+        if not is_store:
+            inputs, meta = self.split_document(document)
+            return self.embedding_model.embeddings(inputs=inputs)
+        if dimensions:
+            assert ''.join(filter(str.isdigit, table.__name__)) == str(dimensions), 'Table dimensions not match'
+        return IngestionPipeline(self, table, batch_size=batch_size, dimensions=dimensions).ingest(document, progress, incremental)
 
 
 class VectorRetrival:
-    def __init__(self, organization, embedding_model=None, rerank_model='qwen2-72b-instruct', table=Vector1792, metadata=None):
+    def __init__(self, organization, embedding_model=None, rerank_model='qwen2-72b-instruct', table=Vector1792, metadata=None, two_stage=None, candidates=100, reranker: Reranker = None, cache: RetrievalCache = None, quantization=None):
         self.organizaton = organization
         self.table = table
+        # two-stage: ANN search on a compact form of the vectors, exact rescoring of `candidates` rows.
+        # The first pass is 'half' or 'binary' (quantized indexes, VECTOR_QUANTIZATION per organization),
+        # 'short' (the Matryoshka prefix column) or None for a single exact search
+        quantization = quantization_for(organization) if quantization is None else quantization
+        two_stage = (TWO_STAGE_RETRIEVAL if two_stage is None else two_stage) and hasattr(table, 'embedding_short')
+        self.first_pass = quantization or ('short' if two_stage else None)
+        self.candidates = candidates
         self.metadata = metadata or {'embedding_model': 'LocalEmbedding', 'sentence_splitter': 'RawMarkdownSplitter'}
-        self.docs = ''
-        self.doc_meta = []
+        # every chunk retrieved so far, reranking works on these
+        self.result = RetrievalResult()
         self.rerank_model = rerank_model
-        self.embedding_model = embedding_model or LocalEmbedding()
-        
-    def build_retrieved_result(self, chunks):
-        retrival_chunks = ""
-        for i, chunk in enumerate(chunks, start=1):
-            # Remove special characters and newlines
-            cleaned_chunk = chunk.text.replace('#', '').replace('\n', '')
-            # Append to the formatted string
-            retrival_chunks += f"{i}. {cleaned_chunk}\n"
-        return retrival_chunks
+        # rerank_model only applies to the LLM reranker
+        self.reranker = reranker or (LLMReranker(rerank_model) if RERANKER == 'llm' else get_reranker())
+        self.embedding_model = cached_embedding(embedding_model)
+        # shared Redis cache of vector results, cache=False disables it for this instance
+        self.cache = get_retrieval_cache() if cache is None else cache
 
-    def vector_retrieval(self, query, topk=20, raw=False):
-        db.execute_sql('SET search_path TO valacy,public')
-        query_embedding = self.embedding_model.embeddings(inputs=[query])[0]
-        vectors = (self.table.select(self.table.doc_id, self.table.text, self.table.meta, self.table.embedding.cosine_distance(query_embedding).alias('distance'), Document.filename, Document.path)
-                   .join(Document, on=(self.table.doc_id == Document.doc_id), attr='doc')
-                   .where(
-                       (self.table.meta['embedding_model']==self.metadata['embedding_model']) & (self.table.meta['sentence_splitter']==self.metadata['sentence_splitter']) & (self.table.organization == self.organizaton))
-                   .order_by(
-                       self.table.embedding.cosine_distance(query_embedding))
-                   .limit(topk))
-        context = self.build_retrieved_result(vectors)
-        self.docs += context
-        self.doc_meta.extend([v.meta for v in vectors])
+    @property
+    def chunks(self) -> List[RetrievedChunk]:
+        return self.result.chunks
+
+    @property
+    def docs(self) -> str:
+        '''Context of everything retrieved so far, rendered on access.'''
+        return self.result.render()
+
+    @property
+    def doc_meta(self) -> List[Optional[dict]]:
+        return self.result.metas
+
+    def reset(self) -> None:
+        self.result = RetrievalResult()
+
+    def _filters(self):
+        return identity_filter(self.table, self.organizaton, self.metadata['embedding_model'], self.metadata['sentence_splitter'])
+
+    def _first_pass_distance(self, query_embedding):
+        if self.first_pass == 'short':
+            return self.table.embedding_short.cosine_distance(sliced_norm_l2_batch([query_embedding], MATRYOSHKA_DIM)[0])
+        return quantized_distance(self.table.embedding, query_embedding, self.first_pass)
+
+    def _vector_query(self, query_embedding, topk=20):
+        distance = cosine_distance(self.table.embedding, query_embedding)
+        query = (self.table.select(self.table.id, self.table.doc_id, self.table.text, self.table.meta, distance.alias('distance'), Document.filename, Document.path)
+                 .join(Document, on=(self.table.doc_id == Document.doc_id), attr='doc'))
+        if self.first_pass:
+            candidates = (self.table.select(self.table.id)
+                          .where(self._filters())
+                          .order_by(self._first_pass_distance(query_embedding))
+                          .limit(max(self.candidates, topk)))
+            # the organization prunes the id lookups to its partition
+            query = query.where((self.table.organization == self.organizaton) & self.table.id.in_(candidates))
+        else:
+            query = query.where(self._filters())
+        return query.order_by(distance).limit(topk)
+
+    def _search(self, query_embedding, topk=20):
+        # the ANN scan has to return at least as many rows as the candidate list it feeds
+        limit = max(self.candidates, topk) if self.first_pass else topk
+        db.execute_sql(f'SET search_path TO {SEARCH_PATH}')
+        with search_settings(limit=limit):
+            return list(self._vector_query(query_embedding, topk))
+
+    async def _asearch(self, query_embedding, topk=20):
+        limit = max(self.candidates, topk) if self.first_pass else topk
+        async with asearch_settings(limit=limit) as conn:
+            await conn.execute(f'SET LOCAL search_path TO {SEARCH_PATH}')
+            return await adb.fetch(self._vector_query(query_embedding, topk), conn)
+
+    def _collect(self, chunks: List[RetrievedChunk], raw=False):
+        result = RetrievalResult(chunks)
+        self.result.extend(result)
         if raw:
-            return vectors, context
-        return context
+            return result, result.render()
+        return result.render()
+
+    def _cache_lookup(self, query, topk):
+        if not self.cache:
+            return None, -1, None
+        key = self.cache.key(self.organizaton, self.metadata['embedding_model'], self.metadata['sentence_splitter'],
+                             query, topk, f'{self.table.__name__}:{self.first_pass or "exact"}')
+        chunks, generation = self.cache.get(self.organizaton, key)
+        return key, generation, [RetrievedChunk(**chunk) for chunk in chunks] if chunks is not None else None
+
+    def _cache_store(self, key, generation, chunks):
+        if self.cache:
+            self.cache.put(key, [chunk.model_dump() for chunk in chunks], generation)
+
+    def vector_retrieval(self, query, topk=20, raw=False):
+        key, generation, chunks = self._cache_lookup(query, topk)
+        if chunks is None:
+            query_embedding = self.embedding_model.embeddings(inputs=[query])[0]
+            chunks = [to_chunk(v) for v in self._search(query_embedding, topk)]
+            self._cache_store(key, generation, chunks)
+        return self._collect(chunks, raw)
+
+    async def avector_retrieval(self, query, topk=20, raw=False):
+        key, generation, chunks = await asyncio.to_thread(self._cache_lookup, query, topk)
+        if chunks is None:
+            query_embedding = (await self.embedding_model.aembeddings(inputs=[query]))[0]
+            chunks = [to_chunk(v) for v in await self._asearch(query_embedding, topk)]
+            await asyncio.to_thread(self._cache_store, key, generation, chunks)
+        return self._collect(chunks, raw)
     
-    def keyword_retrieval(self, query, topk=20, raw=False):
+    def _keyword_raw(self, query, topk=20):
         index_name = self.table.__name__.lower()
-        sql_tpl = '''SELECT doc_id, text FROM {{ index_name }}_index.search('(text:"{{ query }}" AND organization:{{ organization }} AND meta.embedding_model:{{ emb_model }} AND meta.sentence_splitter:{{ splitter }})',
-            limit_rows => {{ topk }});
-        '''
-        sql = Template(sql_tpl).render(index_name=index_name, query=query, organization=self.organizaton, emb_model=self.metadata['embedding_model'], splitter=self.metadata['sentence_splitter'], topk=topk)
-        items = self.table.raw(sql)
-        context = self.build_retrieved_result(items)
-        self.docs += context
-        self.doc_meta.extend([v.meta for v in items])
+        sql = Template('SELECT id, doc_id, text, meta FROM {{ index_name }}_index.search(%s, limit_rows => %s)').render(index_name=index_name)
+        expression_tpl = '(text:"{{ query }}" AND organization:{{ organization }} AND meta.embedding_model:{{ emb_model }} AND meta.sentence_splitter:{{ splitter }})'
+        # the search expression is a bound parameter, only the quoted search phrase needs escaping
+        query = query.replace('\\', ' ').replace('"', ' ')
+        expression = Template(expression_tpl).render(query=query, organization=self.organizaton, emb_model=self.metadata['embedding_model'], splitter=self.metadata['sentence_splitter'])
+        return self.table.raw(sql, expression, topk)
+
+    def _keyword_query(self, query, topk=20):
+        return list(self._keyword_raw(query, topk))
+
+    async def _akeyword_query(self, query, topk=20):
+        async with adb.transaction() as conn:
+            await conn.execute(f'SET LOCAL search_path TO {SEARCH_PATH}')
+            return await adb.fetch(self._keyword_raw(query, topk), conn)
+
+    def keyword_retrieval(self, query, topk=20, raw=False):
+        chunks = [to_chunk(row) for row in self._keyword_query(query, topk)]
         if raw:
-            return items
-        return context
-    
-    def hybrid_retrieval(self, query, topk=20):
-        pass
+            return self._collect(chunks, raw)[0]
+        return self._collect(chunks)
+
+    def _fuse(self, vector_hits, keyword_hits, topk, vector_weight, keyword_weight, rrf_k) -> List[RetrievedChunk]:
+        rows = {}
+        for hit in keyword_hits:
+            rows[hit.id] = RetrievedChunk(id=hit.id, doc_id=hit.doc_id, text=hit.text, meta=hit.meta)
+        for hit in vector_hits:
+            # vector rows carry the distance and document info, prefer them over the keyword row
+            rows[hit.id] = RetrievedChunk(id=hit.id, doc_id=hit.doc_id, text=hit.text, meta=hit.meta,
+                                          distance=hit.distance, filename=hit.doc.filename, path=hit.doc.path)
+        vector_ids = [hit.id for hit in vector_hits]
+        keyword_ids = [hit.id for hit in keyword_hits]
+        fused = reciprocal_rank_fusion([vector_ids, keyword_ids], [vector_weight, keyword_weight], rrf_k)
+        chunks = []
+        for chunk_id, score in fused[:topk]:
+            chunk = rows[chunk_id]
+            chunk.score = score
+            chunk.vector_rank = vector_ids.index(chunk_id) + 1 if chunk_id in vector_ids else None
+            chunk.keyword_rank = keyword_ids.index(chunk_id) + 1 if chunk_id in keyword_ids else None
+            chunks.append(chunk)
+        return chunks
+
+    def hybrid_retrieval(self, query, topk=20, raw=False, vector_weight=1.0, keyword_weight=1.0, rrf_k=60, candidates=None):
+        '''
+        Dense and keyword retrieval run at the same time on separate connections and are merged
+        with weighted reciprocal-rank fusion. raw=True returns the scored RetrievedChunk list too.
+        '''
+        candidates = candidates or 2 * topk
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            keyword = pool.submit(in_worker_thread, self._keyword_query, query, candidates)
+            vector = pool.submit(in_worker_thread, lambda: self._search(self.embedding_model.embeddings(inputs=[query])[0], candidates))
+            chunks = self._fuse(vector.result(), keyword.result(), topk, vector_weight, keyword_weight, rrf_k)
+        return self._collect(chunks, raw)
+
+    async def ahybrid_retrieval(self, query, topk=20, raw=False, vector_weight=1.0, keyword_weight=1.0, rrf_k=60, candidates=None):
+        candidates = candidates or 2 * topk
+
+        async def vector_hits():
+            query_embedding = (await self.embedding_model.aembeddings(inputs=[query]))[0]
+            return await self._asearch(query_embedding, candidates)
+
+        vector, keyword = await asyncio.gather(vector_hits(), self._akeyword_query(query, candidates))
+        return self._collect(self._fuse(vector, keyword, topk, vector_weight, keyword_weight, rrf_k), raw)
     
-    def rerank(self, query, topk=5) -> tuple[str, List[dict]]:
-        if not self.docs:
-            return None, None
-        query = rerank_prompt().render(query=query, documents=self.docs, topk=topk)
-        result: str = llm(query, self.rerank_model, stream=False)
-        # build dict from result string
-        doc_ids_dict = eval(result)
-        doc_ids = doc_ids_dict.get("documents", [])
-        doc_ids = [int(doc_id) for doc_id in doc_ids]
-        if not doc_ids:
+    def _reranked(self, candidates, ranked, raw):
+        result = RetrievalResult([candidates[i].model_copy(update={'score': score}) for i, score in ranked])
+        if raw:
+            return result
+        if not result:
             return None, None
-        # return rerank context
-        reranked_chunks = []
-        chunks = self.docs.split('\n')
-        reranked_meta = []
-        for doc_id in doc_ids:
-            for chunk in zip(chunks, self.doc_meta):
-                if chunk[0].startswith(f"{doc_id}. "):
-                    reranked_chunks.append(chunk[0])
-                    reranked_meta.append(chunk[1])
-                    break
-        return "\n".join(reranked_chunks), reranked_meta
+        return result.render().rstrip('\n'), result.metas
+
+    def rerank(self, query, topk=5, raw=False):
+        '''
+        Rerank everything retrieved so far. Returns (context, metas) like before, or the scored
+        RetrievalResult with raw=True.
+        '''
+        candidates = self.result.unique()
+        ranked = self.reranker.rerank(query, [chunk.text for chunk in candidates], topk) if candidates else []
+        return self._reranked(candidates, ranked, raw)
 
+    async def arerank(self, query, topk=5, raw=False):
+        candidates = self.result.unique()
+        ranked = await self.reranker.arerank(query, [chunk.text for chunk in candidates], topk) if candidates else []
+        return self._reranked(candidates, ranked, raw)
 
 if __name__ == '__main__':
     from tool.splitter import RawMarkdownSplitter
\ No newline at end of file